@@ -0,0 +1,96 @@
+"""
+Benchmark registry shared by the bench_*.py modules and run.py.
+
+A benchmark is a function taking the canvas size and returning the callable
+to time, so setup work (creating buffers, writing input files) is not
+measured. The callable must give the same result when called repeatedly.
+"""
+
+from __future__ import annotations
+
+import atexit
+import os
+import shutil
+import sys
+import tempfile
+from typing import Callable
+
+# Application modules are plain modules in the grid directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "grid"))
+
+try:
+    # Same versions as the application, for the benchmarks of GTK code paths
+    import gi  # type:ignore
+
+    gi.require_version("Gtk", "4.0")
+    gi.require_version("GdkPixbuf", "2.0")
+except (ImportError, ValueError):
+    pass
+
+from pixel_buffer import pack_color  # noqa: E402
+
+# Square canvas sides from the smallest sprite to the largest supported canvas
+SIZES: tuple[int, ...] = (16, 64, 256, 1024, 4096)
+
+
+class Benchmark:
+    __slots__ = ("name", "setup", "sizes", "requires")
+
+    def __init__(
+        self,
+        name: str,
+        setup: Callable[[int], Callable[[], object]],
+        sizes: tuple[int, ...],
+        requires: tuple[str, ...],
+    ) -> None:
+        self.name: str = name
+        self.setup: Callable[[int], Callable[[], object]] = setup
+        self.sizes: tuple[int, ...] = sizes
+        # Modules that must be importable, e.g. "gi" and "cairo"
+        self.requires: tuple[str, ...] = requires
+
+
+BENCHMARKS: list[Benchmark] = []
+
+# Input and output files of benchmarks, removed on exit
+_temp_dir: str = tempfile.mkdtemp(prefix="grid-bench-")
+atexit.register(shutil.rmtree, _temp_dir, True)
+
+
+def bench(sizes: tuple[int, ...] = SIZES, requires: tuple[str, ...] = ()):
+    """Register benchmark as "<module without bench_>.<function>" """
+
+    def register(setup: Callable[[int], Callable[[], object]]):
+        group: str = setup.__module__.removeprefix("bench_")
+        BENCHMARKS.append(Benchmark(f"{group}.{setup.__name__}", setup, sizes, requires))
+        return setup
+
+    return register
+
+
+def temp_path(name: str) -> str:
+    return os.path.join(_temp_dir, name)
+
+
+def noise_colors(colors: int = 16, seed: int = 1) -> list[int]:
+    """Opaque packed 0xRRGGBBAA colors used by `noise()`"""
+    return [
+        pack_color((i * 67 + seed) & 0xFF, (i * 151 + seed) & 0xFF, (i * 37) & 0xFF)
+        for i in range(colors)
+    ]
+
+
+def noise(size: int, colors: int = 16, seed: int = 1) -> bytes:
+    """
+    Deterministic packed RGBA image of `size` x `size` made of 8x8 blocks of
+    `colors` opaque colors, like a typical sprite rather than random noise
+    """
+    palette: list[bytes] = [color.to_bytes(4, "big") for color in noise_colors(colors, seed)]
+    rows: list[bytes] = []
+    for by in range(0, size, 8):
+        row: bytes = b"".join(
+            palette[((bx * 31) ^ (by * 17) ^ seed) % colors] * min(8, size - bx)
+            for bx in range(0, size, 8)
+        )
+        rows.append(row * min(8, size - by))
+    return b"".join(rows)
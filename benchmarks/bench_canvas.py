@@ -0,0 +1,74 @@
+"""Pixel storage and the tile compositing behind the canvas redraw"""
+
+from __future__ import annotations
+
+from bench import bench, noise, noise_colors
+from indexed import IndexedPixelBuffer, Palette
+from pixel_buffer import TILE_SIZE, PixelBuffer
+from pixel_buffer import rgba_to_argb32 as _rgba_to_argb32
+
+
+@bench()
+def fill_rect(size: int):
+    buffer = PixelBuffer(size, size)
+    return lambda: buffer.fill_rect(0, 0, size, size, 0x336699FF)
+
+
+@bench()
+def region_bytes(size: int):
+    buffer = PixelBuffer.from_bytes(size, size, noise(size))
+    return lambda: buffer.region_bytes(0, 0, size, size)
+
+
+@bench()
+def from_bytes(size: int):
+    data: bytes = noise(size)
+    return lambda: PixelBuffer.from_bytes(size, size, data)
+
+
+@bench()
+def rgba_to_argb32(size: int):
+    # Every 8th pixel translucent, so the premultiplication path runs too
+    data = bytearray(noise(size))
+    data[3::32] = b"\x80" * len(data[3::32])
+    return lambda: _rgba_to_argb32(data)
+
+
+@bench()
+def indexed_argb32(size: int):
+    """Palette lookup rendering, done for every tile after a palette edit"""
+    data: bytes = noise(size)
+    palette: Palette = Palette.from_colors(noise_colors())
+    buffer = IndexedPixelBuffer(size, size, palette)
+    buffer.write_bytes(0, 0, size, size, data)
+
+    def run() -> bytearray:
+        # Invalidate the palette's cached lookup tables like an edit does
+        palette.set(1, 0xFF000080)
+        return buffer.argb32_region(0, 0, size, size)
+
+    return run
+
+
+@bench(requires=("gi", "cairo"))
+def redraw_tiles(size: int):
+    """
+    `DrawingArea.redraw_cached_surface` followed by painting the whole canvas:
+    drop the cached tiles and composite all of them again from three layers
+    """
+    from layers import LayerStack
+
+    frame: LayerStack = LayerStack.from_buffer(PixelBuffer.from_bytes(size, size, noise(size)))
+    frame.add_layer().buffer.write_bytes(0, 0, size, size // 2, noise(size)[: size * size * 2])
+    frame.add_layer().buffer.fill_rect(size // 4, size // 4, size // 2, size // 2, 0xFF000080)
+    frame.set_active(1)
+    frame.max_cached_tiles = max(frame.max_cached_tiles, (size // TILE_SIZE + 1) ** 2)
+    tiles: range = range((size + TILE_SIZE - 1) // TILE_SIZE)
+
+    def run() -> None:
+        frame.drop_cache()
+        for ty in tiles:
+            for tx in tiles:
+                frame.get_tile(tx, ty)
+
+    return run
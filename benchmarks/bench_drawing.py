@@ -0,0 +1,103 @@
+"""Drawing tools: Bresenham strokes, shapes and flood fill with their undo history"""
+
+from __future__ import annotations
+
+from bench import bench, noise
+from fill import flood_fill_spans
+from history import History
+from pixel_buffer import TILE_SIZE, DirtyRegion, PixelBuffer
+from shapes import clip_spans, ellipse_spans, line_points, line_spans, write_spans
+
+
+# Pointer motion events per frame while drawing quickly, and pixels between them
+_EVENTS_PER_FRAME: int = 8
+_EVENT_SPACING: int = 3
+
+
+@bench(requires=("gi", "cairo"))
+def pencil_stroke(size: int):
+    """
+    A Pencil stroke across the canvas as the drawing area runs it: pointer
+    events interpolated by `__interpolate_positions`, every pixel recorded,
+    written and added to the stroke overlay, the overlay re-composited in the
+    cached tiles once per frame and merged into them on release
+    """
+    from layers import LayerStack, StrokeLayer
+
+    frame: LayerStack = LayerStack.from_buffer(PixelBuffer.from_bytes(size, size, noise(size)))
+    frame.add_layer()
+    # Tiles of a 1024x1024 viewport are cached, like while drawing
+    tiles: range = range(min(size, 1024) // TILE_SIZE or 1)
+    for ty in tiles:
+        for tx in tiles:
+            frame.get_tile(tx, ty)
+    end: tuple[int, int] = (size - 1, size // 3)
+    events: list[tuple[int, int]] = [
+        (x, y) for x, y in line_points(0, 0, *end)[::_EVENT_SPACING]
+    ] + [end]
+
+    def run() -> None:
+        history = History()
+        stroke = StrokeLayer()
+        buffer: PixelBuffer = frame.active_layer.buffer
+        dirty = DirtyRegion()
+        for i in range(1, len(events), _EVENTS_PER_FRAME):
+            for start, stop in zip(events[i - 1 :], events[i : i + _EVENTS_PER_FRAME]):
+                # `Pencil.__paint` of every interpolated pixel, segment ends twice
+                for x, y in line_points(*start, *stop):
+                    history.record(buffer, x, y)
+                    buffer.set(x, y, 0x336699FF)
+                    stroke.add(x, y, buffer.get(x, y), size, size)
+                    frame.overlay = (stroke.surface, *stroke.origin)
+                    dirty.add(x, y)
+            # `DrawingArea.__flush_dirty_region`
+            frame.update_overlay(dirty.take())
+        x0, y0, x1, y1 = stroke.bounds
+        frame.merge_overlay(x0, y0, x1 - x0 + 1, y1 - y0 + 1)
+        stroke.clear()
+        history.commit()
+
+    return run
+
+
+@bench()
+def line_tool(size: int):
+    """`Line` tool: diagonal line rasterised to spans, recorded and written at once"""
+    buffer = PixelBuffer(size, size)
+
+    def run() -> None:
+        history = History()
+        spans = clip_spans(line_spans(0, 0, size - 1, size // 3), size, size)
+        history.record_spans(buffer, spans)
+        write_spans(buffer, spans, 0x336699FF)
+        history.commit()
+
+    return run
+
+
+@bench()
+def ellipse_tool(size: int):
+    buffer = PixelBuffer(size, size)
+
+    def run() -> None:
+        history = History()
+        spans = clip_spans(ellipse_spans(0, 0, size - 1, size - 1, True), size, size)
+        history.record_spans(buffer, spans)
+        write_spans(buffer, spans, 0x336699FF)
+        history.commit()
+
+    return run
+
+
+@bench()
+def flood_fill(size: int):
+    """Fill of one color of a blocky image, many short spans"""
+    buffer = PixelBuffer.from_bytes(size, size, noise(size, colors=2))
+    return lambda: flood_fill_spans(buffer, 0, 0)
+
+
+@bench()
+def flood_fill_empty(size: int):
+    """Fill of an empty canvas, mostly unallocated tiles"""
+    buffer = PixelBuffer(size, size)
+    return lambda: flood_fill_spans(buffer, 0, 0)
@@ -0,0 +1,91 @@
+"""PNG import and export"""
+
+from __future__ import annotations
+
+import struct
+import zlib
+
+import png as Png
+from bench import bench, noise, noise_colors, temp_path
+from indexed import IndexedPixelBuffer, Palette
+from pixel_buffer import PixelBuffer
+
+
+def _write_input(size: int) -> str:
+    path: str = temp_path(f"input-{size}.png")
+    Png.write_buffer(path, PixelBuffer.from_bytes(size, size, noise(size)))
+    return path
+
+
+@bench()
+def write_png(size: int):
+    buffer = PixelBuffer.from_bytes(size, size, noise(size))
+    path: str = temp_path(f"write-{size}.png")
+    return lambda: Png.write_buffer(path, buffer)
+
+
+@bench()
+def write_png_indexed(size: int):
+    buffer = IndexedPixelBuffer(size, size, Palette.from_colors(noise_colors()))
+    buffer.write_bytes(0, 0, size, size, noise(size))
+    path: str = temp_path(f"write-indexed-{size}.png")
+    return lambda: Png.write_buffer(path, buffer)
+
+
+@bench(sizes=(16, 64, 256))
+def write_png_scaled(size: int):
+    """Export upscaled 16 times, the output is up to 4096x4096"""
+    buffer = PixelBuffer.from_bytes(size, size, noise(size))
+    path: str = temp_path(f"write-scaled-{size}.png")
+    return lambda: Png.write_buffer(path, buffer, scale=16)
+
+
+@bench()
+def read_png(size: int):
+    path: str = _write_input(size)
+    return lambda: Png.read_png(path)
+
+
+@bench(sizes=(16, 64, 256, 1024))
+def read_png_paeth(size: int):
+    """
+    Decoding Paeth filtered rows, the filter most encoders pick for photos and
+    gradients. The noise is used as the filtered bytes, so the decoded image
+    differs from it but takes the same work
+    """
+    path: str = temp_path(f"input-paeth-{size}.png")
+    data: bytes = noise(size)
+    rows: bytes = b"".join(
+        b"\x04" + data[y * size * 4 : (y + 1) * size * 4] for y in range(size)
+    )
+    with open(path, "wb") as file:
+        file.write(Png.PNG_SIGNATURE)
+        for tag, chunk in (
+            (b"IHDR", struct.pack(">IIBBBBB", size, size, 8, Png.COLOR_RGBA, 0, 0, 0)),
+            (b"IDAT", zlib.compress(rows)),
+            (b"IEND", b""),
+        ):
+            file.write(struct.pack(">I", len(chunk)) + tag + chunk)
+            file.write(struct.pack(">I", zlib.crc32(tag + chunk)))
+    return lambda: Png.read_png(path)
+
+
+@bench(requires=("gi",))
+def load_png(size: int):
+    """`utils.load_png`: GdkPixbuf decoding and the copy into a pixel buffer"""
+    import utils as Utils
+
+    path: str = _write_input(size)
+    return lambda: Utils.load_png(path)
+
+
+@bench(requires=("gi", "cairo"))
+def save_png(size: int):
+    """`utils.save_png`: flattening a two layer frame and writing it"""
+    import utils as Utils
+    from layers import LayerStack
+
+    frame: LayerStack = LayerStack.from_buffer(PixelBuffer.from_bytes(size, size, noise(size)))
+    frame.add_layer().buffer.fill_rect(size // 4, size // 4, size // 2, size // 2, 0xFF000080)
+    path: str = temp_path(f"save-{size}.png")
+    return lambda: Utils.save_png(path, frame)
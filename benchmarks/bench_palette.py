@@ -0,0 +1,87 @@
+"""Palette extraction, remapping and the palette library"""
+
+from __future__ import annotations
+
+import os
+
+from bench import bench, noise, noise_colors, temp_path
+from indexed import Palette
+from palette_library import PaletteLibrary
+from quantize import extract_palette as _extract_palette
+
+
+@bench()
+def extract_palette(size: int):
+    """Median cut of an image with more colors than the palette"""
+    data: bytes = noise(size, colors=256)
+    return lambda: _extract_palette(data, 32)
+
+
+@bench()
+def remap(size: int):
+    """Nearest palette index of every pixel, as in indexed import and `grid batch --remap`"""
+    data: bytes = noise(size, colors=256)
+    colors: list[int] = noise_colors(256)[::8]
+
+    # A new palette has no cached nearest matches
+    return lambda: Palette.from_colors(colors).indices_of(data)
+
+
+@bench(requires=("gi",))
+def get_pallete_colors_from_file(size: int):
+    """`utils.get_pallete_colors_from_file`: decoding an image and extracting its palette"""
+    import png as Png
+    import utils as Utils
+    from pixel_buffer import PixelBuffer
+
+    path: str = temp_path(f"palette-{size}.png")
+    Png.write_buffer(path, PixelBuffer.from_bytes(size, size, noise(size, colors=256)))
+    return lambda: Utils.get_pallete_colors_from_file(path)
+
+
+def _palette_directory(count: int) -> str:
+    """Directory of `count` GIMP palettes of 64 colors"""
+    directory: str = temp_path(f"palettes-{count}")
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        rows: str = "".join(
+            f"{c >> 24} {c >> 16 & 0xFF} {c >> 8 & 0xFF}\tColor\n"
+            for c in noise_colors(64, seed=i)
+        )
+        with open(os.path.join(directory, f"palette-{i}.gpl"), "w") as file:
+            file.write(f"GIMP Palette\nName: Palette {i}\nColumns: 8\n#\n{rows}")
+    return directory
+
+
+# Sizes of the library benchmarks are numbers of palette files
+
+
+@bench(sizes=(16, 256))
+def library_cold_scan(size: int):
+    """First start: every file is parsed and the index is written"""
+    directory: str = _palette_directory(size)
+    index_path: str = temp_path(f"palettes-{size}-cold.json")
+
+    def run() -> list[str]:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        library = PaletteLibrary(directory, index_path)
+        library.scan()
+        return library.labels()
+
+    return run
+
+
+@bench(sizes=(16, 256))
+def library_warm_scan(size: int):
+    """Later starts: the index is read and the files are only stat'ed"""
+    directory: str = _palette_directory(size)
+    index_path: str = temp_path(f"palettes-{size}-warm.json")
+    PaletteLibrary(directory, index_path).scan()
+
+    def run() -> list[str]:
+        library = PaletteLibrary(directory, index_path)
+        library.scan()
+        return library.labels()
+
+    return run
@@ -0,0 +1,271 @@
+"""
+Headless benchmarks of the canvas hot paths: `python3 benchmarks/run.py [options]`.
+
+Every benchmark in the bench_*.py modules runs at each of its canvas sizes.
+Time is the fastest of several runs, peak memory is traced in one extra run
+with tracemalloc. Results are compared with a baseline JSON and the run fails
+when a benchmark got slower or allocates more than the tolerances allow, or
+has no baseline entry to compare with. That includes benchmarks skipped for
+missing dependencies, their entries are recorded where they can run. Timings
+depend on the machine, record a baseline on it first with --update.
+"""
+
+from __future__ import annotations
+
+import argparse
+import gc
+import glob
+import importlib
+import importlib.util
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable
+
+from bench import BENCHMARKS, Benchmark
+
+DIRECTORY: str = os.path.dirname(os.path.abspath(__file__))
+
+# Differences below these are noise whatever the tolerance
+TIME_FLOOR: float = 0.0005
+MEMORY_FLOOR: int = 64 * 1024
+# Apparent slowdowns are measured again this many times before they are
+# reported, machines busy with other work easily make a run 1.5x slower.
+# For the same reason the default time tolerance is a 2x slowdown
+RETRIES: int = 2
+
+
+def measure_time(run: Callable[[], object], min_time: float) -> tuple[float, int]:
+    """Fastest of at least 3 runs taking `min_time` seconds in total. Returns it and run count"""
+    # Untimed first run fills caches and lets the allocator settle on its
+    # thresholds, so results don't depend on the benchmarks that ran before
+    run()
+    best: float = float("inf")
+    total: float = 0.0
+    count: int = 0
+    gc.collect()
+    gc.disable()
+    try:
+        while count < 3 or (total < min_time and count < 1000):
+            start: float = time.perf_counter()
+            run()
+            elapsed: float = time.perf_counter() - start
+            best = min(best, elapsed)
+            total += elapsed
+            count += 1
+    finally:
+        gc.enable()
+    return best, count
+
+
+def _reference_work() -> None:
+    """Fixed mix of interpreted loops and bulk byte operations"""
+    values: dict[int, int] = {}
+    for i in range(20000):
+        values[i & 1023] = i * 3
+    data: bytes = bytes(range(256)) * 4096
+    data.translate(bytes(reversed(range(256)))).count(b"\x00")
+    bytearray(data)[::4] = data[::4]
+
+
+def calibrate() -> float:
+    """
+    Time of the reference work. Timings compared with a baseline are scaled by
+    the ratio of the calibrations, so a machine that is slower as a whole
+    (other load, power saving) doesn't make every benchmark regress
+    """
+    return measure_time(_reference_work, 0.0)[0]
+
+
+def measure_memory(run: Callable[[], object]) -> int:
+    """Peak of memory allocated by one run, above what was allocated before it"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before: int = tracemalloc.get_traced_memory()[0]
+        run()
+        return tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+
+def scaled_time(result: dict, base: dict) -> float:
+    """Result's time as if measured on the machine at the time of the baseline"""
+    return result["time"] * base["calibration"] / result["calibration"]
+
+
+def regression(result: dict, base: dict, options: argparse.Namespace) -> str:
+    """Description of how result regressed from the baseline, empty if it didn't"""
+    problems: list[str] = []
+    seconds: float = scaled_time(result, base)
+    if (
+        seconds > base["time"] * (1 + options.time_tolerance)
+        and seconds - base["time"] > TIME_FLOOR
+    ):
+        problems.append(f"time {seconds / base['time']:.2f}x")
+    if (
+        result["memory"] > base["memory"] * (1 + options.memory_tolerance)
+        and result["memory"] - base["memory"] > MEMORY_FLOOR
+    ):
+        problems.append(f"memory {result['memory'] / max(base['memory'], 1):.2f}x")
+    return ", ".join(problems)
+
+
+def missing_modules(benchmark: Benchmark) -> list[str]:
+    return [name for name in benchmark.requires if importlib.util.find_spec(name) is None]
+
+
+def main(args: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="run.py", description="Run benchmarks and compare them with a baseline"
+    )
+    parser.add_argument(
+        "-k",
+        "--filter",
+        action="append",
+        default=[],
+        help="only run benchmarks whose name contains this, may be repeated",
+    )
+    parser.add_argument("--max-size", type=int, help="skip larger canvas sizes")
+    parser.add_argument(
+        "--baseline",
+        default=os.path.join(DIRECTORY, "baseline.json"),
+        help="baseline JSON file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--update", action="store_true", help="record the results in the baseline"
+    )
+    parser.add_argument(
+        "--time-tolerance",
+        type=float,
+        default=1.0,
+        help="allowed slowdown as a fraction of the baseline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--memory-tolerance",
+        type=float,
+        default=0.2,
+        help="allowed memory growth as a fraction of the baseline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="seconds spent repeating each fast benchmark (default: %(default)s)",
+    )
+    options = parser.parse_args(args)
+
+    for path in sorted(glob.glob(os.path.join(DIRECTORY, "bench_*.py"))):
+        importlib.import_module(os.path.splitext(os.path.basename(path))[0])
+
+    try:
+        with open(options.baseline) as file:
+            baseline: dict[str, dict] = json.load(file)["results"]
+    except FileNotFoundError:
+        baseline = {}
+    except (OSError, ValueError, KeyError) as e:
+        parser.error(f"Invalid baseline {options.baseline}: {e}")
+
+    results: dict[str, dict] = {}
+    regressions: list[str] = []
+    # Benchmarks without a baseline entry, nothing guards them. Those skipped
+    # here fail the run too, or a suite missing them would pass everywhere
+    unguarded: list[str] = []
+    unguarded_skipped: list[str] = []
+    skipped: int = 0
+    for benchmark in BENCHMARKS:
+        if options.filter and not any(f in benchmark.name for f in options.filter):
+            continue
+        missing: list[str] = missing_modules(benchmark)
+        for size in benchmark.sizes:
+            if options.max_size and size > options.max_size:
+                continue
+            key: str = f"{benchmark.name}[{size}]"
+            reason: str = f"{', '.join(missing)} not installed" if missing else ""
+            if not reason:
+                try:
+                    run: Callable[[], object] = benchmark.setup(size)
+                except (ImportError, ValueError) as e:
+                    # E.g. gi without the GTK typelibs
+                    reason = str(e)
+            if reason:
+                print(f"{key:<40} skipped, {reason}")
+                skipped += 1
+                if key not in baseline:
+                    unguarded_skipped.append(key)
+                continue
+
+            seconds, count = measure_time(run, options.min_time)
+            result: dict = {
+                "time": seconds,
+                "memory": measure_memory(run),
+                "calibration": calibrate(),
+            }
+            results[key] = result
+            base: dict = baseline.get(key)
+            comparison: str = "NO BASELINE"
+            if not base:
+                unguarded.append(key)
+            else:
+                problem: str = regression(result, base, options)
+                for _ in range(RETRIES if "time" in problem else 0):
+                    seconds = measure_time(run, options.min_time)[0]
+                    if seconds < result["time"]:
+                        result["time"], result["calibration"] = seconds, calibrate()
+                    problem = regression(result, base, options)
+                    if "time" not in problem:
+                        break
+                comparison = f"{(scaled_time(result, base) / base['time'] - 1) * 100:+.0f}% time"
+                if problem:
+                    regressions.append(f"{key}: {problem}")
+                    comparison += f"  REGRESSION ({problem})"
+            del run
+            print(
+                f"{key:<40} {result['time'] * 1000:>10.3f} ms"
+                f" {result['memory'] / 1024:>10.0f} KiB  ({count} runs)  {comparison}",
+                flush=True,
+            )
+
+    if options.update:
+        # Entries that weren't run (filtered, skipped) are kept
+        baseline.update(results)
+        temp_path: str = options.baseline + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(
+                {
+                    "python": sys.version.split()[0],
+                    "results": dict(sorted(baseline.items())),
+                },
+                file,
+                indent=1,
+            )
+            file.write("\n")
+        os.replace(temp_path, options.baseline)
+        print(f"Recorded {len(results)} results in {options.baseline}")
+        return 0
+
+    print(
+        f"{len(results)} benchmarks run, {skipped} skipped, {len(regressions)} regressed,"
+        f" {len(unguarded)} without baseline"
+    )
+    for line in regressions:
+        print(f"  {line}", file=sys.stderr)
+    if unguarded_skipped:
+        print(
+            f"No baseline entry in {options.baseline} for skipped {', '.join(unguarded_skipped)}."
+            " Record them with --update where their dependencies are installed",
+            file=sys.stderr,
+        )
+    if unguarded:
+        print(
+            f"No baseline entry in {options.baseline} for {', '.join(unguarded)}."
+            " Record them with --update",
+            file=sys.stderr,
+        )
+    return 1 if regressions or unguarded or unguarded_skipped else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,290 @@
+"""
+Sprite sheet atlas packing: `grid atlas INPUT OUTPUT.png [options]`.
+
+Sprites are optionally trimmed to their visible pixels and deduplicated by
+content digest, packed with a skyline bottom-left packer and written as one
+PNG plus a JSON frame map in the common TexturePacker hash layout.
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from typing import Callable
+
+import png as Png
+from pixel_buffer import PixelBuffer, content_bounds
+
+
+class Sprite:
+    """Image packed into an atlas, `data` is packed RGBA of its trimmed rectangle"""
+
+    __slots__ = ("name", "width", "height", "data", "trim", "source_size", "digest", "x", "y")
+
+    def __init__(
+        self,
+        name: str,
+        width: int,
+        height: int,
+        data: bytes,
+        trim: tuple[int, int, int, int] = None,
+        source_size: tuple[int, int] = None,
+    ) -> None:
+        self.name: str = name
+        self.width: int = width
+        self.height: int = height
+        self.data: bytes = data
+        # Rectangle of the data in the source image
+        self.trim: tuple[int, int, int, int] = trim or (0, 0, width, height)
+        self.source_size: tuple[int, int] = source_size or (width, height)
+        self.digest: bytes = hashlib.blake2b(
+            struct.pack("<II", width, height) + data, digest_size=16
+        ).digest()
+        # Position in the atlas, set by `pack()`
+        self.x: int = 0
+        self.y: int = 0
+
+
+def make_sprite(name: str, width: int, height: int, data: bytes, trim: bool) -> Sprite:
+    """Sprite of packed RGBA image, trimmed to visible pixels if `trim`"""
+    if not trim:
+        return Sprite(name, width, height, data)
+    # Fully transparent images keep one transparent pixel
+    bounds: tuple[int, int, int, int] = content_bounds(width, height, data) or (0, 0, 1, 1)
+    if bounds == (0, 0, width, height):
+        return Sprite(name, width, height, data)
+    region: bytes = PixelBuffer.from_bytes(width, height, data).region_bytes(*bounds)
+    return Sprite(name, bounds[2], bounds[3], region, bounds, (width, height))
+
+
+class SkylinePacker:
+    """
+    Skyline bottom-left rectangle packer for a fixed width and unbounded height.
+    The skyline is the top edge of everything packed so far, as [x, y, width]
+    segments. Rectangles go where their top edge ends lowest, then leftmost.
+    """
+
+    def __init__(self, width: int) -> None:
+        self.width: int = width
+        self.height: int = 0
+        self.skyline: list[list[int]] = [[0, 0, width]]
+
+    def insert(self, w: int, h: int) -> tuple[int, int] | None:
+        """Place rectangle. Returns its position, None if it's wider than the packer"""
+        skyline: list[list[int]] = self.skyline
+        best_top: int = -1
+        best_index: int = -1
+        for i in range(len(skyline)):
+            x: int = skyline[i][0]
+            if x + w > self.width:
+                break
+            # The rectangle rests on the highest segment under it
+            y: int = 0
+            remaining: int = w
+            j: int = i
+            while remaining > 0:
+                if skyline[j][1] > y:
+                    y = skyline[j][1]
+                    if best_index != -1 and y + h >= best_top:
+                        break
+                remaining -= skyline[j][2]
+                j += 1
+            else:
+                if best_index == -1 or y + h < best_top:
+                    best_top, best_index = y + h, i
+        if best_index == -1:
+            return None
+
+        x = skyline[best_index][0]
+        end: int = x + w
+        # Drop segments covered by the rectangle, shorten a partly covered one
+        j = best_index
+        while j < len(skyline) and skyline[j][0] < end:
+            segment_end: int = skyline[j][0] + skyline[j][2]
+            if segment_end > end:
+                skyline[j] = [end, skyline[j][1], segment_end - end]
+                break
+            j += 1
+        skyline[best_index:j] = [[x, best_top, w]]
+
+        # Merge with neighbours of the same height
+        i = best_index
+        if i + 1 < len(skyline) and skyline[i + 1][1] == best_top:
+            skyline[i][2] += skyline.pop(i + 1)[2]
+        if i > 0 and skyline[i - 1][1] == best_top:
+            skyline[i - 1][2] += skyline.pop(i)[2]
+
+        self.height = max(self.height, best_top)
+        return x, best_top - h
+
+
+def pack(
+    sprites: list[Sprite], padding: int = 1, max_width: int = None, dedup: bool = True
+) -> tuple[int, int]:
+    """
+    Set atlas positions of sprites. Identical sprites share one rectangle if
+    `dedup`. The atlas width starts at the side of a square holding all sprites.
+    Returns the atlas size
+    """
+    unique: dict[bytes, Sprite] = {}
+    for sprite in sprites:
+        unique.setdefault(sprite.digest if dedup else id(sprite), sprite)
+    if not unique:
+        return 0, 0
+    # Tallest first keeps the skyline flat
+    order: list[Sprite] = sorted(
+        unique.values(), key=lambda s: (s.height, s.width), reverse=True
+    )
+
+    widest: int = max(sprite.width for sprite in order) + padding
+    area: int = sum((s.width + padding) * (s.height + padding) for s in order)
+    width: int = max(widest, math.ceil(math.sqrt(area)))
+    if max_width:
+        if widest > max_width + padding:
+            raise ValueError(f"Sprites are wider than {max_width} pixels")
+        width = min(width, max_width + padding)
+
+    packer = SkylinePacker(width)
+    for sprite in order:
+        sprite.x, sprite.y = packer.insert(sprite.width + padding, sprite.height + padding)
+    for sprite in sprites:
+        if dedup:
+            original: Sprite = unique[sprite.digest]
+            sprite.x, sprite.y = original.x, original.y
+
+    # Trailing padding isn't needed
+    return (
+        max(s.x + s.width for s in order),
+        max(s.y + s.height for s in order),
+    )
+
+
+def frame_map(sprites: list[Sprite], image: str, size: tuple[int, int]) -> dict:
+    """JSON frame map in TexturePacker's hash layout, understood by most engines"""
+    return {
+        "frames": {
+            sprite.name: {
+                "frame": {"x": sprite.x, "y": sprite.y, "w": sprite.width, "h": sprite.height},
+                "rotated": False,
+                "trimmed": sprite.source_size != (sprite.width, sprite.height),
+                "spriteSourceSize": dict(zip("xywh", sprite.trim)),
+                "sourceSize": {"w": sprite.source_size[0], "h": sprite.source_size[1]},
+            }
+            for sprite in sprites
+        },
+        "meta": {
+            "app": "Grid",
+            "image": image,
+            "format": "RGBA8888",
+            "size": {"w": size[0], "h": size[1]},
+        },
+    }
+
+
+def write_atlas(
+    sprites: list[Sprite],
+    path: str,
+    padding: int = 1,
+    max_width: int = None,
+    dedup: bool = True,
+    progress: Callable[[float], None] = None,
+) -> tuple[int, int]:
+    """Pack sprites, write atlas PNG and its frame map next to it (.json). Returns size"""
+    width, height = pack(sprites, padding, max_width, dedup)
+    atlas: PixelBuffer = PixelBuffer(max(width, 1), max(height, 1))
+    written: set[tuple[int, int]] = set()
+    for sprite in sprites:
+        # Duplicates share the rectangle, copy it once
+        if (sprite.x, sprite.y) not in written:
+            written.add((sprite.x, sprite.y))
+            atlas.write_bytes(sprite.x, sprite.y, sprite.width, sprite.height, sprite.data)
+    Png.write_buffer(path, atlas, progress)
+
+    temp_path: str = os.path.splitext(path)[0] + ".json.tmp"
+    with open(temp_path, "w") as file:
+        json.dump(frame_map(sprites, os.path.basename(path), (width, height)), file, indent=1)
+    os.replace(temp_path, temp_path[: -len(".tmp")])
+    return width, height
+
+
+def _load(task: tuple[str, bool]) -> Sprite | str:
+    """Load sprite in a worker process. Returns error message on failure"""
+    path, trim = task
+    try:
+        width, height, data = Png.read_png(path)
+    except Exception as e:
+        return f"{os.path.basename(path)}: {e}"
+    name: str = os.path.splitext(os.path.basename(path))[0]
+    return make_sprite(name, width, height, data, trim)
+
+
+def main(args: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="grid atlas", description="Pack a directory of PNG sprites into an atlas"
+    )
+    parser.add_argument("input", help="directory of PNG images")
+    parser.add_argument("output", help="atlas PNG, the frame map is written next to it")
+    parser.add_argument("--trim", action="store_true", help="crop transparent borders")
+    parser.add_argument(
+        "--no-dedup", action="store_true", help="pack identical sprites separately"
+    )
+    parser.add_argument("--padding", type=int, default=1, help="pixels between sprites")
+    parser.add_argument("--max-width", type=int, help="atlas width limit")
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="worker processes for loading"
+    )
+    options = parser.parse_args(args)
+    if options.padding < 0 or options.jobs < 1:
+        parser.error("--padding must not be negative and --jobs must be at least 1")
+
+    try:
+        paths: list[str] = sorted(
+            os.path.join(options.input, name)
+            for name in os.listdir(options.input)
+            if name.lower().endswith(".png")
+        )
+        os.makedirs(os.path.dirname(options.output) or ".", exist_ok=True)
+    except OSError as e:
+        parser.error(str(e))
+
+    start: float = time.perf_counter()
+    # Forked workers start without importing the GUI entry point again
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    sprites: list[Sprite] = []
+    with context.Pool(min(options.jobs, len(paths) or 1)) as pool:
+        for result in pool.imap(_load, [(path, options.trim) for path in paths], 16):
+            if isinstance(result, str):
+                print(result, file=sys.stderr)
+            else:
+                sprites.append(result)
+    loaded: float = time.perf_counter()
+
+    try:
+        width, height = write_atlas(
+            sprites,
+            options.output,
+            options.padding,
+            options.max_width,
+            not options.no_dedup,
+        )
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    placed: dict[tuple[int, int], Sprite] = {(s.x, s.y): s for s in sprites}
+    used: int = sum(sprite.width * sprite.height for sprite in placed.values())
+    print(
+        f"{len(sprites)} sprites ({len(placed)} unique) loaded in {loaded - start:.2f} s,"
+        f" packed into {width}x{height} ({used * 100 / max(width * height, 1):.0f}% used)"
+        f" in {time.perf_counter() - loaded:.2f} s"
+    )
+    return 1 if len(sprites) != len(paths) else 0
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+import threading
+import time
+
+from gi.repository import GLib  # type:ignore
+
+from document import Document
+from grid_file import GridFile
+from state import State
+
+
+class Autosave:
+    """
+    Periodic background save of the open document for crash recovery.
+
+    The recovery file is a .grid project used as a journal: every autosave
+    appends only the tiles changed since the previous one and the file is
+    compacted into a fresh snapshot when it accumulates too many stale chunks.
+    The main loop only takes a copy-on-write snapshot of the document, all
+    hashing, compression and writing happens on a worker thread.
+    """
+
+    # Seconds between autosaves
+    interval: int = 30
+
+    def __init__(self) -> None:
+        State.autosave = self
+        self.directory: str = os.path.join(GLib.get_user_data_dir(), "grid", "recovery")
+        self.path: str = os.path.join(self.directory, "recovery.grid")
+        self.info_path: str = os.path.join(self.directory, "recovery.json")
+        # Recovery file state, only used by the worker while it runs
+        self.grid_file: GridFile = None
+        self.__saved_state: tuple = None
+        self.__worker: threading.Thread = None
+        # Set to stop the running worker's save, see `discard()`
+        self.__cancelled: threading.Event = threading.Event()
+        GLib.timeout_add_seconds(self.interval, self.__on_timeout)
+
+    def has_recovery(self) -> bool:
+        return os.path.exists(self.path) and os.path.exists(self.info_path)
+
+    def recovery_info(self) -> dict:
+        with open(self.info_path) as file:
+            return json.load(file)
+
+    def recover(self) -> Document:
+        """Load the recovered document. Further autosaves append to the same journal"""
+        document: Document = GridFile.load(self.path)
+        self.grid_file, document.file = document.file, None
+        self.__saved_state = self.__state(document)
+        return document
+
+    def discard(self) -> None:
+        """
+        Remove recovery files, e.g. after a clean exit. A save in progress isn't
+        waited for, the worker removes what it wrote once it sees it's cancelled
+        """
+        self.__cancelled.set()
+        self.grid_file = None
+        self.__saved_state = None
+        self.__remove_files()
+
+    def __remove_files(self) -> None:
+        # The info file goes first, without it the journal isn't offered for recovery
+        for path in (self.info_path, self.path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def __state(self, document: Document) -> tuple:
+        """Value that changes whenever anything saved in the document changes"""
+        return (
+            id(document),
+            document.fps,
+            tuple((id(frame), frame.version) for frame in document.frames),
+        )
+
+    def __on_timeout(self) -> bool:
+        document: Document = State.drawing_area.document
+        if not document or (self.__worker and self.__worker.is_alive()):
+            return GLib.SOURCE_CONTINUE
+
+        state: tuple = self.__state(document)
+        if state == self.__saved_state:
+            return GLib.SOURCE_CONTINUE
+        if self.__saved_state and self.__saved_state[0] != id(document):
+            # Another document was opened, start a new journal
+            self.grid_file = None
+        previous_state: tuple = self.__saved_state
+        self.__saved_state = state
+
+        # Tiles are shared copy-on-write, so editing can go on during the save
+        snapshot: Document = document.snapshot()
+        snapshot.file = self.grid_file
+        info: dict = {
+            "time": time.time(),
+            "path": document.file.path if document.file else None,
+        }
+        self.__cancelled = threading.Event()
+        self.__worker = threading.Thread(
+            target=self.__write,
+            args=(snapshot, info, previous_state, self.__cancelled),
+            daemon=True,
+        )
+        self.__worker.start()
+        return GLib.SOURCE_CONTINUE
+
+    def __write(
+        self, snapshot: Document, info: dict, previous_state: tuple, cancelled: threading.Event
+    ) -> None:
+        """
+        Worker thread. The main loop doesn't touch the recovery state while it
+        runs, so it's updated here. Cancellation is checked after every write,
+        so files written after `discard()` removed them are removed again
+        """
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            GridFile.save(snapshot, self.path)
+            if cancelled.is_set():
+                self.__remove_files()
+                return
+            self.grid_file = snapshot.file
+            temp_path: str = self.info_path + ".tmp"
+            with open(temp_path, "w") as file:
+                json.dump(info, file)
+            os.replace(temp_path, self.info_path)
+            if cancelled.is_set():
+                self.__remove_files()
+        except Exception as e:
+            print(f"Autosave failed: {e}", file=sys.stderr)
+            if cancelled.is_set():
+                return
+            # Nothing was saved. The journal may be half written, so the next
+            # autosave writes a fresh file
+            self.__saved_state = previous_state
+            self.grid_file = None
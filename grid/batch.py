@@ -0,0 +1,166 @@
+"""
+Headless batch processing of PNG sprites: `grid batch INPUT OUTPUT [options]`.
+
+Only pure Python modules are imported here, GTK is never initialised.
+Every PNG in the input directory goes through the same operations in a fixed
+order (recolor, trim, remap, format, scale) on a pool of worker processes.
+"""
+
+from __future__ import annotations
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+
+import png as Png
+from indexed import IndexedPixelBuffer, Palette
+from palette_library import PaletteFileError, load_palette
+from pixel_buffer import PixelBuffer, color_to_pixel, content_bounds, hex_to_color
+from quantize import extract_palette
+
+
+def recolor(data: bytes, colors: dict[int, int]) -> bytes:
+    """Replace colors of RGBA bytes, looking up every distinct pixel value once"""
+    pixels: memoryview = memoryview(data).cast("I")
+    native: dict[int, int] = {color_to_pixel(old): color_to_pixel(new) for old, new in colors.items()}
+    lookup: dict[int, int] = {value: native.get(value, value) for value in set(pixels)}
+    return array("I", map(lookup.__getitem__, pixels)).tobytes()
+
+
+def process_file(
+    input_path: str, output_path: str, options: dict
+) -> tuple[str, float, tuple[int, int], str]:
+    """
+    Run the operations on one file. Runs in a worker process.
+    Returns file name, seconds taken, output size and error message or None
+    """
+    start: float = time.perf_counter()
+    name: str = os.path.basename(input_path)
+    try:
+        width, height, data = Png.read_png(input_path)
+
+        if options["recolor"]:
+            data = recolor(data, options["recolor"])
+
+        if options["trim"]:
+            bounds = content_bounds(width, height, data)
+            if bounds:
+                data = PixelBuffer.from_bytes(width, height, data).region_bytes(*bounds)
+                width, height = bounds[2], bounds[3]
+
+        buffer: PixelBuffer = PixelBuffer.from_bytes(width, height, data)
+        palette: list[int] = options["palette"]
+        if palette is None and options["format"] == "indexed":
+            # Exact colors if they fit in a palette, median cut otherwise
+            palette = extract_palette(data, Palette.max_colors - 1)
+        if palette is not None:
+            buffer = IndexedPixelBuffer(width, height, Palette.from_colors(palette))
+            buffer.write_bytes(0, 0, width, height, data)
+            if options["format"] == "rgba":
+                buffer = PixelBuffer.from_bytes(width, height, buffer.to_bytes())
+
+        Png.write_buffer(output_path, buffer, scale=options["scale"])
+        scale: int = options["scale"]
+        return name, time.perf_counter() - start, (width * scale, height * scale), None
+    except Exception as e:
+        return name, time.perf_counter() - start, None, str(e) or type(e).__name__
+
+
+def _process(task: tuple[str, str, dict]) -> tuple[str, float, tuple[int, int], str]:
+    return process_file(*task)
+
+
+def _parse_recolor(value: str) -> tuple[int, int]:
+    old, _, new = value.partition("=")
+    try:
+        return hex_to_color(old), hex_to_color(new)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected FROM=TO hex colors, got {value}")
+
+
+def main(args: list[str]) -> int:
+    parser = argparse.ArgumentParser(
+        prog="grid batch", description="Process a directory of PNG sprites"
+    )
+    parser.add_argument("input", help="directory of PNG images")
+    parser.add_argument("output", help="directory for results, created if missing")
+    parser.add_argument("--scale", type=int, default=1, help="integer upscale factor")
+    parser.add_argument(
+        "--remap", metavar="PALETTE", help="map colors to the nearest of a .gpl/.hex/.pal palette"
+    )
+    parser.add_argument(
+        "--recolor",
+        metavar="FROM=TO",
+        type=_parse_recolor,
+        action="append",
+        default=[],
+        help="replace a hex color, may be repeated",
+    )
+    parser.add_argument(
+        "--trim", action="store_true", help="crop transparent borders"
+    )
+    parser.add_argument(
+        "--format",
+        choices=["rgba", "indexed"],
+        default=None,
+        help="output PNG format, indexed if remapped, RGBA otherwise by default",
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=os.cpu_count(), help="worker processes"
+    )
+    options = parser.parse_args(args)
+    if options.scale < 1 or options.jobs < 1:
+        parser.error("--scale and --jobs must be at least 1")
+
+    palette: list[int] = None
+    if options.remap:
+        try:
+            palette = [hex_to_color(color) for color in load_palette(options.remap)[1]]
+        except (OSError, PaletteFileError) as e:
+            parser.error(str(e))
+
+    try:
+        names: list[str] = sorted(
+            name for name in os.listdir(options.input) if name.lower().endswith(".png")
+        )
+    except OSError as e:
+        parser.error(str(e))
+    os.makedirs(options.output, exist_ok=True)
+
+    settings: dict = {
+        "scale": options.scale,
+        "palette": palette,
+        "recolor": dict(options.recolor),
+        "trim": options.trim,
+        "format": options.format or ("indexed" if palette else "rgba"),
+    }
+    tasks: list[tuple[str, str, dict]] = [
+        (os.path.join(options.input, name), os.path.join(options.output, name), settings)
+        for name in names
+    ]
+
+    # Forked workers start without importing the GUI entry point again
+    context = multiprocessing.get_context(
+        "fork" if "fork" in multiprocessing.get_all_start_methods() else None
+    )
+    processes: int = min(options.jobs, len(tasks) or 1)
+    start: float = time.perf_counter()
+    failed: int = 0
+    busy: float = 0.0
+    with context.Pool(processes) as pool:
+        for name, seconds, size, error in pool.imap_unordered(_process, tasks):
+            busy += seconds
+            if error:
+                failed += 1
+                print(f"{name}: {error}", file=sys.stderr)
+            else:
+                print(f"{name}: {size[0]}x{size[1]} in {seconds * 1000:.1f} ms")
+
+    print(
+        f"{len(tasks) - failed} of {len(tasks)} files in {time.perf_counter() - start:.2f} s"
+        f" ({busy:.2f} s of work across {processes} process(es))"
+    )
+    return 1 if failed else 0
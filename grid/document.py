@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+
+import cairo
+from indexed import IndexedPixelBuffer, Palette
+from layers import Layer, LayerStack
+from pixel_buffer import PixelBuffer
+
+if TYPE_CHECKING:
+    from grid_file import GridFile
+
+
+class FrameCache:
+    """
+    Flattened canvas sized surfaces of whole frames, used for playback and onion skins.
+    Timeline thumbnails are rendered at their own size, see `LayerStack.thumbnail`.
+    A surface is rebuilt only when its frame's version changed since it was cached.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.max_bytes: int = max_bytes
+        self.size: int = 0
+        self.surfaces: OrderedDict[LayerStack, tuple[int, cairo.ImageSurface]] = OrderedDict()
+
+    def get(self, frame: LayerStack) -> cairo.ImageSurface:
+        cached = self.surfaces.get(frame)
+        if cached and cached[0] == frame.version:
+            self.surfaces.move_to_end(frame)
+            return cached[1]
+
+        surface: cairo.ImageSurface = frame.flatten_surface()
+        if cached:
+            self.size -= self.__surface_size(cached[1])
+        self.surfaces[frame] = (frame.version, surface)
+        self.surfaces.move_to_end(frame)
+        self.size += self.__surface_size(surface)
+        while self.size > self.max_bytes and len(self.surfaces) > 1:
+            self.size -= self.__surface_size(self.surfaces.popitem(last=False)[1][1])
+        return surface
+
+    def discard(self, frame: LayerStack) -> None:
+        cached = self.surfaces.pop(frame, None)
+        if cached:
+            self.size -= self.__surface_size(cached[1])
+
+    def __surface_size(self, surface: cairo.ImageSurface) -> int:
+        return surface.get_stride() * surface.get_height()
+
+
+class Document:
+    """Animation of equally sized frames, each a stack of layers"""
+
+    def __init__(
+        self,
+        width: int,
+        height: int,
+        frames: list[LayerStack] = None,
+        fps: int = 12,
+        palette: Palette = None,
+    ) -> None:
+        self.width: int = width
+        self.height: int = height
+        self.frames: list[LayerStack] = frames or [LayerStack(width, height)]
+        self.current: int = 0
+        self.fps: int = fps
+        self.frame_cache: FrameCache = FrameCache()
+        # Palette shared by all layers of an indexed document, None for RGBA documents
+        self.palette: Palette = palette
+        # Project file the document was last opened from or saved to
+        self.file: GridFile = None
+
+    @classmethod
+    def from_buffer(cls, buffer: PixelBuffer) -> Document:
+        palette: Palette = buffer.palette if isinstance(buffer, IndexedPixelBuffer) else None
+        return cls(buffer.width, buffer.height, [LayerStack.from_buffer(buffer)], palette=palette)
+
+    @property
+    def current_frame(self) -> LayerStack:
+        return self.frames[self.current]
+
+    def snapshot(self) -> Document:
+        """
+        Copy of the whole document sharing pixels copy-on-write.
+        It can be read from another thread while this one is edited
+        """
+        document = Document(
+            self.width, self.height, [frame.copy() for frame in self.frames], self.fps
+        )
+        document.current = self.current
+        if self.palette:
+            # Palette edits mustn't recolor the snapshot while it's being saved
+            document.palette = Palette(self.palette.colors)
+            for frame in document.frames:
+                for layer in frame.layers:
+                    layer.buffer.palette = document.palette
+        return document
+
+    def find_layer(self, buffer: PixelBuffer) -> tuple[LayerStack, Layer] | tuple[None, None]:
+        """Find frame and layer a buffer belongs to"""
+        for frame in self.frames:
+            layer: Layer = frame.layer_for(buffer)
+            if layer:
+                return frame, layer
+        return None, None
+
+    def frame_surface(self, index: int) -> cairo.ImageSurface:
+        return self.frame_cache.get(self.frames[index])
+
+    def memory_usage(self) -> int:
+        return sum(frame.memory_usage() for frame in self.frames)
+
+    def structure(self) -> tuple[list[LayerStack], int]:
+        """Frames and current index, restored on undo of a structure change"""
+        return list(self.frames), self.current
+
+    def restore(self, structure: tuple[list[LayerStack], int]) -> None:
+        frames, self.current = structure
+        self.frames[:] = frames
+        for frame in list(self.frame_cache.surfaces):
+            if frame not in frames:
+                self.frame_cache.discard(frame)
+
+    def add_frame(self, duplicate: bool = False) -> int:
+        """
+        Insert frame after the current one. It has the current frame's layers,
+        either empty or sharing their pixels copy-on-write. Returns its index
+        """
+        self.frames.insert(self.current + 1, self.current_frame.copy(empty=not duplicate))
+        return self.current + 1
+
+    def remove_frame(self, index: int) -> None:
+        if len(self.frames) == 1:
+            return
+        self.frame_cache.discard(self.frames.pop(index))
+        if index < self.current or self.current == len(self.frames):
+            self.current -= 1
+
+    def move_frame(self, index: int, new_index: int) -> None:
+        if not 0 <= new_index < len(self.frames):
+            return
+        current: LayerStack = self.current_frame
+        self.frames.insert(new_index, self.frames.pop(index))
+        self.current = self.frames.index(current)
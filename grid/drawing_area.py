@@ -1,9 +1,12 @@
 import cairo
-from gi.repository import Adw, Gtk, Gdk  # type:ignore
+from gi.repository import Adw, Gtk, Gdk, GLib  # type:ignore
 
 from state import State
-import utils as Utils
 from dataclasses import dataclass
+from pixel_buffer import TILE_SIZE, DirtyRegion, PixelBuffer
+from history import CompoundDelta, History, StructureDelta
+from layers import Layer, LayerStack
+from document import Document
 
 
 @dataclass
@@ -17,12 +20,27 @@ class DrawingArea(Adw.Bin):
     prev_pos: list[int, int] = None
     grid_size: int = 20
     canvas_size: Point = Point(16, 16)
-    pixel_data: list[tuple[int]] = []
-    cached_surface: cairo.Surface = None
+    document: Document = None
+    # Draw previous and next frames over the canvas
+    onion_skin: bool = False
+    onion_skin_opacity: float = 0.3
+    # Animation preview state. Frames are painted from the document's frame cache
+    playing: bool = False
+    playback_frame: int = 0
+    __playback_tick: int = 0
+    __playback_start: int = None
+    # Average time in ms from a pointer event to the frame that processed it
+    input_latency: float = 0.0
+    __tick_scheduled: bool = False
 
     def __init__(self) -> None:
         super().__init__()
         State.drawing_area = self
+        State.history = History()
+        # Queued pointer motion: (position, pressed button, event time in µs)
+        self.pending_motion: list[tuple[list[int], int, int]] = []
+        # Changed regions of the active frame's overlay, see `LayerStack.overlay`
+        self.overlay_dirty: DirtyRegion = DirtyRegion()
         self.__setup_styles()
         self.__build_ui()
 
@@ -45,12 +63,7 @@ class DrawingArea(Adw.Bin):
                 int(x // self.grid_size), int(y // self.grid_size)
             ),
         )
-        self.left_click_ctrl.connect(
-            "released",
-            lambda _g, _n, x, y: State.toolbar.current_tool.left_click_release(
-                int(x // self.grid_size), int(y // self.grid_size)
-            ),
-        )
+        self.left_click_ctrl.connect("released", self.__on_left_click_release)
         self.drawing_area.add_controller(self.left_click_ctrl)
 
         # Create and configure the right click gesture controller
@@ -61,12 +74,7 @@ class DrawingArea(Adw.Bin):
                 int(x // self.grid_size), int(y // self.grid_size)
             ),
         )
-        self.right_click_ctrl.connect(
-            "released",
-            lambda _g, _n, x, y: State.toolbar.current_tool.right_click_release(
-                int(x // self.grid_size), int(y // self.grid_size)
-            ),
-        )
+        self.right_click_ctrl.connect("released", self.__on_right_click_release)
         self.drawing_area.add_controller(self.right_click_ctrl)
 
         # Create and configure the motion controller
@@ -75,53 +83,100 @@ class DrawingArea(Adw.Bin):
         self.motion_ctrl.connect("leave", self.__on_pointer_leave)
         self.drawing_area.add_controller(self.motion_ctrl)
 
+        # Tiles are only painted for the visible part, so scrolling needs a redraw
+        self.drawing_area.connect("realize", self.__on_realize)
+
         self.set_child(self.drawing_area)
 
-    def load_image(self, pixel_data: list[list[str]]) -> None:
-        self.pixel_data = pixel_data
-        self.canvas_size.x = len(pixel_data[0])
-        self.canvas_size.y = len(pixel_data)
+    def __on_realize(self, _) -> None:
+        scrolled_window: Gtk.ScrolledWindow = self.get_ancestor(Gtk.ScrolledWindow)
+        if not scrolled_window:
+            return
+        for adjustment in (
+            scrolled_window.get_hadjustment(),
+            scrolled_window.get_vadjustment(),
+        ):
+            adjustment.connect("value-changed", lambda *_: self.drawing_area.queue_draw())
+
+    @property
+    def layers(self) -> LayerStack | None:
+        """Layers of the current frame"""
+        return self.document.current_frame if self.document else None
+
+    @property
+    def pixel_data(self) -> PixelBuffer | None:
+        """Buffer of the active layer. Tools draw into it"""
+        return self.layers.active_layer.buffer if self.layers else None
+
+    def load_image(self, pixel_data: PixelBuffer) -> None:
+        self.load_document(Document.from_buffer(pixel_data))
+
+    def load_document(self, document: Document) -> None:
+        if self.document:
+            # Through the play button, so it shows playback stopped too
+            State.timeline.play_btn.set_active(False)
+            State.toolbar.current_tool.deactivate()
+            self.layers.drop_cache()
+        self.document = document
+        State.history.clear()
+        self.canvas_size.x = document.width
+        self.canvas_size.y = document.height
         self.update_canvas_size()
 
-        # Create a cached surface for the pixel data
-        self.cached_surface = cairo.ImageSurface(
-            cairo.FORMAT_ARGB32,
-            self.canvas_size.x * self.grid_size,
-            self.canvas_size.y * self.grid_size,
-        )
-        self.redraw_cached_surface()
-
         self.drawing_area.set_draw_func(self.on_draw)
+        self.redraw_cached_surface()
+        if document.palette:
+            State.palette_bar.show_palette(document.palette)
+        State.main_window.update_document_info()
+        State.layers_panel.update()
+        State.timeline.update()
+
+    def set_frame(self, index: int) -> None:
+        """Switch the edited frame"""
+        if self.playing or index == self.document.current:
+            return
+        State.toolbar.current_tool.deactivate()
+        self.__flush_dirty_region()
+        # Only the edited frame keeps its tiles
+        self.layers.drop_cache()
+        self.document.current = index
         self.drawing_area.queue_draw()
+        State.layers_panel.update()
+        State.timeline.update_current()
 
     def update_canvas_size(self):
         """Set the size of the drawing area based on the grid size and canvas size"""
         self.drawing_area.set_content_width(self.canvas_size.x * self.grid_size)
         self.drawing_area.set_content_height(self.canvas_size.y * self.grid_size)
 
+    def palette_changed(self) -> None:
+        """
+        Recolor every frame after the indexed document's palette was edited.
+        Pixels keep their indices, only cached tiles are rebuilt from the new colors
+        """
+        for frame in self.document.frames:
+            frame.invalidate()
+            State.timeline.frame_changed(frame)
+        self.drawing_area.queue_draw()
+
     def redraw_cached_surface(self):
-        # Create a context for the cached surface
-        ctx = cairo.Context(self.cached_surface)
-
-        # Clear the surface by setting the source color to transparent and painting
-        ctx.set_source_rgba(0, 0, 0, 0)
-        ctx.set_operator(cairo.OPERATOR_SOURCE)
-        ctx.paint()
-
-        # Set the operator back to OVER for normal drawing
-        ctx.set_operator(cairo.OPERATOR_OVER)
-
-        # Iterate through the pixel data and draw each pixel at the correct position
-        for y, row in enumerate(self.pixel_data):
-            for x, color in enumerate(row):
-                ctx.set_source_rgba(*color)
-                ctx.rectangle(
-                    x * self.grid_size,
-                    y * self.grid_size,
-                    self.grid_size,
-                    self.grid_size,
-                )
-                ctx.fill()
+        """Drop all cached tiles. They are rebuilt lazily when painted"""
+        if self.layers:
+            self.layers.drop_cache()
+            State.timeline.frame_changed(self.layers)
+        self.drawing_area.queue_draw()
+
+    def __visible_rect(self) -> tuple[int, int, int, int]:
+        """Get part of the canvas visible in the scrolled window, in canvas pixels"""
+        scrolled_window: Gtk.ScrolledWindow = self.get_ancestor(Gtk.ScrolledWindow)
+        if not scrolled_window:
+            return 0, 0, self.canvas_size.x, self.canvas_size.y
+        _, x, y = scrolled_window.translate_coordinates(self.drawing_area, 0, 0)
+        x0: int = int(x // self.grid_size)
+        y0: int = int(y // self.grid_size)
+        x1: int = int((x + scrolled_window.get_width()) // self.grid_size) + 1
+        y1: int = int((y + scrolled_window.get_height()) // self.grid_size) + 1
+        return self.pixel_data.clip_rect(x0, y0, x1 - x0, y1 - y0)
 
     def __setup_styles(self) -> None:
         self.styles: str = """
@@ -139,11 +194,13 @@ class DrawingArea(Adw.Bin):
             Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION,
         )
 
-    def __interpolate_positions(self, start_pos: list[int], end_pos: list[int]) -> None:
-        # Determine the tool action based on the current button pressed
-        if self.left_click_ctrl.get_current_button() == 1:
+    def __interpolate_positions(
+        self, start_pos: list[int], end_pos: list[int], button: int
+    ) -> None:
+        # Determine the tool action based on the button pressed when the motion happened
+        if button == 1:
             tool_action = State.toolbar.current_tool.left_click_hold
-        elif self.right_click_ctrl.get_current_button() == 3:
+        elif button == 3:
             tool_action = State.toolbar.current_tool.right_click_hold
         else:
             return
@@ -170,51 +227,196 @@ class DrawingArea(Adw.Bin):
                 y0 += sy
 
     def __on_pointer_motion(self, _, x: float, y: float) -> None:
+        # Motion is only queued here and processed once per frame in __on_tick
+        button: int = self.left_click_ctrl.get_current_button() or (
+            self.right_click_ctrl.get_current_button()
+        )
         new_pos: list[int] = [int(x // self.grid_size), int(y // self.grid_size)]
-        if self.cur_pos:
-            self.__interpolate_positions(
-                self.cur_pos, new_pos
-            )  # Interpolate positions if necessary
-        self.cur_pos = new_pos  # Update the current position
-
-        # Handle continuous left click hold
-        if self.left_click_ctrl.get_current_button() == 1:
-            State.toolbar.current_tool.left_click_hold(*new_pos)
-        # Handle continuous right click hold
-        elif self.right_click_ctrl.get_current_button() == 3:
-            State.toolbar.current_tool.right_click_hold(*new_pos)
-        else:
-            self.drawing_area.queue_draw()  # Request a redraw of the drawing area
+        if not self.pending_motion or self.pending_motion[-1][:2] != (new_pos, button):
+            self.pending_motion.append((new_pos, button, GLib.get_monotonic_time()))
+        self.__schedule_tick()
+
+    def __process_motion(self, frame_time: int = None) -> None:
+        """Apply queued pointer motion to the current tool in one pass"""
+        if not self.pending_motion:
+            return
+        if frame_time:
+            # Exponential moving average of time from the oldest event to its frame
+            latency: float = (frame_time - self.pending_motion[0][2]) / 1000
+            self.input_latency += (latency - self.input_latency) * 0.1
+        for new_pos, button, _time in self.pending_motion:
+            if self.cur_pos and button:
+                self.__interpolate_positions(self.cur_pos, new_pos, button)
+            self.cur_pos = new_pos
+        self.pending_motion.clear()
+
+    def __on_left_click_release(self, _g, _n, x: float, y: float) -> None:
+        # Finish the stroke with all queued motion before the tool commits it
+        self.__process_motion()
+        State.toolbar.current_tool.left_click_release(
+            int(x // self.grid_size), int(y // self.grid_size)
+        )
+
+    def __on_right_click_release(self, _g, _n, x: float, y: float) -> None:
+        self.__process_motion()
+        State.toolbar.current_tool.right_click_release(
+            int(x // self.grid_size), int(y // self.grid_size)
+        )
 
     def __on_pointer_leave(self, _) -> None:
         self.cur_pos = None  # Reset the current position when the pointer leaves
         self.drawing_area.queue_draw()  # Request a redraw of the drawing area
 
-    # def update_pixel(self, x: int, y: int):
-    #     # Update the pixel data on the cached surface
-    #     ctx = cairo.Context(self.cached_surface)
-    #     color = self.pixel_data[y][x]
-
-    #     if color[3] == 0:
-    #         ctx.set_operator(cairo.Operator.CLEAR)
-    #         ctx.rectangle(
-    #             x * self.grid_size,
-    #             y * self.grid_size,
-    #             self.grid_size,
-    #             self.grid_size,
-    #         )
-    #         ctx.fill()
-
-    #     ctx.set_operator(cairo.Operator.OVER)
-    #     ctx.set_source_rgba(*color)
-    #     ctx.rectangle(
-    #         x * self.grid_size,
-    #         y * self.grid_size,
-    #         self.grid_size,
-    #         self.grid_size,
-    #     )
-    #     ctx.fill()
-    #     self.drawing_area.queue_draw()
+    def mark_dirty(
+        self, x: int, y: int, w: int = 1, h: int = 1, buffer: PixelBuffer = None
+    ) -> None:
+        """
+        Mark region of a layer's buffer (the active one by default) as changed.
+        Regions are merged and composited to the cached tiles once per frame
+        """
+        if buffer:
+            frame, layer = self.document.find_layer(buffer)
+        else:
+            frame, layer = self.layers, self.layers.active_layer
+        if not layer:
+            return
+        if frame is not self.layers:
+            # Frames not being edited have no tiles to update
+            frame.invalidate()
+            State.timeline.frame_changed(frame)
+            return
+        x, y, w, h = layer.buffer.clip_rect(x, y, w, h)
+        if not w or not h:
+            return
+        layer.dirty.add(x, y, w, h)
+        self.__schedule_tick()
+
+    def mark_overlay_dirty(self, x: int, y: int, w: int = 1, h: int = 1) -> None:
+        """Mark region of the overlay as changed. Composited once per frame like `mark_dirty`"""
+        self.overlay_dirty.add(x, y, w, h)
+        self.__schedule_tick()
+
+    def update_pixel(self, x: int, y: int) -> None:
+        self.mark_dirty(x, y)
+
+    def undo(self) -> None:
+        # Finish pending tool operation (e.g. floating selection) so it can be undone
+        State.toolbar.current_tool.deactivate()
+        self.__apply_history(State.history.undo)
+
+    def redo(self) -> None:
+        State.toolbar.current_tool.deactivate()
+        self.__apply_history(State.history.redo)
+
+    def __apply_history(self, apply) -> None:
+        """Undo or redo and update the canvas and the panels showing what it changed"""
+        if self.playing:
+            # Playback switches the current frame, frames can't change under it
+            return
+        self.__flush_dirty_region()
+        frame: LayerStack = self.layers
+        delta = apply()
+        if not delta:
+            return
+        parts: list = delta.deltas if isinstance(delta, CompoundDelta) else [delta]
+        if any(isinstance(part, StructureDelta) for part in parts):
+            # Layers or frames changed. Only the edited frame keeps its tiles
+            if frame is not self.layers:
+                frame.drop_cache()
+            State.layers_panel.update()
+            State.timeline.update()
+            State.main_window.update_document_info()
+            self.redraw_cached_surface()
+        # Deltas may belong to any layer
+        for part in parts:
+            for rect in part.dirty_rects():
+                self.mark_dirty(*rect, buffer=part.buffer)
+
+    def __schedule_tick(self) -> None:
+        if not self.__tick_scheduled:
+            self.__tick_scheduled = True
+            self.drawing_area.add_tick_callback(self.__on_tick)
+
+    def __on_tick(self, _widget: Gtk.Widget, frame_clock: Gdk.FrameClock) -> bool:
+        """Once per frame: apply queued input, update dirty tiles and redraw"""
+        self.__tick_scheduled = False
+        self.__process_motion(frame_clock.get_frame_time())
+        self.__flush_dirty_region()
+        self.drawing_area.queue_draw()
+        return GLib.SOURCE_REMOVE
+
+    def __flush_dirty_region(self) -> None:
+        if not self.layers:
+            return
+        if self.overlay_dirty:
+            self.layers.update_overlay(self.overlay_dirty.take())
+        flushed: bool = False
+        for layer in self.layers.layers:
+            if layer.dirty:
+                # Only cached tiles are updated. Others will be composited when painted
+                self.layers.update(layer, layer.dirty.take())
+                flushed = True
+        if flushed:
+            State.main_window.update_document_info()
+            State.timeline.frame_changed(self.layers)
+
+    def play(self) -> None:
+        """Preview the animation, advancing frames on the frame clock"""
+        if self.playing or not self.document:
+            return
+        State.toolbar.current_tool.deactivate()
+        self.__flush_dirty_region()
+        # Rasterise every frame up front, playback only paints cached surfaces
+        for index in range(len(self.document.frames)):
+            self.document.frame_surface(index)
+        self.playing = True
+        self.playback_frame = self.document.current
+        self.__playback_start = None
+        self.drawing_area.set_can_target(False)
+        self.__playback_tick = self.drawing_area.add_tick_callback(self.__on_playback_tick)
+
+    def stop(self) -> None:
+        if not self.playing:
+            return
+        self.playing = False
+        self.drawing_area.remove_tick_callback(self.__playback_tick)
+        self.drawing_area.set_can_target(True)
+        self.drawing_area.queue_draw()
+
+    def __on_playback_tick(self, _widget: Gtk.Widget, frame_clock: Gdk.FrameClock) -> bool:
+        frame_time: int = frame_clock.get_frame_time()
+        if self.__playback_start is None:
+            self.__playback_start = frame_time - self.playback_frame * 1_000_000 // self.document.fps
+        frame: int = (
+            (frame_time - self.__playback_start) * self.document.fps // 1_000_000
+        ) % len(self.document.frames)
+        if frame != self.playback_frame:
+            self.playback_frame = frame
+            self.drawing_area.queue_draw()
+        return GLib.SOURCE_CONTINUE
+
+    def __paint_frame(
+        self,
+        cr: cairo.Context,
+        index: int,
+        rect: tuple[int, int, int, int],
+        tint: tuple[float, float, float, float] = None,
+    ) -> None:
+        """Paint cached surface of a whole frame, or only its shape in tint color"""
+        surface: cairo.ImageSurface = self.document.frame_surface(index)
+        cr.save()
+        cr.scale(self.grid_size, self.grid_size)
+        cr.rectangle(*rect)
+        cr.clip()
+        pattern = cairo.SurfacePattern(surface)
+        pattern.set_filter(cairo.FILTER_NEAREST)
+        if tint:
+            cr.set_source_rgba(*tint)
+            cr.mask(pattern)
+        else:
+            cr.set_source(pattern)
+            cr.paint()
+        cr.restore()
 
     def on_draw(
         self,
@@ -223,10 +425,43 @@ class DrawingArea(Adw.Bin):
         _width: int,
         _height: int,
     ) -> None:
-        # Draw the cached surface with pixel data
-        if self.cached_surface:
-            cr.set_source_surface(self.cached_surface, 0, 0)
-            cr.paint()
+        # Draw the cached tiles intersecting the viewport, scaled to the grid size
+        x, y, w, h = self.__visible_rect() if self.pixel_data else (0, 0, 0, 0)
+        if w and h and self.playing:
+            self.__paint_frame(cr, self.playback_frame, (x, y, w, h))
+            return
+        if w and h:
+            tiles_x: range = range(x // TILE_SIZE, (x + w - 1) // TILE_SIZE + 1)
+            tiles_y: range = range(y // TILE_SIZE, (y + h - 1) // TILE_SIZE + 1)
+            cr.save()
+            cr.scale(self.grid_size, self.grid_size)
+            for ty in tiles_y:
+                for tx in tiles_x:
+                    tile: cairo.ImageSurface = self.layers.get_tile(tx, ty)
+                    cr.set_source_surface(tile, tx * TILE_SIZE, ty * TILE_SIZE)
+                    cr.get_source().set_filter(cairo.FILTER_NEAREST)
+                    cr.rectangle(
+                        tx * TILE_SIZE,
+                        ty * TILE_SIZE,
+                        tile.get_width(),
+                        tile.get_height(),
+                    )
+                    cr.fill()
+            cr.restore()
+
+            # Evict tiles that were not painted recently. Visible ones are always kept
+            self.layers.evict(len(tiles_x) * len(tiles_y))
+
+            if self.onion_skin:
+                current: int = self.document.current
+                if current > 0:
+                    self.__paint_frame(
+                        cr, current - 1, (x, y, w, h), (1, 0, 0, self.onion_skin_opacity)
+                    )
+                if current < len(self.document.frames) - 1:
+                    self.__paint_frame(
+                        cr, current + 1, (x, y, w, h), (0, 0.6, 0, self.onion_skin_opacity)
+                    )
 
         # Draw tool overlay
         State.toolbar.current_tool.draw_overlay(cr)
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+from pixel_buffer import TILE_SIZE, PixelBuffer, unpack_color
+
+
+def _channel_table(value: int, tolerance: int) -> bytes:
+    """Translate table: channel values within tolerance of `value` -> 0, others -> 1"""
+    return bytes(0 if abs(v - value) <= tolerance else 1 for v in range(256))
+
+
+def _or_planes(*planes: bytes) -> bytes:
+    """Bitwise OR of equal length byte strings, done as big integer operations"""
+    result: int = 0
+    for plane in planes:
+        result |= int.from_bytes(plane, "little")
+    return result.to_bytes(len(planes[0]), "little")
+
+
+def flood_fill_spans(
+    buffer: PixelBuffer,
+    x: int,
+    y: int,
+    tolerance: int = 0,
+    connectivity: int = 4,
+) -> list[tuple[int, int, int]]:
+    """
+    Scanline flood fill starting at (x, y).
+
+    Returns horizontal spans (y, x0, x1) with exclusive x1 of the connected area
+    whose pixels are within `tolerance` of the start pixel in every channel.
+    Rows are compared as whole byte planes. Per-pixel Python work is only done
+    per span, not per pixel.
+    """
+    if not buffer.in_bounds(x, y):
+        return []
+
+    width: int = buffer.width
+    tables: list[bytes] = [
+        _channel_table(c, tolerance) for c in unpack_color(buffer.get(x, y))
+    ]
+    # Row masks: 0 = fillable and not yet visited, 1 = blocked or visited
+    masks: dict[int, bytearray] = {}
+    # Unallocated tiles all share the background, so its mask is computed once
+    background_mask: list[bytes] = []
+
+    def tile_mask(key: tuple[int, int]) -> bytes:
+        tile: bytes = buffer.tile(key)
+        if tile is buffer.background:
+            if not background_mask:
+                background_mask.append(tile_mask_of(buffer.background))
+            return background_mask[0]
+        return tile_mask_of(tile)
+
+    if buffer.bpp == 1:
+        # Indexed buffer. Every palette color is compared once, pixels by index
+        index_table: bytes = bytes(
+            any(tables[c][v] for c, v in enumerate(unpack_color(color)))
+            for color in buffer.palette.colors
+        ).ljust(256, b"\x01")
+
+    def tile_mask_of(data: bytes) -> bytes:
+        if buffer.bpp == 1:
+            return data.translate(index_table)
+        return _or_planes(*(data[c::4].translate(tables[c]) for c in range(4)))
+
+    def row_mask(row: int) -> bytearray:
+        mask: bytearray = masks.get(row)
+        if mask is None:
+            # Compute masks for the whole row of tiles at once
+            ty: int = row // TILE_SIZE
+            y0: int = ty * TILE_SIZE
+            tiles: list[bytes] = [
+                tile_mask((tx, ty)) for tx in range((width - 1) // TILE_SIZE + 1)
+            ]
+            for i in range(min(TILE_SIZE, buffer.height - y0)):
+                start: int = i * TILE_SIZE
+                masks[y0 + i] = bytearray(
+                    b"".join(tile[start : start + TILE_SIZE] for tile in tiles)[:width]
+                )
+            mask = masks[row]
+        return mask
+
+    # Extend neighbour row search by one pixel for diagonal connections
+    reach: int = 1 if connectivity == 8 else 0
+    spans: list[tuple[int, int, int]] = []
+    stack: list[tuple[int, int]] = [(x, y)]
+    while stack:
+        sx, sy = stack.pop()
+        mask = row_mask(sy)
+        if mask[sx]:
+            continue
+
+        # Grow span left and right to the nearest blocked pixels
+        x0: int = mask.rfind(1, 0, sx) + 1
+        x1: int = mask.find(1, sx)
+        if x1 == -1:
+            x1 = width
+        mask[x0:x1] = b"\x01" * (x1 - x0)
+        spans.append((sy, x0, x1))
+
+        # Seed one position per fillable run in rows above and below
+        lo, hi = max(x0 - reach, 0), min(x1 + reach, width)
+        for ny in (sy - 1, sy + 1):
+            if not 0 <= ny < buffer.height:
+                continue
+            neighbour: bytearray = row_mask(ny)
+            i: int = neighbour.find(0, lo, hi)
+            while i != -1:
+                stack.append((i, ny))
+                j: int = neighbour.find(1, i, hi)
+                if j == -1:
+                    break
+                i = neighbour.find(0, j, hi)
+
+    return spans
+
+
+def spans_to_rects(spans: list[tuple[int, int, int]]) -> list[tuple[int, int, int, int]]:
+    """Merge spans with the same extent on consecutive rows into rectangles (x, y, w, h)"""
+    rects: list[tuple[int, int, int, int]] = []
+    for y, x0, x1 in sorted(spans, key=lambda span: (span[1], span[2], span[0])):
+        if rects:
+            rx, ry, rw, rh = rects[-1]
+            if rx == x0 and rw == x1 - x0 and ry + rh == y:
+                rects[-1] = (rx, ry, rw, rh + 1)
+                continue
+        rects.append((x0, y, x1 - x0, 1))
+    return rects
+
+
+def spans_bounds(spans: list[tuple[int, int, int]]) -> tuple[int, int, int, int]:
+    """Bounding box (x, y, w, h) of spans"""
+    x0: int = min(span[1] for span in spans)
+    x1: int = max(span[2] for span in spans)
+    y0: int = min(span[0] for span in spans)
+    y1: int = max(span[0] for span in spans)
+    return x0, y0, x1 - x0, y1 - y0 + 1
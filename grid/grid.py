@@ -1,6 +1,14 @@
 from __future__ import annotations
 
-import gi  # type:ignore
+import sys
+
+if __name__ == "__main__" and sys.argv[1:2] in (["batch"], ["atlas"]):
+    # Headless commands, GTK is never imported
+    from importlib import import_module
+
+    sys.exit(import_module(sys.argv[1]).main(sys.argv[2:]))
+
+import gi  # type:ignore  # noqa: E402
 
 gi.require_version("Gtk", "4.0")
 gi.require_version("Adw", "1")
@@ -25,4 +33,5 @@ class Application(Adw.Application):
         win.present()
 
 
-Application().run()
+if __name__ == "__main__":
+    Application().run()
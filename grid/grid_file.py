@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+from typing import Callable
+
+from document import Document
+from layers import Layer, LayerStack
+from indexed import IndexedPixelBuffer, Palette
+from pixel_buffer import PixelBuffer
+
+# .grid project file layout:
+#
+#   header   magic, format version, offset and length of the index
+#   chunks   zlib compressed RGBA or palette index tiles, each stored once by
+#            content digest
+#   index    zlib compressed JSON: document structure, tile -> chunk digest,
+#            digest -> chunk offset and length
+#
+# Saving appends chunks of new tiles and a new index, then points the header
+# to it. Chunks no longer referenced stay in the file until it is compacted.
+
+MAGIC: bytes = b"GRID"
+FORMAT_VERSION: int = 1
+_HEADER: struct.Struct = struct.Struct("<4sHHQQ")
+
+
+class GridFileError(Exception):
+    pass
+
+
+def _digest(tile: bytes) -> str:
+    return hashlib.blake2b(tile, digest_size=16).hexdigest()
+
+
+class Chunk:
+    """Lazy tile loader reading a compressed chunk from the mapped file"""
+
+    __slots__ = ("data", "offset", "length", "digest")
+
+    def __init__(self, data: mmap.mmap, offset: int, length: int, digest: str) -> None:
+        # Map of the file the chunk was read from. Stays valid after the
+        # file is replaced by compaction, because the old file stays mapped
+        self.data: mmap.mmap = data
+        self.offset: int = offset
+        self.length: int = length
+        self.digest: str = digest
+
+    def __call__(self) -> bytes:
+        return zlib.decompress(self.data[self.offset : self.offset + self.length])
+
+
+class GridFile:
+    """
+    Saved state of a document's .grid file.
+    Knows which chunks the file holds so saves only write new tiles.
+    """
+
+    # Rewrite the whole file when unreferenced bytes exceed this part of it
+    max_garbage: float = 0.5
+    compression_level: int = 6
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        # Chunks in the file: digest -> (offset, length)
+        self.chunks: dict[str, tuple[int, int]] = {}
+        self.size: int = 0
+        # Bytes of chunks referenced by the last saved index
+        self.used_bytes: int = 0
+
+    # ---------- Loading ---------- #
+
+    @classmethod
+    def load(cls, path: str) -> Document:
+        """
+        Open document. Only the index is decoded, tiles are decoded from the
+        mapped file when first used
+        """
+        with open(path, "rb") as file:
+            if os.fstat(file.fileno()).st_size < _HEADER.size:
+                raise GridFileError(f"{path} is not a Grid project")
+            data: mmap.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, index_offset, index_length = _HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise GridFileError(f"{path} is not a Grid project")
+        if version > FORMAT_VERSION:
+            raise GridFileError(f"{path} was saved by a newer version of Grid")
+
+        index: dict = json.loads(
+            zlib.decompress(data[index_offset : index_offset + index_length])
+        )
+        grid_file = cls(path)
+        grid_file.chunks = {
+            digest: (offset, length) for digest, (offset, length) in index["chunks"].items()
+        }
+        grid_file.size = len(data)
+
+        width, height = index["width"], index["height"]
+        # Indexed documents store their palette, all their layers are indexed
+        palette: Palette = Palette(index["palette"]) if index.get("palette") else None
+        frames: list[LayerStack] = []
+        for frame_info in index["frames"]:
+            layers: list[Layer] = []
+            for info in frame_info["layers"]:
+                buffer = (
+                    IndexedPixelBuffer(width, height, palette, info["fill"])
+                    if palette
+                    else PixelBuffer(width, height, info["fill"])
+                )
+                for tx, ty, digest in info["tiles"]:
+                    offset, length = grid_file.chunks[digest]
+                    buffer.lazy[(tx, ty)] = Chunk(data, offset, length, digest)
+                layers.append(
+                    Layer(
+                        buffer,
+                        info["name"],
+                        info["visible"],
+                        info["opacity"],
+                        info["blend_mode"],
+                    )
+                )
+            frame = LayerStack(width, height, layers)
+            frame.active = frame_info["active"]
+            frames.append(frame)
+
+        document = Document(width, height, frames, index["fps"], palette)
+        document.current = index["current"]
+        document.file = grid_file
+        return document
+
+    # ---------- Saving ---------- #
+
+    @classmethod
+    def save(
+        cls, document: Document, path: str, progress: Callable[[float], None] = None
+    ) -> None:
+        """
+        Save document. Saving over its own file only appends changed tiles.
+        `progress` is called with the saved fraction and may raise to cancel
+        """
+        grid_file: GridFile = document.file
+        if grid_file and grid_file.path == path and os.path.exists(path):
+            grid_file.__append(document, progress)
+            if grid_file.used_bytes >= grid_file.size * (1 - grid_file.max_garbage):
+                return
+        grid_file = cls(path)
+        grid_file.__rewrite(document, progress)
+        document.file = grid_file
+
+    def __tile_digests(
+        self, buffer: PixelBuffer
+    ) -> list[tuple[tuple[int, int], str, bytes | None]]:
+        """Tiles of buffer as (key, digest, data). Data is None for tiles never decoded"""
+        tiles: list[tuple[tuple[int, int], str, bytes | None]] = []
+        for key, loader in buffer.lazy.items():
+            if isinstance(loader, Chunk):
+                tiles.append((key, loader.digest, None))
+            else:
+                tile: bytes = loader()
+                tiles.append((key, _digest(tile), tile))
+        for key, tile in buffer.tiles.items():
+            tiles.append((key, _digest(tile), tile))
+        return tiles
+
+    def __write_chunks(
+        self, file, document: Document, progress: Callable[[float], None] = None
+    ) -> tuple[dict, int]:
+        """
+        Write chunks missing from the file. Return the new index and the bytes
+        of chunks it references
+        """
+        file.seek(0, os.SEEK_END)
+        # Copied, so a failed save leaves no entries for chunks never written
+        chunks: dict[str, tuple[int, int]] = dict(self.chunks)
+        used: set[str] = set()
+        frames: list[dict] = []
+        total: int = sum(len(frame.layers) for frame in document.frames)
+        done: int = 0
+        for frame in document.frames:
+            layers: list[dict] = []
+            for layer in frame.layers:
+                if progress:
+                    progress(done / total)
+                done += 1
+                tiles: list[tuple[int, int, str]] = []
+                for (tx, ty), digest, tile in self.__tile_digests(layer.buffer):
+                    if digest not in chunks:
+                        if tile is None:
+                            # Lazy tile whose chunk is only in another file
+                            tile = layer.buffer.lazy[(tx, ty)]()
+                        chunk: bytes = zlib.compress(tile, self.compression_level)
+                        chunks[digest] = (file.tell(), len(chunk))
+                        file.write(chunk)
+                    tiles.append((tx, ty, digest))
+                    used.add(digest)
+                layers.append(
+                    {
+                        "name": layer.name,
+                        "visible": layer.visible,
+                        "opacity": layer.opacity,
+                        "blend_mode": layer.blend_mode,
+                        "fill": layer.buffer.fill,
+                        "tiles": tiles,
+                    }
+                )
+            frames.append({"active": frame.active, "layers": layers})
+        used_bytes: int = sum(chunks[digest][1] for digest in used)
+
+        index: dict = {
+            "width": document.width,
+            "height": document.height,
+            "fps": document.fps,
+            "current": document.current,
+            "frames": frames,
+            "palette": document.palette.colors if document.palette else None,
+            "chunks": chunks,
+        }
+        return index, used_bytes
+
+    def __write(
+        self, file, document: Document, progress: Callable[[float], None]
+    ) -> None:
+        """Write chunks and index, then take the index's chunks as the file's"""
+        index, used_bytes = self.__write_chunks(file, document, progress)
+        self.__write_index(file, index)
+        self.chunks = index["chunks"]
+        self.used_bytes = used_bytes
+
+    def __write_index(self, file, index: dict) -> None:
+        """Append index, then point the header to it once everything is on disk"""
+        file.seek(0, os.SEEK_END)
+        index_offset: int = file.tell()
+        data: bytes = zlib.compress(json.dumps(index, separators=(",", ":")).encode())
+        file.write(data)
+        file.flush()
+        os.fsync(file.fileno())
+        file.seek(0)
+        file.write(_HEADER.pack(MAGIC, FORMAT_VERSION, 0, index_offset, len(data)))
+        file.flush()
+        os.fsync(file.fileno())
+        self.size = index_offset + len(data)
+
+    def __append(self, document: Document, progress: Callable[[float], None]) -> None:
+        with open(self.path, "r+b") as file:
+            self.__write(file, document, progress)
+
+    def __rewrite(self, document: Document, progress: Callable[[float], None]) -> None:
+        """Write complete file next to the target and replace it"""
+        temp_path: str = self.path + ".tmp"
+        try:
+            with open(temp_path, "wb") as file:
+                file.write(bytes(_HEADER.size))
+                self.__write(file, document, progress)
+            os.replace(temp_path, self.path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
@@ -0,0 +1,321 @@
+from __future__ import annotations
+
+import zlib
+from array import array
+from collections import deque
+from typing import Protocol
+
+from fill import spans_to_rects
+from pixel_buffer import PixelBuffer
+
+
+class PixelDelta:
+    """Changed pixels of a buffer as parallel arrays of coordinates and old/new raw values"""
+
+    # Above this many pixels, dirty region is reported as the bounding box
+    max_dirty_pixels: int = 256
+
+    def __init__(
+        self, buffer: PixelBuffer, changes: dict[tuple[int, int], int]
+    ) -> None:
+        self.buffer: PixelBuffer = buffer
+        self.xs: array = array("i", (x for x, _ in changes))
+        self.ys: array = array("i", (y for _, y in changes))
+        self.old: array = array("I", changes.values())
+        self.new: array = array("I", (buffer.get_raw(x, y) for x, y in changes))
+
+    def __apply(self, values: array) -> None:
+        for x, y, value in zip(self.xs, self.ys, values):
+            self.buffer.set_raw(x, y, value)
+
+    def undo(self) -> None:
+        self.__apply(self.old)
+
+    def redo(self) -> None:
+        self.__apply(self.new)
+
+    def size(self) -> int:
+        return len(self.xs) * 16
+
+    def dirty_rects(self) -> list[tuple[int, int, int, int]]:
+        if len(self.xs) > self.max_dirty_pixels:
+            x0, y0 = min(self.xs), min(self.ys)
+            return [(x0, y0, max(self.xs) - x0 + 1, max(self.ys) - y0 + 1)]
+        return [(x, y, 1, 1) for x, y in zip(self.xs, self.ys)]
+
+
+class RegionDelta:
+    """Rectangle of a buffer stored as compressed old and new raw bytes"""
+
+    def __init__(
+        self, buffer: PixelBuffer, x: int, y: int, w: int, h: int, old: bytes
+    ) -> None:
+        self.buffer: PixelBuffer = buffer
+        self.rect: tuple[int, int, int, int] = (x, y, w, h)
+        self.old: bytes = zlib.compress(old, 1)
+        self.new: bytes = zlib.compress(buffer.raw_region(x, y, w, h), 1)
+
+    def undo(self) -> None:
+        self.buffer.write_raw(*self.rect, zlib.decompress(self.old))
+
+    def redo(self) -> None:
+        self.buffer.write_raw(*self.rect, zlib.decompress(self.new))
+
+    def size(self) -> int:
+        return len(self.old) + len(self.new)
+
+    def dirty_rects(self) -> list[tuple[int, int, int, int]]:
+        return [self.rect]
+
+
+class SpanDelta:
+    """
+    Rectangles of a buffer filled with one raw value, e.g. a flood fill or a shape.
+    Old pixels are kept as one value when they were all equal (a fill with no
+    tolerance), as compressed raw bytes otherwise. Redo fills the rectangles again
+    """
+
+    # Above this many rectangles, dirty region is reported as the bounding box
+    max_dirty_rects: int = 256
+
+    def __init__(
+        self, buffer: PixelBuffer, rects: list[tuple[int, int, int, int]], old: int | bytes
+    ) -> None:
+        self.buffer: PixelBuffer = buffer
+        self.rects: list[tuple[int, int, int, int]] = rects
+        self.new: int = buffer.get_raw(rects[0][0], rects[0][1])
+        if isinstance(old, bytes):
+            bpp: int = buffer.bpp
+            first: bytes = old[:bpp]
+            if old == first * (len(old) // bpp):
+                old = int.from_bytes(first, "big")
+            else:
+                old = zlib.compress(old, 1)
+        self.old: int | bytes = old
+
+    def undo(self) -> None:
+        if isinstance(self.old, int):
+            for rect in self.rects:
+                self.buffer.fill_raw(*rect, self.old)
+            return
+        old: memoryview = memoryview(zlib.decompress(self.old))
+        bpp: int = self.buffer.bpp
+        offset: int = 0
+        for x, y, w, h in self.rects:
+            end: int = offset + w * h * bpp
+            self.buffer.write_raw(x, y, w, h, old[offset:end])
+            offset = end
+
+    def redo(self) -> None:
+        for rect in self.rects:
+            self.buffer.fill_raw(*rect, self.new)
+
+    def size(self) -> int:
+        return len(self.rects) * 32 + (0 if isinstance(self.old, int) else len(self.old))
+
+    def dirty_rects(self) -> list[tuple[int, int, int, int]]:
+        if len(self.rects) > self.max_dirty_rects:
+            x0: int = min(x for x, _, _, _ in self.rects)
+            y0: int = min(y for _, y, _, _ in self.rects)
+            x1: int = max(x + w for x, _, w, _ in self.rects)
+            y1: int = max(y + h for _, y, _, h in self.rects)
+            return [(x0, y0, x1 - x0, y1 - y0)]
+        return self.rects
+
+
+class Structured(Protocol):
+    """List of layers or frames with a selected item, e.g. `LayerStack` and `Document`"""
+
+    def structure(self) -> tuple[list, int]: ...
+
+    def restore(self, structure: tuple[list, int]) -> None: ...
+
+
+class StructureDelta:
+    """Change of a frame's layers or a document's frames, e.g. a layer added or removed"""
+
+    # Changes no pixels of a particular buffer
+    buffer: PixelBuffer = None
+
+    def __init__(self, target: Structured, old: tuple[list, int]) -> None:
+        self.target: Structured = target
+        self.old: tuple[list, int] = old
+        self.new: tuple[list, int] = target.structure()
+
+    def undo(self) -> None:
+        self.target.restore(self.old)
+
+    def redo(self) -> None:
+        self.target.restore(self.new)
+
+    def size(self) -> int:
+        # Removed layers and frames are kept alive by the delta. Only the lists
+        # are counted, their pixels were counted when they were drawn
+        return (len(self.old[0]) + len(self.new[0])) * 8
+
+    def dirty_rects(self) -> list[tuple[int, int, int, int]]:
+        return []
+
+
+class CompoundDelta:
+    """Several deltas undone and redone as one operation"""
+
+    def __init__(
+        self, deltas: list[PixelDelta | RegionDelta | SpanDelta | StructureDelta]
+    ) -> None:
+        self.deltas: list[PixelDelta | RegionDelta | SpanDelta | StructureDelta] = deltas
+
+    def undo(self) -> None:
+        for delta in reversed(self.deltas):
+            delta.undo()
+
+    def redo(self) -> None:
+        for delta in self.deltas:
+            delta.redo()
+
+    def size(self) -> int:
+        return sum(delta.size() for delta in self.deltas)
+
+    def dirty_rects(self) -> list[tuple[int, int, int, int]]:
+        return [rect for delta in self.deltas for rect in delta.dirty_rects()]
+
+
+Delta = PixelDelta | RegionDelta | SpanDelta | StructureDelta | CompoundDelta
+
+
+class History:
+    """
+    Undo/redo history of pixel and structure changes.
+
+    Changes are recorded while an operation is in progress with `record()`,
+    `record_region()`, `record_spans()` or `record_structure()` and turned
+    into one compact delta by `commit()`.
+    Oldest deltas are dropped when the history exceeds `max_bytes`.
+    """
+
+    # Operations changing more pixels than this are stored as regions or spans
+    max_pixel_delta: int = 4096
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024) -> None:
+        self.max_bytes: int = max_bytes
+        self.undo_stack: deque[Delta] = deque()
+        self.redo_stack: list[Delta] = []
+        self.size: int = 0
+        self.__buffer: PixelBuffer = None
+        self.__pixels: dict[tuple[int, int], int] = {}
+        self.__regions: list[tuple[PixelBuffer, int, int, int, int, bytes]] = []
+        self.__spans: list[tuple[PixelBuffer, list[tuple[int, int, int, int]], int | bytes]] = []
+        self.__structures: list[tuple[Structured, tuple[list, int]]] = []
+
+    def clear(self) -> None:
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.size = 0
+        self.__buffer = None
+        self.__pixels = {}
+        self.__regions = []
+        self.__spans = []
+        self.__structures = []
+
+    def record(self, buffer: PixelBuffer, x: int, y: int) -> None:
+        """Remember pixel's value before it is changed by the current operation"""
+        self.__buffer = buffer
+        if (x, y) not in self.__pixels:
+            self.__pixels[(x, y)] = buffer.get_raw(x, y)
+
+    def record_region(self, buffer: PixelBuffer, x: int, y: int, w: int, h: int) -> None:
+        """
+        Remember region before it is changed by the current operation.
+        Must be followed by `commit()` after the region is written
+        """
+        x, y, w, h = buffer.clip_rect(x, y, w, h)
+        if w and h:
+            self.__regions.append((buffer, x, y, w, h, buffer.raw_region(x, y, w, h)))
+
+    def record_spans(
+        self, buffer: PixelBuffer, spans: list[tuple[int, int, int]], value: int = None
+    ) -> None:
+        """
+        Remember pixels covered by spans (y, x0, x1) before they are changed.
+        `value` is the raw value of every covered pixel when the caller knows it,
+        e.g. a fill with no tolerance. The spans must be filled with a single
+        color before `commit()`
+        """
+        if sum(x1 - x0 for _, x0, x1 in spans) > self.max_pixel_delta:
+            # Only the covered pixels are kept, not their bounding box
+            rects: list[tuple[int, int, int, int]] = spans_to_rects(spans)
+            if value is None:
+                value = b"".join(buffer.raw_region(*rect) for rect in rects)
+            self.__spans.append((buffer, rects, value))
+            return
+        for y, x0, x1 in spans:
+            for x in range(x0, x1):
+                self.record(buffer, x, y)
+
+    def record_structure(self, target: Structured) -> None:
+        """Remember layers or frames before they are added, removed or reordered"""
+        self.__structures.append((target, target.structure()))
+
+    def commit(self) -> None:
+        """Finish the current operation and push its delta"""
+        deltas: list[PixelDelta | RegionDelta | SpanDelta | StructureDelta] = [
+            RegionDelta(*region) for region in self.__regions
+        ]
+        deltas += [SpanDelta(*spans) for spans in self.__spans]
+        deltas += [
+            StructureDelta(target, old)
+            for target, old in self.__structures
+            # E.g. removing the only layer does nothing
+            if target.structure() != old
+        ]
+        if self.__pixels:
+            deltas.append(self.__pixels_delta())
+        self.__buffer = None
+        self.__pixels = {}
+        self.__regions = []
+        self.__spans = []
+        self.__structures = []
+        if not deltas:
+            return
+
+        delta = deltas[0] if len(deltas) == 1 else CompoundDelta(deltas)
+        self.size -= sum(redo.size() for redo in self.redo_stack)
+        self.redo_stack.clear()
+        self.undo_stack.append(delta)
+        self.size += delta.size()
+        while self.size > self.max_bytes and len(self.undo_stack) > 1:
+            self.size -= self.undo_stack.popleft().size()
+
+    def __pixels_delta(self) -> PixelDelta | RegionDelta:
+        if len(self.__pixels) <= self.max_pixel_delta:
+            return PixelDelta(self.__buffer, self.__pixels)
+
+        # Large operation. Rebuild old bounding box from the new one and the old pixels
+        x0: int = min(x for x, _ in self.__pixels)
+        y0: int = min(y for _, y in self.__pixels)
+        w: int = max(x for x, _ in self.__pixels) - x0 + 1
+        h: int = max(y for _, y in self.__pixels) - y0 + 1
+        bpp: int = self.__buffer.bpp
+        old: bytearray = bytearray(self.__buffer.raw_region(x0, y0, w, h))
+        for (x, y), value in self.__pixels.items():
+            offset: int = ((y - y0) * w + x - x0) * bpp
+            old[offset : offset + bpp] = value.to_bytes(bpp, "big")
+        return RegionDelta(self.__buffer, x0, y0, w, h, old)
+
+    def undo(self) -> Delta | None:
+        """Revert last operation. Returns its delta for dirty region updates"""
+        if not self.undo_stack:
+            return None
+        delta = self.undo_stack.pop()
+        delta.undo()
+        self.redo_stack.append(delta)
+        return delta
+
+    def redo(self) -> Delta | None:
+        """Re-apply last reverted operation. Returns its delta for dirty region updates"""
+        if not self.redo_stack:
+            return None
+        delta = self.redo_stack.pop()
+        delta.redo()
+        self.undo_stack.append(delta)
+        return delta
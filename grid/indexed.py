@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import sys
+
+from pixel_buffer import TILE_SIZE, TRANSPARENT, PixelBuffer, pixel_to_color, unpack_color
+
+
+class Palette:
+    """
+    Color table of indexed buffers, shared by every layer and frame of a document.
+
+    Index 0 is always transparent. Buffers store only indices and convert them
+    to colors through lookup tables built from the palette, so editing an entry
+    recolors every pixel using it without touching pixel data.
+    """
+
+    max_colors: int = 256
+
+    def __init__(self, colors: list[int] = None) -> None:
+        # Entries by index, the first one transparent
+        self.colors: list[int] = list(colors) if colors else [TRANSPARENT]
+        # Bumped on every edit
+        self.version: int = 0
+        # Index by color, including nearest matches of colors not in the palette
+        self.__indices: dict[int, int] = {}
+        self.__rgba_tables: tuple[bytes, ...] = None
+        self.__argb32_tables: tuple[bytes, ...] = None
+
+    @classmethod
+    def from_colors(cls, colors: list[int]) -> Palette:
+        """Palette of distinct visible colors after the transparent entry"""
+        palette = cls()
+        for color in colors:
+            if len(palette.colors) == cls.max_colors:
+                break
+            if color & 0xFF and color not in palette.colors:
+                palette.colors.append(color)
+        return palette
+
+    def __len__(self) -> int:
+        return len(self.colors)
+
+    def set(self, index: int, color: int) -> None:
+        self.colors[index] = color
+        self.__changed()
+
+    def replace(self, colors: list[int]) -> None:
+        """
+        Swap colors after the transparent entry by position.
+        Entries past the new colors are kept, as pixels may still use them.
+        """
+        colors = colors[: self.max_colors - 1]
+        self.colors[1 : 1 + len(colors)] = colors
+        self.__changed()
+
+    def __changed(self) -> None:
+        self.version += 1
+        self.__indices = {}
+        self.__rgba_tables = None
+        self.__argb32_tables = None
+
+    def index_of(self, color: int) -> int:
+        """Index of color, or of the nearest palette color if it isn't in the palette"""
+        index: int = self.__indices.get(color)
+        if index is None:
+            index = self.__indices[color] = self.__nearest(color)
+        return index
+
+    def __nearest(self, color: int) -> int:
+        if color in self.colors:
+            return self.colors.index(color)
+        if not color & 0xFF or len(self.colors) == 1:
+            return 0
+        channels: tuple[int, int, int, int] = unpack_color(color)
+        return min(
+            range(1, len(self.colors)),
+            key=lambda i: sum(
+                (a - b) ** 2 for a, b in zip(channels, unpack_color(self.colors[i]))
+            ),
+        )
+
+    def indices_of(self, data: bytes) -> bytes:
+        """Convert packed RGBA bytes to indices, looking up every distinct color once"""
+        pixels: memoryview = memoryview(data).cast("I")
+        lookup: dict[int, int] = {
+            value: self.index_of(pixel_to_color(value)) for value in set(pixels)
+        }
+        return bytes(map(lookup.__getitem__, pixels))
+
+    def has_translucent(self) -> bool:
+        """Whether any color is partially transparent"""
+        return any(0 < color & 0xFF < 255 for color in self.colors)
+
+    def visible_table(self) -> bytes:
+        """Translate table of indices: transparent colors -> 0x00, others -> 0xFF"""
+        return bytes(
+            0xFF if i < len(self.colors) and self.colors[i] & 0xFF else 0 for i in range(256)
+        )
+
+    def rgba_tables(self) -> tuple[bytes, ...]:
+        """Translate tables of indices to R, G, B and A channel values"""
+        if not self.__rgba_tables:
+            channels: list[tuple[int, ...]] = [unpack_color(c) for c in self.colors]
+            channels += [(0, 0, 0, 0)] * (256 - len(channels))
+            self.__rgba_tables = tuple(bytes(c[i] for c in channels) for i in range(4))
+        return self.__rgba_tables
+
+    def argb32_tables(self) -> tuple[bytes, ...]:
+        """
+        Translate tables of indices to bytes of cairo FORMAT_ARGB32 pixels in memory
+        order. Colors are premultiplied here once instead of per pixel
+        """
+        if not self.__argb32_tables:
+            r, g, b, a = self.rgba_tables()
+            r, g, b = (
+                bytes((c * alpha + 127) // 255 for c, alpha in zip(plane, a))
+                for plane in (r, g, b)
+            )
+            self.__argb32_tables = (b, g, r, a) if sys.byteorder == "little" else (a, r, g, b)
+        return self.__argb32_tables
+
+
+class IndexedPixelBuffer(PixelBuffer):
+    """
+    Pixel buffer storing one byte palette index per pixel, a quarter of RGBA.
+
+    Colors are converted on the way in and out, so the rest of the editor
+    reads and writes it like an RGBA buffer. Raw values are the indices.
+    """
+
+    bpp: int = 1
+
+    def __init__(self, width: int, height: int, palette: Palette, fill: int = 0) -> None:
+        super().__init__(width, height, fill)
+        self.palette: Palette = palette
+
+    def get(self, x: int, y: int) -> int:
+        return self.palette.colors[self.get_raw(x, y)]
+
+    def set(self, x: int, y: int, color: int) -> None:
+        self.set_raw(x, y, self.palette.index_of(color))
+
+    def to_value(self, color: int) -> int:
+        return self.palette.index_of(color)
+
+    def fill_rect(self, x: int, y: int, w: int, h: int, color: int) -> None:
+        self.fill_raw(x, y, w, h, self.palette.index_of(color))
+
+    def region_bytes(self, x: int, y: int, w: int, h: int) -> bytes:
+        return bytes(self.__expand(self.raw_region(x, y, w, h), self.palette.rgba_tables()))
+
+    def argb32_region(self, x: int, y: int, w: int, h: int) -> bytearray:
+        return self.__expand(self.raw_region(x, y, w, h), self.palette.argb32_tables())
+
+    def sampled_argb32(self, width: int, height: int) -> bytearray:
+        return self.__expand(self.sampled_raw(width, height), self.palette.argb32_tables())
+
+    def __expand(self, indices: bytes, tables: tuple[bytes, ...]) -> bytearray:
+        """Look up 4 bytes per index, one translated plane at a time"""
+        out: bytearray = bytearray(len(indices) * 4)
+        for i, table in enumerate(tables):
+            out[i::4] = indices.translate(table)
+        return out
+
+    def write_bytes(self, x: int, y: int, w: int, h: int, data: bytes) -> None:
+        self.write_raw(x, y, w, h, self.palette.indices_of(data))
+
+    def blank(self, fill: int = None) -> IndexedPixelBuffer:
+        return IndexedPixelBuffer(
+            self.width, self.height, self.palette, self.fill if fill is None else fill
+        )
+
+    def composite(self, upper: IndexedPixelBuffer) -> None:
+        """
+        Copy visible pixels of an indexed buffer of the same size and palette
+        over this one. Matches normal blending only if no color is translucent
+        """
+        table: bytes = self.palette.visible_table()
+        if table[upper.fill]:
+            # Unallocated tiles of the upper buffer cover everything
+            keys = (
+                (tx, ty)
+                for ty in range((self.height - 1) // TILE_SIZE + 1)
+                for tx in range((self.width - 1) // TILE_SIZE + 1)
+            )
+        else:
+            keys = set(upper.tiles) | set(upper.lazy)
+        for key in keys:
+            top: bytes = upper.tile(key)
+            mask: bytes = top.translate(table)
+            if mask.find(0xFF) == -1:
+                continue
+            if mask.find(0) == -1:
+                tile: bytes = top
+            else:
+                m: int = int.from_bytes(mask, "little")
+                tile: bytes = (
+                    (int.from_bytes(top, "little") & m)
+                    | (int.from_bytes(self.tile(key), "little") & ~m)
+                ).to_bytes(len(top), "little")
+            self.tiles[key] = bytearray(tile)
+            self.shared.discard(key)
+            self.lazy.pop(key, None)
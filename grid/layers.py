@@ -0,0 +1,498 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+
+import cairo
+import utils as Utils
+from indexed import IndexedPixelBuffer
+from pixel_buffer import (
+    TILE_SIZE,
+    TRANSPARENT,
+    DirtyRegion,
+    PixelBuffer,
+    argb32_to_rgba,
+    color_to_rgba,
+)
+
+BLEND_MODES: dict[str, cairo.Operator] = {
+    "Normal": cairo.OPERATOR_OVER,
+    "Multiply": cairo.OPERATOR_MULTIPLY,
+    "Screen": cairo.OPERATOR_SCREEN,
+    "Overlay": cairo.OPERATOR_OVERLAY,
+    "Darken": cairo.OPERATOR_DARKEN,
+    "Lighten": cairo.OPERATOR_LIGHTEN,
+    "Difference": cairo.OPERATOR_DIFFERENCE,
+    "Add": cairo.OPERATOR_ADD,
+}
+
+
+class Layer:
+    def __init__(
+        self,
+        buffer: PixelBuffer,
+        name: str = "Layer",
+        visible: bool = True,
+        opacity: float = 1.0,
+        blend_mode: str = "Normal",
+    ) -> None:
+        self.buffer: PixelBuffer = buffer
+        self.name: str = name
+        self.visible: bool = visible
+        self.opacity: float = opacity
+        self.blend_mode: str = blend_mode
+        # Changed regions not yet composited
+        self.dirty: DirtyRegion = DirtyRegion()
+
+    def copy(self, empty: bool = False) -> Layer:
+        """Copy of the layer. Pixels are shared copy-on-write, or cleared if `empty`"""
+        buffer: PixelBuffer = (
+            self.buffer.blank(self.buffer.to_value(TRANSPARENT))
+            if empty
+            else self.buffer.copy()
+        )
+        return Layer(buffer, self.name, self.visible, self.opacity, self.blend_mode)
+
+    def surface(self, x: int, y: int, w: int, h: int) -> cairo.ImageSurface:
+        """Render region of the layer to a new surface"""
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        Utils.blit_to_surface(surface, self.buffer, x, y, w, h, x, y)
+        return surface
+
+    def paint(self, ctx: cairo.Context, surface: cairo.ImageSurface, x: int, y: int) -> None:
+        """Composite layer's surface at position with layer's blend mode and opacity"""
+        ctx.set_operator(BLEND_MODES[self.blend_mode])
+        ctx.set_source_surface(surface, x, y)
+        ctx.paint_with_alpha(self.opacity)
+
+
+class LayerTile:
+    """Cached surfaces of one canvas tile"""
+
+    __slots__ = ("below", "active", "above", "composite")
+
+    def __init__(self) -> None:
+        # Layers below the active one flattened
+        self.below: cairo.ImageSurface = None
+        # Active layer pixels
+        self.active: cairo.ImageSurface = None
+        # Layers above the active one flattened. None if they can't be grouped
+        self.above: cairo.ImageSurface = None
+        # Final image
+        self.composite: cairo.ImageSurface = None
+
+
+class StrokeLayer:
+    """
+    Opaque pixels painted during a stroke on a canvas scale surface. It is set
+    as the frame's `LayerStack.overlay` while the stroke lasts, so layers above,
+    blend mode and opacity apply to it. The surface grows with the stroke.
+    """
+
+    # Least space added around the stroke when the surface grows
+    margin: int = 32
+
+    def __init__(self) -> None:
+        self.surface: cairo.ImageSurface = None
+        self.ctx: cairo.Context = None
+        self.origin: tuple[int, int] = (0, 0)
+        self.bounds: list[int] = None
+
+    def __grow(self, x: int, y: int, width: int, height: int) -> None:
+        """
+        Reallocate surface so it contains canvas pixel (x, y), within a canvas
+        of width x height. The surface at least doubles towards the pixel, so a
+        long stroke is copied a logarithmic number of times
+        """
+        if self.surface:
+            ox, oy = self.origin
+            w, h = self.surface.get_width(), self.surface.get_height()
+            x0 = ox if x >= ox else x - max(self.margin, w)
+            y0 = oy if y >= oy else y - max(self.margin, h)
+            x1 = ox + w if x < ox + w else x + 1 + max(self.margin, w)
+            y1 = oy + h if y < oy + h else y + 1 + max(self.margin, h)
+        else:
+            x0, y0 = x - self.margin, y - self.margin
+            x1, y1 = x + 1 + self.margin, y + 1 + self.margin
+        x0, y0, x1, y1 = max(x0, 0), max(y0, 0), min(x1, width), min(y1, height)
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, x1 - x0, y1 - y0)
+        ctx = cairo.Context(surface)
+        if self.surface:
+            ctx.set_source_surface(self.surface, self.origin[0] - x0, self.origin[1] - y0)
+            ctx.paint()
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        self.surface, self.ctx, self.origin = surface, ctx, (x0, y0)
+
+    def add(self, x: int, y: int, color: int, width: int, height: int) -> None:
+        """Draw pixel of a canvas of width x height"""
+        ox, oy = self.origin
+        if (
+            not self.surface
+            or not ox <= x < ox + self.surface.get_width()
+            or not oy <= y < oy + self.surface.get_height()
+        ):
+            self.__grow(x, y, width, height)
+            ox, oy = self.origin
+
+        self.ctx.set_source_rgba(*color_to_rgba(color))
+        self.ctx.rectangle(x - ox, y - oy, 1, 1)
+        self.ctx.fill()
+
+        if self.bounds:
+            self.bounds = [
+                min(self.bounds[0], x),
+                min(self.bounds[1], y),
+                max(self.bounds[2], x),
+                max(self.bounds[3], y),
+            ]
+        else:
+            self.bounds = [x, y, x, y]
+
+    def clear(self) -> None:
+        self.surface = None
+        self.ctx = None
+        self.bounds = None
+
+
+class LayerStack:
+    """
+    Layers of a document (bottom to top) with a cache of composited tiles.
+
+    For every cached tile the layers below and above the active layer are kept
+    flattened, so an edit on the active layer only composites three surfaces
+    in its dirty region, however many layers there are.
+    """
+
+    # Maximum number of cached tiles. Least recently used tiles are evicted
+    max_cached_tiles: int = 256
+
+    def __init__(self, width: int, height: int, layers: list[Layer] = None) -> None:
+        self.width: int = width
+        self.height: int = height
+        self.layers: list[Layer] = layers or [Layer(PixelBuffer(width, height), "Layer 1")]
+        self.active: int = len(self.layers) - 1
+        self.tiles: OrderedDict[tuple[int, int], LayerTile] = OrderedDict()
+        # Incremented on every change of the composited image. Caches of whole
+        # frames (thumbnails, onion skins) compare it to know when to rebuild
+        self.version: int = 0
+        # Surface painted over the active layer (e.g. a stroke in progress) and
+        # its canvas position. Composited as part of the active layer
+        self.overlay: tuple[cairo.ImageSurface, int, int] = None
+
+    @classmethod
+    def from_buffer(cls, buffer: PixelBuffer) -> LayerStack:
+        return cls(buffer.width, buffer.height, [Layer(buffer, "Layer 1")])
+
+    def copy(self, empty: bool = False) -> LayerStack:
+        """Copy with the same layers. See `Layer.copy`"""
+        stack = LayerStack(
+            self.width, self.height, [layer.copy(empty) for layer in self.layers]
+        )
+        stack.active = self.active
+        return stack
+
+    @property
+    def active_layer(self) -> Layer:
+        return self.layers[self.active]
+
+    def layer_for(self, buffer: PixelBuffer) -> Layer | None:
+        for layer in self.layers:
+            if layer.buffer is buffer:
+                return layer
+        return None
+
+    def memory_usage(self) -> int:
+        return sum(layer.buffer.memory_usage() for layer in self.layers)
+
+    # ---------- Structure ---------- #
+
+    def invalidate(self) -> None:
+        """Drop all cached tiles. Call after changing layer order, visibility, blending or pixels"""
+        self.tiles.clear()
+        self.version += 1
+
+    def drop_cache(self) -> None:
+        """Free cached tiles without marking the image as changed"""
+        self.tiles.clear()
+        # Rebuilt tiles come from the buffer, which already has the stroke
+        self.overlay = None
+
+    def layer_changed(self, layer: Layer) -> None:
+        """Update cached tiles after layer's visibility, opacity or blend mode changed"""
+        if layer is not self.active_layer:
+            self.invalidate()
+            return
+        self.version += 1
+        # Active layer is composited last-but-one, cached neighbours stay valid
+        for (tx, ty), tile in self.tiles.items():
+            x, y, w, h = self.__tile_rect(tx, ty)
+            self.__compose(tile, x, y, w, h, x, y)
+
+    def set_active(self, index: int) -> None:
+        if index != self.active:
+            self.active = index
+            # Image doesn't change, only the grouping of cached layers
+            self.drop_cache()
+
+    def structure(self) -> tuple[list[Layer], int]:
+        """Layers and active index, restored on undo of a structure change"""
+        return list(self.layers), self.active
+
+    def restore(self, structure: tuple[list[Layer], int]) -> None:
+        layers, self.active = structure
+        self.layers[:] = layers
+        self.invalidate()
+
+    def add_layer(self, name: str = None) -> Layer:
+        """Add empty layer above the active one and make it active"""
+        buffer: PixelBuffer = self.active_layer.buffer
+        layer = Layer(
+            buffer.blank(buffer.to_value(TRANSPARENT)),
+            name or f"Layer {len(self.layers) + 1}",
+        )
+        self.active += 1
+        self.layers.insert(self.active, layer)
+        self.invalidate()
+        return layer
+
+    def remove_layer(self, index: int) -> None:
+        if len(self.layers) == 1:
+            return
+        del self.layers[index]
+        if index < self.active or self.active == len(self.layers):
+            self.active -= 1
+        self.invalidate()
+
+    def move_layer(self, index: int, new_index: int) -> None:
+        if not 0 <= new_index < len(self.layers):
+            return
+        active: Layer = self.active_layer
+        self.layers.insert(new_index, self.layers.pop(index))
+        self.active = self.layers.index(active)
+        self.invalidate()
+
+    # ---------- Compositing ---------- #
+
+    def __tile_rect(self, tx: int, ty: int) -> tuple[int, int, int, int]:
+        x, y = tx * TILE_SIZE, ty * TILE_SIZE
+        return x, y, min(TILE_SIZE, self.width - x), min(TILE_SIZE, self.height - y)
+
+    def __flatten_into(
+        self,
+        target: cairo.ImageSurface,
+        layers: list[Layer],
+        x: int,
+        y: int,
+        w: int,
+        h: int,
+        origin_x: int,
+        origin_y: int,
+    ) -> None:
+        """Composite layers' region into target surface whose origin is at canvas (origin_x, origin_y)"""
+        ctx = cairo.Context(target)
+        ctx.rectangle(x - origin_x, y - origin_y, w, h)
+        ctx.clip()
+        ctx.set_operator(cairo.OPERATOR_CLEAR)
+        ctx.paint()
+        for layer in layers:
+            if layer.visible:
+                layer.paint(ctx, layer.surface(x, y, w, h), x - origin_x, y - origin_y)
+
+    def __groupable(self, layers: list[Layer]) -> bool:
+        """Normal blended layers can be flattened into one group and painted over the rest"""
+        return all(
+            layer.blend_mode == "Normal" or not layer.visible for layer in layers
+        )
+
+    def __compose(self, tile: LayerTile, x: int, y: int, w: int, h: int, ox: int, oy: int) -> None:
+        """Composite the tile's cached surfaces in region"""
+        ctx = cairo.Context(tile.composite)
+        ctx.rectangle(x - ox, y - oy, w, h)
+        ctx.clip()
+        ctx.set_operator(cairo.OPERATOR_SOURCE)
+        ctx.set_source_surface(tile.below, 0, 0)
+        ctx.paint()
+
+        active: Layer = self.active_layer
+        if active.visible and self.overlay:
+            # Overlay and layer are blended with the layer's mode and opacity at once
+            surface, sx, sy = self.overlay
+            ctx.push_group()
+            ctx.set_source_surface(tile.active, 0, 0)
+            ctx.paint()
+            ctx.set_operator(cairo.OPERATOR_OVER)
+            ctx.set_source_surface(surface, sx - ox, sy - oy)
+            ctx.paint()
+            group: cairo.Pattern = ctx.pop_group()
+            ctx.set_operator(BLEND_MODES[active.blend_mode])
+            ctx.set_source(group)
+            ctx.paint_with_alpha(active.opacity)
+        elif active.visible:
+            active.paint(ctx, tile.active, 0, 0)
+
+        above: list[Layer] = self.layers[self.active + 1 :]
+        if tile.above:
+            ctx.set_operator(cairo.OPERATOR_OVER)
+            ctx.set_source_surface(tile.above, 0, 0)
+            ctx.paint()
+        else:
+            for layer in above:
+                if layer.visible:
+                    layer.paint(ctx, layer.surface(x, y, w, h), x - ox, y - oy)
+
+    def __build_tile(self, tx: int, ty: int) -> LayerTile:
+        x, y, w, h = self.__tile_rect(tx, ty)
+        tile = LayerTile()
+        tile.below = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.__flatten_into(tile.below, self.layers[: self.active], x, y, w, h, x, y)
+        tile.active = self.active_layer.surface(x, y, w, h)
+        above: list[Layer] = self.layers[self.active + 1 :]
+        if above and self.__groupable(above):
+            tile.above = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+            self.__flatten_into(tile.above, above, x, y, w, h, x, y)
+        tile.composite = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.__compose(tile, x, y, w, h, x, y)
+        return tile
+
+    def get_tile(self, tx: int, ty: int) -> cairo.ImageSurface:
+        """Get composited tile surface, building it on first use"""
+        tile: LayerTile = self.tiles.get((tx, ty))
+        if tile:
+            self.tiles.move_to_end((tx, ty))
+        else:
+            tile = self.tiles[(tx, ty)] = self.__build_tile(tx, ty)
+        return tile.composite
+
+    def evict(self, keep: int) -> None:
+        """Drop least recently used tiles above max_cached_tiles, but keep at least `keep`"""
+        while len(self.tiles) > max(self.max_cached_tiles, keep):
+            self.tiles.popitem(last=False)
+
+    def __cached_parts(self, x: int, y: int, w: int, h: int):
+        """
+        Split region into parts covered by cached tiles.
+        Yields the tile, part's x, y, w, h and the tile's origin
+        """
+        for ty in range(y // TILE_SIZE, (y + h - 1) // TILE_SIZE + 1):
+            for tx in range(x // TILE_SIZE, (x + w - 1) // TILE_SIZE + 1):
+                tile: LayerTile = self.tiles.get((tx, ty))
+                if not tile:
+                    continue
+                ox, oy, tw, th = self.__tile_rect(tx, ty)
+                ix, iy = max(x, ox), max(y, oy)
+                iw, ih = min(x + w, ox + tw) - ix, min(y + h, oy + th) - iy
+                yield tile, ix, iy, iw, ih, ox, oy
+
+    def update(self, layer: Layer, rects: list[tuple[int, int, int, int]]) -> None:
+        """Re-composite changed regions of a layer in cached tiles"""
+        index: int = self.layers.index(layer)
+        self.version += 1
+        for rect in rects:
+            for tile, ix, iy, iw, ih, ox, oy in self.__cached_parts(*rect):
+                # Refresh only the cache the layer belongs to
+                if index == self.active:
+                    Utils.blit_to_surface(tile.active, layer.buffer, ix, iy, iw, ih, ox, oy)
+                elif index < self.active:
+                    self.__flatten_into(
+                        tile.below, self.layers[: self.active], ix, iy, iw, ih, ox, oy
+                    )
+                elif tile.above:
+                    self.__flatten_into(
+                        tile.above, self.layers[self.active + 1 :], ix, iy, iw, ih, ox, oy
+                    )
+                self.__compose(tile, ix, iy, iw, ih, ox, oy)
+
+    def update_overlay(self, rects: list[tuple[int, int, int, int]]) -> None:
+        """Re-composite cached tiles in regions where the overlay changed"""
+        for rect in rects:
+            for tile, ix, iy, iw, ih, ox, oy in self.__cached_parts(*rect):
+                self.__compose(tile, ix, iy, iw, ih, ox, oy)
+
+    def merge_overlay(self, x: int, y: int, w: int, h: int) -> None:
+        """
+        Paint overlay into the active layer's cached tiles and remove it, once
+        its pixels are written to the layer's buffer. Only the cached tiles in
+        the region are touched, the others are built from the buffer
+        """
+        if not self.overlay:
+            return
+        surface, sx, sy = self.overlay
+        for tile, ix, iy, iw, ih, ox, oy in self.__cached_parts(x, y, w, h):
+            ctx = cairo.Context(tile.active)
+            ctx.rectangle(ix - ox, iy - oy, iw, ih)
+            ctx.clip()
+            ctx.set_source_surface(surface, sx - ox, sy - oy)
+            ctx.paint()
+            self.__compose(tile, ix, iy, iw, ih, ox, oy)
+        self.overlay = None
+        self.version += 1
+
+    def flatten_surface(self) -> cairo.ImageSurface:
+        """Composite all visible layers to a canvas sized surface"""
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, self.width, self.height)
+        self.__flatten_into(
+            surface, self.layers, 0, 0, self.width, self.height, 0, 0
+        )
+        return surface
+
+    def thumbnail(self, width: int, height: int) -> cairo.ImageSurface:
+        """
+        Composite all visible layers downscaled to width x height. Layers are
+        sampled at that size first, so the cost doesn't depend on the canvas size
+        """
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, width, height)
+        ctx = cairo.Context(surface)
+        for layer in self.layers:
+            if not layer.visible:
+                continue
+            sampled = cairo.ImageSurface.create_for_data(
+                layer.buffer.sampled_argb32(width, height),
+                cairo.FORMAT_ARGB32,
+                width,
+                height,
+                width * 4,
+            )
+            layer.paint(ctx, sampled, 0, 0)
+        return surface
+
+    def flatten(self) -> PixelBuffer:
+        """Composite all visible layers to a pixel buffer"""
+        visible: list[Layer] = [layer for layer in self.layers if layer.visible]
+        if (
+            len(visible) == 1
+            and visible[0].opacity == 1
+            and visible[0].blend_mode == "Normal"
+        ):
+            return visible[0].buffer.copy()
+
+        surface: cairo.ImageSurface = self.flatten_surface()
+        surface.flush()
+        stride: int = surface.get_stride()
+        data: bytes = bytes(surface.get_data())
+        if stride != self.width * 4:
+            data = b"".join(
+                data[y * stride : y * stride + self.width * 4] for y in range(self.height)
+            )
+        return PixelBuffer.from_bytes(self.width, self.height, argb32_to_rgba(data))
+
+    def flatten_indexed(self) -> IndexedPixelBuffer | None:
+        """
+        Merge visible indexed layers by palette index, e.g. for indexed export.
+        None if the result wouldn't match the composited image: some layer
+        isn't indexed, opaque or normal blended, or stacked layers have
+        translucent palette colors that would blend
+        """
+        visible: list[Layer] = [layer for layer in self.layers if layer.visible]
+        if not visible or any(
+            not isinstance(layer.buffer, IndexedPixelBuffer)
+            or layer.opacity != 1
+            or layer.blend_mode != "Normal"
+            for layer in visible
+        ):
+            return None
+        buffer: IndexedPixelBuffer = visible[0].buffer.copy()
+        if len(visible) > 1 and buffer.palette.has_translucent():
+            return None
+        for layer in visible[1:]:
+            buffer.composite(layer.buffer)
+        return buffer
@@ -0,0 +1,173 @@
+from gi.repository import Gtk  # type:ignore
+
+from layers import BLEND_MODES, Layer, LayerStack
+from shared import Box, Button
+from state import State
+
+
+class LayerRow(Gtk.ListBoxRow):
+    def __init__(self, layer: Layer) -> None:
+        super().__init__()
+        self.layer: Layer = layer
+        self.visible_btn: Gtk.CheckButton = Gtk.CheckButton(
+            active=layer.visible, tooltip_text="Visible"
+        )
+        self.visible_btn.connect("toggled", self.__on_visible_toggled)
+        self.set_child(
+            Box(
+                children=[
+                    self.visible_btn,
+                    Gtk.Label(label=layer.name, hexpand=True, xalign=0),
+                ],
+                spacing=6,
+                margin_top=3,
+                margin_bottom=3,
+                margin_start=3,
+                margin_end=3,
+            )
+        )
+
+    def __on_visible_toggled(self, btn: Gtk.CheckButton) -> None:
+        self.layer.visible = btn.get_active()
+        State.layers_panel.layer_changed(self.layer)
+
+
+class LayersPanel(Gtk.Box):
+    # Set while widgets are synced with the layer stack, so their signals are ignored
+    __updating: bool = False
+
+    def __init__(self) -> None:
+        super().__init__()
+        State.layers_panel = self
+        self.__build_ui()
+
+    def __build_ui(self) -> None:
+        self.set_orientation(Gtk.Orientation.VERTICAL)
+        self.props.width_request = 160
+        self.set_sensitive(False)
+
+        # Layers are listed top to bottom
+        self.list_box: Gtk.ListBox = Gtk.ListBox(
+            selection_mode=Gtk.SelectionMode.SINGLE, css_classes=["navigation-sidebar"]
+        )
+        self.list_box.connect("row-selected", self.__on_row_selected)
+        self.append(Gtk.ScrolledWindow(child=self.list_box, vexpand=True))
+
+        self.append(Gtk.Separator())
+
+        self.opacity_scale: Gtk.Scale = Gtk.Scale.new_with_range(
+            Gtk.Orientation.HORIZONTAL, 0, 100, 1
+        )
+        self.opacity_scale.set_tooltip_text("Opacity")
+        self.opacity_scale.connect("value-changed", self.__on_opacity_changed)
+        self.append(self.opacity_scale)
+
+        self.blend_dropdown: Gtk.DropDown = Gtk.DropDown.new_from_strings(
+            list(BLEND_MODES)
+        )
+        self.blend_dropdown.set_tooltip_text("Blend Mode")
+        self.blend_dropdown.set_margin_start(6)
+        self.blend_dropdown.set_margin_end(6)
+        self.blend_dropdown.connect("notify::selected", self.__on_blend_mode_changed)
+        self.append(self.blend_dropdown)
+
+        self.append(
+            Box(
+                children=[
+                    Button(
+                        icon_name="list-add-symbolic",
+                        tooltip_text="Add Layer",
+                        on_click=lambda *_: self.__add_layer(),
+                    ),
+                    Button(
+                        icon_name="list-remove-symbolic",
+                        tooltip_text="Remove Layer",
+                        on_click=lambda *_: self.__remove_layer(),
+                    ),
+                    Button(
+                        icon_name="go-up-symbolic",
+                        tooltip_text="Move Layer Up",
+                        on_click=lambda *_: self.__move_layer(1),
+                    ),
+                    Button(
+                        icon_name="go-down-symbolic",
+                        tooltip_text="Move Layer Down",
+                        on_click=lambda *_: self.__move_layer(-1),
+                    ),
+                ],
+                css_classes=["linked"],
+                halign=Gtk.Align.CENTER,
+                margin_top=6,
+                margin_bottom=6,
+            )
+        )
+
+    @property
+    def __layers(self) -> LayerStack:
+        return State.drawing_area.layers
+
+    def update(self) -> None:
+        """Rebuild the list and controls from the drawing area's layer stack"""
+        self.__updating = True
+        self.set_sensitive(True)
+        self.list_box.remove_all()
+        for layer in reversed(self.__layers.layers):
+            self.list_box.append(LayerRow(layer))
+        self.list_box.select_row(
+            self.list_box.get_row_at_index(len(self.__layers.layers) - 1 - self.__layers.active)
+        )
+        active: Layer = self.__layers.active_layer
+        self.opacity_scale.set_value(active.opacity * 100)
+        self.blend_dropdown.set_selected(list(BLEND_MODES).index(active.blend_mode))
+        self.__updating = False
+
+    def layer_changed(self, layer: Layer) -> None:
+        self.__layers.layer_changed(layer)
+        State.drawing_area.drawing_area.queue_draw()
+        State.timeline.frame_changed(self.__layers)
+
+    def __restructure(self) -> None:
+        """Apply change of layer order or active layer"""
+        self.update()
+        State.drawing_area.redraw_cached_surface()
+        State.main_window.update_document_info()
+
+    def __on_row_selected(self, _, row: LayerRow) -> None:
+        if self.__updating or not row:
+            return
+        State.toolbar.current_tool.deactivate()
+        self.__layers.set_active(self.__layers.layers.index(row.layer))
+        self.__restructure()
+
+    def __on_opacity_changed(self, scale: Gtk.Scale) -> None:
+        if self.__updating:
+            return
+        self.__layers.active_layer.opacity = scale.get_value() / 100
+        self.layer_changed(self.__layers.active_layer)
+
+    def __on_blend_mode_changed(self, dropdown: Gtk.DropDown, _) -> None:
+        if self.__updating:
+            return
+        self.__layers.active_layer.blend_mode = list(BLEND_MODES)[dropdown.get_selected()]
+        self.layer_changed(self.__layers.active_layer)
+
+    def __add_layer(self) -> None:
+        State.toolbar.current_tool.deactivate()
+        State.history.record_structure(self.__layers)
+        self.__layers.add_layer()
+        State.history.commit()
+        self.__restructure()
+
+    def __remove_layer(self) -> None:
+        State.toolbar.current_tool.deactivate()
+        State.history.record_structure(self.__layers)
+        self.__layers.remove_layer(self.__layers.active)
+        State.history.commit()
+        self.__restructure()
+
+    def __move_layer(self, offset: int) -> None:
+        State.toolbar.current_tool.deactivate()
+        State.history.record_structure(self.__layers)
+        self.__layers.move_layer(self.__layers.active, self.__layers.active + offset)
+        State.history.commit()
+        self.__restructure()
@@ -1,10 +1,12 @@
 from gi.repository import Adw, Gtk  # type:ignore
 from state import State
 from shared import Box, Button, ToolbarView
+from pixel_buffer import PixelBuffer, TRANSPARENT, hex_to_color
+from indexed import IndexedPixelBuffer, Palette
 
 
 class NewDialog(Adw.Dialog):
-    bg_color: tuple[int] = (0, 0, 0, 0)
+    bg_color: int = TRANSPARENT
 
     presets: list[int] = [4, 8, 16, 32, 64]
 
@@ -53,6 +55,14 @@ class NewDialog(Adw.Dialog):
             ),
         )
 
+        # Indexed sprites store a palette index per pixel instead of RGBA
+        self.indexed: Adw.SwitchRow = Adw.SwitchRow(
+            title="Indexed Colors",
+            subtitle="Use the current palette, up to 255 colors",
+        )
+        color_mode_group = Adw.PreferencesGroup(title="Color Mode")
+        color_mode_group.add(self.indexed)
+
         custom_size_group = Adw.PreferencesGroup(title="Custom Size")
         custom_size_group.add(width)
         custom_size_group.add(height)
@@ -63,7 +73,12 @@ class NewDialog(Adw.Dialog):
                     Adw.HeaderBar(title_widget=Adw.WindowTitle(title="New Sprite"))
                 ],
                 content=Box(
-                    children=[presets_group, custom_size_group, custom_size_btn],
+                    children=[
+                        color_mode_group,
+                        presets_group,
+                        custom_size_group,
+                        custom_size_btn,
+                    ],
                     orientation=Gtk.Orientation.VERTICAL,
                     spacing=12,
                     margin_start=12,
@@ -76,5 +91,13 @@ class NewDialog(Adw.Dialog):
     def __create_new_sprite(self, _, width: int, height: int) -> None:
         self.close()
         State.main_window.welcome_page.set_visible(False)
-        pixel_data: list[list[str]] = [[self.bg_color] * width for _ in range(height)]
+        if self.indexed.get_active():
+            palette: Palette = Palette.from_colors(
+                [hex_to_color(color) for color in State.palette_bar.get_colors()]
+            )
+            pixel_data: PixelBuffer = IndexedPixelBuffer(
+                width, height, palette, palette.index_of(self.bg_color)
+            )
+        else:
+            pixel_data: PixelBuffer = PixelBuffer(width, height, self.bg_color)
         State.drawing_area.load_image(pixel_data)
@@ -1,122 +1,123 @@
-from gi.repository import Gtk, Adw, Gdk  # type:ignore
+import math
+import os
 
-from shared import Box
+import cairo
+from gi.repository import Gtk, Gdk, Gio, GLib  # type:ignore
+
+from shared import Box, Button
 from state import State
-from palettes import default_palettes
+from palette_library import PaletteFileError, PaletteLibrary
 import utils as Utils
+from indexed import Palette
+from pixel_buffer import color_to_hex, hex_to_color, rgba_to_color, color_to_rgba
 
 
-class PaletteItem(Adw.Bin):
-    def __init__(self, color: str) -> None:
-        super().__init__()
-        self.color = color
-        self.css_class = State.palette_bar.add_palette_item(self.color)
-        self.__build_ui()
-
-    def __build_ui(self) -> None:
-        self.add_css_class("palette-item")
-        self.set_tooltip_text(self.color)
-        self.set_halign(Gtk.Align.CENTER)
-        self.set_valign(Gtk.Align.CENTER)
-        self.add_css_class(self.css_class)
+class Swatch(Gtk.DrawingArea):
+    """Color circle drawn with cairo, translucent colors over a checkerboard"""
 
-        left_click_ctrl = Gtk.GestureClick(button=1)
-        left_click_ctrl.connect("released", self.__on_left_click)
-        self.add_controller(left_click_ctrl)
+    size: int = 30
+    # Side of checkerboard squares behind translucent colors
+    checker_size: int = 5
 
-        right_click_ctrl = Gtk.GestureClick(button=3)
-        right_click_ctrl.connect("released", self.__on_right_click)
-        self.add_controller(right_click_ctrl)
+    def __init__(self, color: int = 0x00000000, **kwargs) -> None:
+        super().__init__(
+            content_width=self.size,
+            content_height=self.size,
+            halign=Gtk.Align.CENTER,
+            valign=Gtk.Align.CENTER,
+            **kwargs,
+        )
+        self.color: int = color
+        # Position in the palette while bound to a grid view item
+        self.position: int = -1
+        self.set_draw_func(self.__on_draw)
 
-    def __on_left_click(self, *_):
-        State.palette_bar.primary_color = Utils.hex_to_rgba(self.color)
+    def set_color(self, color: int) -> None:
+        self.color = color
+        self.queue_draw()
 
-    def __on_right_click(self, *_):
-        State.palette_bar.secondary_color = Utils.hex_to_rgba(self.color)
+    def __on_draw(self, _, cr: cairo.Context, width: int, height: int) -> None:
+        radius: float = min(width, height) / 2 - 1
+        cr.arc(width / 2, height / 2, radius, 0, 2 * math.pi)
+        cr.save()
+        cr.clip_preserve()
+        if self.color & 0xFF < 255:
+            cr.set_source_rgb(0.8, 0.8, 0.8)
+            cr.paint()
+            cr.set_source_rgb(0.6, 0.6, 0.6)
+            for y in range(0, height, self.checker_size):
+                for x in range(0, width, self.checker_size):
+                    if (x + y) // self.checker_size % 2:
+                        cr.rectangle(x, y, self.checker_size, self.checker_size)
+            cr.fill()
+        cr.set_source_rgba(*color_to_rgba(self.color))
+        cr.paint()
+        cr.restore()
+        # Border in the theme's foreground color
+        fg: Gdk.RGBA = self.get_color()
+        cr.set_source_rgba(fg.red, fg.green, fg.blue, 0.25)
+        cr.set_line_width(2)
+        cr.stroke()
 
 
 class PaletteBar(Gtk.Box):
-    __primary_color: str = (0, 0, 0, 1)
-    __secondary_color: str = (0, 0, 0, 0)
+    """
+    Palette colors in a virtualised grid view. Only visible swatches exist as
+    widgets and are drawn directly, so palettes of any size load at once.
+    The primary color's swatch is selected in the grid.
+    """
+
+    __primary_color: int = 0x000000FF
+    __secondary_color: int = 0x00000000
 
     @property
-    def primary_color(self) -> str:
+    def primary_color(self) -> int:
         return self.__primary_color
 
     @primary_color.setter
-    def primary_color(self, new_color: tuple[int]):
+    def primary_color(self, new_color: int):
         self.__primary_color = new_color
         self.primary_color_btn.set_tooltip_text(
-            Utils.rgba_to_hex(new_color) + " (Left Click)"
+            color_to_hex(new_color) + " (Left Click)"
         )
-        self.primary_color_btn.set_css_classes(
-            [
-                "palette-item",
-                self.__get_css_class_for_color(Utils.rgba_to_hex(new_color)),
-            ]
+        self.primary_color_btn.set_color(new_color)
+        self.selection.set_selected(
+            self.__indices.get(new_color, Gtk.INVALID_LIST_POSITION)
         )
 
     @property
-    def secondary_color(self) -> str:
+    def secondary_color(self) -> int:
         return self.__secondary_color
 
     @secondary_color.setter
-    def secondary_color(self, new_color: str):
+    def secondary_color(self, new_color: int):
         self.__secondary_color = new_color
         self.secondary_color_btn.set_tooltip_text(
-            Utils.rgba_to_hex(new_color) + " (Right Click)"
-        )
-        self.secondary_color_btn.set_css_classes(
-            [
-                "palette-item",
-                self.__get_css_class_for_color(Utils.rgba_to_hex(new_color)),
-            ]
+            color_to_hex(new_color) + " (Right Click)"
         )
+        self.secondary_color_btn.set_color(new_color)
 
     def __init__(self) -> None:
         super().__init__()
         State.palette_bar = self
+        # First position of every color in the palette
+        self.__indices: dict[int, int] = {}
+        # Set while the palette list is refreshed, so selection changes are ignored
+        self.__updating: bool = False
+        self.library: PaletteLibrary = PaletteLibrary(
+            os.path.join(GLib.get_user_data_dir(), "grid", "palettes"),
+            os.path.join(GLib.get_user_cache_dir(), "grid", "palettes.json"),
+        )
         self.__setup_styles()
         self.__build_ui()
-        colors: list[str] = default_palettes["cc-29"]
-        for color in colors:
-            self.__add_item(color)
-
-    def __add_item(self, color: str) -> None:
-        self.palette.append(PaletteItem(color))
-
-    def __get_css_class_for_color(self, color: str) -> str:
-        for css_class in self.styles.split("\n\n"):
-            if color in css_class:
-                return css_class.split("{")[0].strip(". \t")
-
-        return self.add_palette_item(color)
+        self.__load_library()
 
     def __setup_styles(self):
+        # Loaded once, swatches don't need per-color styles
         self.styles: str = """
-        flowboxchild {
-            all:unset;
-            padding:0px;
-            margin:0px;
-        }
-
-        .palette-item {
+        .palette gridview > child {
+            padding: 3px;
             border-radius: 9999px;
-            border: solid 2px @borders;
-            min-width: 30px;
-            min-height: 30px;
-        }
-
-        .palette-current-color-btn {
-            border: solid 2px @borders;
-        }
-
-        .default-primary-color {
-            background-color: #000000ff;
-        }
-
-        .default-secondary-color {
-            background-color: #00000000;
         }
         """
 
@@ -132,29 +133,52 @@ class PaletteBar(Gtk.Box):
         self.set_orientation(Gtk.Orientation.VERTICAL)
         self.props.width_request = 100
 
-        self.palette = Gtk.FlowBox(
-            max_children_per_line=2,
+        # Palettes of the library, by label
+        self.palettes: Gtk.StringList = Gtk.StringList()
+        self.palette_dropdown: Gtk.DropDown = Gtk.DropDown(
+            model=self.palettes,
+            enable_search=True,
+            expression=Gtk.PropertyExpression.new(Gtk.StringObject, None, "string"),
+            tooltip_text="Palette",
+            margin_top=6,
+            margin_start=6,
+            margin_end=6,
+        )
+        self.append(self.palette_dropdown)
+
+        # Colors as hex strings
+        self.colors: Gtk.StringList = Gtk.StringList()
+        self.selection: Gtk.SingleSelection = Gtk.SingleSelection(
+            model=self.colors, autoselect=False, can_unselect=True
+        )
+        factory: Gtk.SignalListItemFactory = Gtk.SignalListItemFactory()
+        factory.connect("setup", self.__on_setup_item)
+        factory.connect("bind", self.__on_bind_item)
+        self.palette: Gtk.GridView = Gtk.GridView(
+            model=self.selection,
+            factory=factory,
+            min_columns=2,
+            max_columns=2,
             margin_top=6,
             margin_bottom=6,
             margin_end=6,
             margin_start=6,
-            row_spacing=6,
-            valign=Gtk.Align.START,
         )
         self.append(
             Gtk.ScrolledWindow(
                 child=self.palette,
                 vexpand=True,
+                css_classes=["palette"],
                 window_placement=Gtk.CornerType.TOP_RIGHT,
             )
         )
 
         self.append(Gtk.Separator())
 
-        self.primary_color_btn = Adw.Bin()
-        self.primary_color = (0, 0, 0, 1)
-        self.secondary_color_btn = Adw.Bin()
-        self.secondary_color = (1, 1, 1, 1)
+        self.primary_color_btn = Swatch()
+        self.secondary_color_btn = Swatch()
+        self.primary_color = 0x000000FF
+        self.secondary_color = 0xFFFFFFFF
 
         self.append(
             Box(
@@ -166,12 +190,180 @@ class PaletteBar(Gtk.Box):
             )
         )
 
-    def add_palette_item(self, color: str) -> str:
-        """Add new css class for color if not exists. Else return existing css class"""
+        # Import palette from image
+        self.import_max_colors: Gtk.SpinButton = Gtk.SpinButton.new_with_range(2, 256, 1)
+        self.import_max_colors.set_value(32)
+        self.append(
+            Gtk.MenuButton(
+                icon_name="grid-palette-symbolic",
+                tooltip_text="Import Palette from Image",
+                halign=Gtk.Align.CENTER,
+                margin_bottom=6,
+                popover=Gtk.Popover(
+                    child=Box(
+                        orientation=Gtk.Orientation.VERTICAL,
+                        spacing=6,
+                        children=[
+                            Box(
+                                spacing=6,
+                                children=[
+                                    Gtk.Label(label="Max Colors", hexpand=True, xalign=0),
+                                    self.import_max_colors,
+                                ],
+                            ),
+                            Button(
+                                label="Choose Image…",
+                                on_click=self.__on_import_btn_clicked,
+                            ),
+                        ],
+                    )
+                ),
+            )
+        )
 
-        if color in self.styles:
-            return self.__get_css_class_for_color(color)
-        style_class = Utils.generate_random_ascii_string(30)
-        self.styles += f".{style_class}{{background-color:{color};border: solid 2px @borders;}}\n\n"
-        self.css_provider.load_from_string(self.styles)
-        return style_class
+    def __load_library(self) -> None:
+        os.makedirs(self.library.directory, exist_ok=True)
+        self.library.scan()
+        self.palettes.splice(0, 0, self.library.labels())
+        self.__show_colors(self.library.colors(0))
+        self.palette_dropdown.connect("notify::selected", self.__on_palette_selected)
+        # Pick up palettes added, changed or removed while running
+        self.monitor: Gio.FileMonitor = Gio.File.new_for_path(
+            self.library.directory
+        ).monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None)
+        self.monitor.connect("changed", self.__on_library_changed)
+
+    def __on_palette_selected(self, *_) -> None:
+        index: int = self.palette_dropdown.get_selected()
+        if self.__updating or index == Gtk.INVALID_LIST_POSITION:
+            return
+        # Palette files are only parsed once selected
+        try:
+            colors: list[str] = self.library.colors(index)
+        except (OSError, PaletteFileError) as e:
+            print(e)
+            return
+        self.set_colors(colors)
+
+    def __on_library_changed(self, *_) -> None:
+        if not self.library.scan():
+            return
+        # Keep the selected palette, its colors are already shown
+        selected: str = self.palettes.get_string(self.palette_dropdown.get_selected())
+        labels: list[str] = self.library.labels()
+        self.__updating = True
+        self.palettes.splice(0, self.palettes.get_n_items(), labels)
+        self.palette_dropdown.set_selected(
+            labels.index(selected) if selected in labels else Gtk.INVALID_LIST_POSITION
+        )
+        self.__updating = False
+
+    def __on_setup_item(self, _, item: Gtk.ListItem) -> None:
+        swatch: Swatch = Swatch()
+
+        left_click_ctrl = Gtk.GestureClick(button=1)
+        left_click_ctrl.connect("released", self.__on_left_click, swatch)
+        swatch.add_controller(left_click_ctrl)
+
+        right_click_ctrl = Gtk.GestureClick(button=3)
+        right_click_ctrl.connect("released", self.__on_right_click, swatch)
+        swatch.add_controller(right_click_ctrl)
+
+        item.set_child(swatch)
+
+    def __on_bind_item(self, _, item: Gtk.ListItem) -> None:
+        swatch: Swatch = item.get_child()
+        color: str = item.get_item().get_string()
+        swatch.position = item.get_position()
+        swatch.set_color(hex_to_color(color))
+        swatch.set_tooltip_text(color)
+
+    def __on_left_click(self, _, n_press: int, x: float, y: float, swatch: Swatch):
+        if n_press == 2:
+            self.edit_color(swatch.position)
+            return
+        self.primary_color = swatch.color
+
+    def __on_right_click(self, _, n_press: int, x: float, y: float, swatch: Swatch):
+        self.secondary_color = swatch.color
+
+    def get_colors(self) -> list[str]:
+        return [self.colors.get_string(i) for i in range(self.colors.get_n_items())]
+
+    def set_colors(self, colors: list[str]) -> None:
+        """
+        Replace palette colors. Indexed documents are recolored by palette position
+        and the bar shows their palette, so positions stay palette indices: colors
+        past the palette's size are dropped and entries past the new colors are kept
+        """
+        document = State.drawing_area.document
+        if document and document.palette:
+            document.palette.replace([hex_to_color(color) for color in colors])
+            self.show_palette(document.palette)
+            State.drawing_area.palette_changed()
+            return
+        self.__show_colors(colors)
+
+    def show_palette(self, palette: Palette) -> None:
+        """Show palette of an indexed document, except its transparent entry"""
+        self.__show_colors([color_to_hex(color) for color in palette.colors[1:]])
+
+    def __show_colors(self, colors: list[str]) -> None:
+        # One model change, the grid view only creates swatches for visible rows
+        self.colors.splice(0, self.colors.get_n_items(), colors)
+        self.__index_colors()
+
+    def __index_colors(self) -> None:
+        """Map colors to their first position and select the primary color's swatch"""
+        self.__indices = {}
+        for i, color in enumerate(self.get_colors()):
+            self.__indices.setdefault(hex_to_color(color), i)
+        self.primary_color = self.primary_color
+
+    def edit_color(self, position: int) -> None:
+        """Pick new color for palette entry. In indexed documents this recolors its pixels"""
+        old_color: int = hex_to_color(self.colors.get_string(position))
+
+        def __choose_cb(dialog: Gtk.ColorDialog, res: Gio.Task) -> None:
+            try:
+                rgba: Gdk.RGBA = dialog.choose_rgba_finish(res)
+            except GLib.Error:
+                return
+            color: int = rgba_to_color(rgba.red, rgba.green, rgba.blue, rgba.alpha)
+            self.colors.splice(position, 1, [color_to_hex(color)])
+            if self.primary_color == old_color:
+                self.__primary_color = color
+            self.__index_colors()
+            document = State.drawing_area.document
+            if document and document.palette:
+                # Entry 0 is the transparent one, not shown in the bar
+                document.palette.set(position + 1, color)
+                State.drawing_area.palette_changed()
+
+        initial: Gdk.RGBA = Gdk.RGBA(*color_to_rgba(old_color))
+        Gtk.ColorDialog(with_alpha=True).choose_rgba(
+            State.main_window, initial, None, __choose_cb
+        )
+
+    def __on_import_btn_clicked(self, btn: Gtk.Button) -> None:
+        btn.get_ancestor(Gtk.Popover).popdown()
+        max_colors: int = self.import_max_colors.get_value_as_int()
+
+        def __open_cb(dialog: Gtk.FileDialog, res: Gio.Task) -> None:
+            try:
+                path: str = dialog.open_finish(res).get_path()
+            except GLib.Error as e:
+                print(e)
+                return
+            # Decoding and quantising big images takes a while, keep it off the main loop
+            State.main_window.run_task(
+                f"Importing palette from {os.path.basename(path)}",
+                lambda progress: Utils.get_pallete_colors_from_file(
+                    path, max_colors, progress
+                ),
+                self.set_colors,
+            )
+
+        Gtk.FileDialog(
+            default_filter=Gtk.FileFilter(name="Images", mime_types=["image/*"])
+        ).open(State.main_window, None, __open_cb)
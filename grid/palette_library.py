@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import json
+import os
+import struct
+from typing import Callable
+
+from palettes import default_palettes
+
+
+class PaletteFileError(Exception):
+    pass
+
+
+def parse_gpl(data: bytes) -> tuple[str, list[str]]:
+    """GIMP palette: header, optional Name/Columns lines, then "R G B [name]" rows"""
+    lines: list[str] = data.decode("utf-8", "replace").splitlines()
+    if not lines or not lines[0].strip().startswith("GIMP Palette"):
+        raise PaletteFileError("Missing GIMP Palette header")
+    name: str = None
+    colors: list[str] = []
+    for line in lines[1:]:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("Name:"):
+            name = line[5:].strip()
+            continue
+        if ":" in line.split()[0]:
+            # Columns and other headers
+            continue
+        try:
+            r, g, b = (int(v) for v in line.split()[:3])
+        except ValueError:
+            raise PaletteFileError(f"Invalid color line: {line}")
+        colors.append(f"#{r:02x}{g:02x}{b:02x}ff")
+    return name, colors
+
+
+def parse_hex(data: bytes) -> tuple[str, list[str]]:
+    """One RRGGBB or RRGGBBAA hex color per line, e.g. from Lospec"""
+    colors: list[str] = []
+    for line in data.decode("utf-8", "replace").splitlines():
+        line = line.strip().lstrip("#")
+        if not line:
+            continue
+        if len(line) not in (6, 8) or any(c not in "0123456789abcdefABCDEF" for c in line):
+            raise PaletteFileError(f"Invalid hex color: {line}")
+        colors.append("#" + line.lower().ljust(8, "f"))
+    return None, colors
+
+
+def parse_pal(data: bytes) -> tuple[str, list[str]]:
+    """JASC-PAL text palette or binary RIFF PAL palette"""
+    if data[:4] == b"RIFF" and data[8:12] == b"PAL ":
+        # "data" chunk: version, count, then R G B flags entries
+        offset: int = data.find(b"data", 12)
+        if offset == -1:
+            raise PaletteFileError("Missing RIFF data chunk")
+        _, count = struct.unpack_from("<HH", data, offset + 8)
+        entries: bytes = data[offset + 12 : offset + 12 + count * 4]
+        return None, [
+            f"#{entries[i]:02x}{entries[i + 1]:02x}{entries[i + 2]:02x}ff"
+            for i in range(0, len(entries) - 3, 4)
+        ]
+
+    lines: list[str] = data.decode("ascii", "replace").split()
+    if len(lines) < 3 or lines[0] != "JASC-PAL":
+        raise PaletteFileError("Not a JASC-PAL or RIFF palette")
+    try:
+        count: int = int(lines[2])
+        values: list[int] = [int(v) for v in lines[3 : 3 + count * 3]]
+    except ValueError:
+        raise PaletteFileError("Invalid JASC-PAL color")
+    return None, [
+        f"#{values[i]:02x}{values[i + 1]:02x}{values[i + 2]:02x}ff"
+        for i in range(0, len(values) - 2, 3)
+    ]
+
+
+# Parsers by file extension. They return palette name (if the format has one)
+# and colors as #rrggbbaa strings, like the built-in palettes
+PARSERS: dict[str, Callable[[bytes], tuple[str, list[str]]]] = {
+    ".gpl": parse_gpl,
+    ".hex": parse_hex,
+    ".pal": parse_pal,
+}
+
+
+def load_palette(path: str) -> tuple[str, list[str]]:
+    """Parse palette file. Returns its name (file name if it has none) and colors"""
+    parser = PARSERS.get(os.path.splitext(path)[1].lower())
+    if not parser:
+        raise PaletteFileError(f"Unsupported palette file {path}")
+    with open(path, "rb") as file:
+        name, colors = parser(file.read())
+    return name or os.path.splitext(os.path.basename(path))[0], colors
+
+
+class PaletteInfo:
+    """Index entry of a palette file"""
+
+    __slots__ = ("path", "name", "count", "mtime", "size")
+
+    def __init__(self, path: str, name: str, count: int, mtime: int, size: int) -> None:
+        self.path: str = path
+        self.name: str = name
+        self.count: int = count
+        self.mtime: int = mtime
+        self.size: int = size
+
+
+class PaletteLibrary:
+    """
+    Palettes in a directory plus the built-in ones.
+
+    Names and color counts of the files are kept in a JSON index. Scanning
+    only stats the files and parses the new or modified ones, colors are read
+    when a palette is selected and kept afterwards.
+    """
+
+    def __init__(self, directory: str, index_path: str) -> None:
+        self.directory: str = directory
+        self.index_path: str = index_path
+        # Palette files by path, sorted by name after a scan
+        self.files: dict[str, PaletteInfo] = {}
+        self.__colors: dict[str, list[str]] = {}
+        self.__read_index()
+
+    def labels(self) -> list[str]:
+        """Palette names with color counts, built-in palettes first"""
+        return [f"{name} ({len(colors)})" for name, colors in default_palettes.items()] + [
+            f"{info.name} ({info.count})" for info in self.files.values()
+        ]
+
+    def colors(self, index: int) -> list[str]:
+        """Colors of palette at position in `labels()`"""
+        if index < len(default_palettes):
+            return list(default_palettes.values())[index]
+        info: PaletteInfo = list(self.files.values())[index - len(default_palettes)]
+        colors: list[str] = self.__colors.get(info.path)
+        if colors is None:
+            colors = self.__colors[info.path] = load_palette(info.path)[1]
+        return colors
+
+    def scan(self) -> bool:
+        """Update the index from the directory. Returns whether anything changed"""
+        files: dict[str, PaletteInfo] = {}
+        changed: bool = False
+        try:
+            entries: list[os.DirEntry] = list(os.scandir(self.directory))
+        except FileNotFoundError:
+            entries = []
+        for entry in entries:
+            if os.path.splitext(entry.name)[1].lower() not in PARSERS or not entry.is_file():
+                continue
+            stat: os.stat_result = entry.stat()
+            info: PaletteInfo = self.files.get(entry.path)
+            if info and info.mtime == stat.st_mtime_ns and info.size == stat.st_size:
+                files[entry.path] = info
+                continue
+            try:
+                name, colors = load_palette(entry.path)
+            except (OSError, PaletteFileError, struct.error) as e:
+                print(e)
+                continue
+            files[entry.path] = PaletteInfo(
+                entry.path, name, len(colors), stat.st_mtime_ns, stat.st_size
+            )
+            self.__colors[entry.path] = colors
+            changed = True
+
+        changed = changed or files.keys() != self.files.keys()
+        for path in self.files.keys() - files.keys():
+            self.__colors.pop(path, None)
+        self.files = dict(sorted(files.items(), key=lambda item: item[1].name.lower()))
+        if changed:
+            self.__write_index()
+        return changed
+
+    def __read_index(self) -> None:
+        try:
+            with open(self.index_path) as file:
+                index: dict = json.load(file)
+        except (OSError, ValueError):
+            return
+        if index.get("directory") != self.directory:
+            return
+        self.files = {
+            info["path"]: PaletteInfo(
+                info["path"], info["name"], info["count"], info["mtime"], info["size"]
+            )
+            for info in index["palettes"]
+        }
+
+    def __write_index(self) -> None:
+        os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+        temp_path: str = self.index_path + ".tmp"
+        with open(temp_path, "w") as file:
+            json.dump(
+                {
+                    "directory": self.directory,
+                    "palettes": [
+                        {slot: getattr(info, slot) for slot in PaletteInfo.__slots__}
+                        for info in self.files.values()
+                    ],
+                },
+                file,
+            )
+        os.replace(temp_path, self.index_path)
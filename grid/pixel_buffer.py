@@ -0,0 +1,509 @@
+from __future__ import annotations
+
+import sys
+from array import array
+from typing import Callable
+
+# Colors are stored as packed 0xRRGGBBAA integers (straight, not premultiplied alpha)
+TRANSPARENT: int = 0x00000000
+
+# Side of the square tiles the canvas is split into for rendering
+TILE_SIZE: int = 128
+
+
+def pack_color(r: int, g: int, b: int, a: int = 255) -> int:
+    """Pack 0-255 channel values into 0xRRGGBBAA integer"""
+    return (r << 24) | (g << 16) | (b << 8) | a
+
+
+def unpack_color(color: int) -> tuple[int, int, int, int]:
+    """Unpack 0xRRGGBBAA integer into 0-255 channel values"""
+    return (color >> 24) & 0xFF, (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+
+
+def rgba_to_color(r: float, g: float, b: float, a: float = 1.0) -> int:
+    """Convert RGBA 0-1 floats to packed color"""
+    return pack_color(
+        round(r * 255), round(g * 255), round(b * 255), round(a * 255)
+    )
+
+
+def color_to_rgba(color: int) -> tuple[float, float, float, float]:
+    """Convert packed color to RGBA 0-1 floats tuple (for cairo)"""
+    return tuple(c / 255.0 for c in unpack_color(color))
+
+
+def hex_to_color(hex_code: str) -> int:
+    """Convert #RRGGBB or #RRGGBBAA string to packed color"""
+    hex_code = hex_code.lstrip("#")
+    if len(hex_code) == 6:
+        hex_code += "ff"
+    return int(hex_code, 16)
+
+
+def color_to_hex(color: int) -> str:
+    """Convert packed color to #rrggbbaa string"""
+    return f"#{color:08x}"
+
+
+def pixel_to_color(value: int) -> int:
+    """Convert native endian 32-bit pixel value of RGBA bytes to packed color"""
+    return int.from_bytes(value.to_bytes(4, sys.byteorder), "big")
+
+
+def color_to_pixel(color: int) -> int:
+    """Convert packed color to native endian 32-bit pixel value"""
+    return int.from_bytes(color.to_bytes(4, "big"), sys.byteorder)
+
+
+# Translate tables over the alpha plane
+# 0 -> 0x00, anything else -> 0xFF. Used as AND mask to zero color of transparent pixels
+_VISIBLE_MASK: bytes = bytes([0]) + bytes([0xFF]) * 255
+# Tables by alpha value: that value -> 0xFF, others -> 0x00
+_ALPHA_EQUAL: list[bytes] = [bytes(255 if v == a else 0 for v in range(256)) for a in range(256)]
+
+# Translate tables over color channels by alpha value
+_PREMULTIPLY: list[bytes] = [bytes((c * a + 127) // 255 for c in range(256)) for a in range(256)]
+_UNPREMULTIPLY: list[bytes] = [bytes(range(256))] + [
+    bytes(min((c * 255 + a // 2) // a, 255) for c in range(256)) for a in range(1, 256)
+]
+# Same tables joined, indexed by alpha * 256 + color
+_PREMULTIPLY_ALL: bytes = b"".join(_PREMULTIPLY)
+_UNPREMULTIPLY_ALL: bytes = b"".join(_UNPREMULTIPLY)
+
+# Semi-transparent pixels are converted in groups of equal alpha. Above this
+# many distinct alpha values a lookup per byte is faster than one pass per group
+_MAX_ALPHA_GROUPS: int = 24
+# Pixels converted at once, bounds the size of the big integers used
+_ALPHA_CHUNK: int = 64 * 1024
+
+
+def _and_planes(plane: bytes, mask: bytes) -> bytes:
+    """Bitwise AND of two equal length byte strings, done as one big integer operation"""
+    return (int.from_bytes(plane, "little") & int.from_bytes(mask, "little")).to_bytes(
+        len(plane), "little"
+    )
+
+
+def _convert_partial(data: bytes, tables: list[bytes], joined: bytes) -> bytes:
+    """
+    Map color bytes of semi-transparent pixels of RGBA bytes through the table
+    of their alpha value. Opaque pixels are unchanged
+    """
+    alpha: bytes = data[3::4]
+    alphas: set[int] = set(alpha.translate(None, b"\x00\xff"))
+    if not alphas:
+        return data
+
+    if len(alphas) > _MAX_ALPHA_GROUPS:
+        # Look up every byte by (alpha, value) as native 16-bit indices.
+        # Opaque pixels go through the identity table of alpha 255
+        spread: bytearray = bytearray(len(data))
+        for c in range(4):
+            spread[c::4] = alpha
+        indices: bytearray = bytearray(len(data) * 2)
+        low, high = (0, 1) if sys.byteorder == "little" else (1, 0)
+        indices[low::2], indices[high::2] = data, spread
+        out: bytearray = bytearray(map(joined.__getitem__, memoryview(indices).cast("H")))
+        out[3::4] = alpha
+        return out
+
+    # One translate of the whole data per group. Bytes of the group's pixels
+    # take the translated value: data ^ ((data ^ translated) & mask)
+    original: int = int.from_bytes(data, "little")
+    changes: int = 0
+    mask: bytearray = bytearray(len(data))
+    for a in alphas:
+        pixels: bytes = alpha.translate(_ALPHA_EQUAL[a])
+        mask[0::4] = mask[1::4] = mask[2::4] = pixels
+        translated: int = int.from_bytes(data.translate(tables[a]), "little")
+        changes |= (original ^ translated) & int.from_bytes(mask, "little")
+    return (original ^ changes).to_bytes(len(data), "little")
+
+
+def _convert_alpha(data: bytes, tables: list[bytes], joined: bytes) -> bytes:
+    """`_convert_partial` in chunks, which keeps groups small and integers in cache"""
+    size: int = _ALPHA_CHUNK * 4
+    return b"".join(
+        _convert_partial(bytes(data[i : i + size]), tables, joined)
+        for i in range(0, len(data), size)
+    )
+
+
+def rgba_to_argb32(data: bytes) -> bytearray:
+    """
+    Convert straight RGBA bytes to cairo FORMAT_ARGB32 bytes
+    (premultiplied alpha, native endian 32-bit pixels).
+    """
+    data = _convert_alpha(data, _PREMULTIPLY, _PREMULTIPLY_ALL)
+    r, g, b, a = data[0::4], data[1::4], data[2::4], data[3::4]
+
+    # Transparent pixels must have zero color in premultiplied format
+    if a.find(0) != -1:
+        mask: bytes = a.translate(_VISIBLE_MASK)
+        r, g, b = _and_planes(r, mask), _and_planes(g, mask), _and_planes(b, mask)
+
+    out: bytearray = bytearray(len(data))
+    if sys.byteorder == "little":
+        out[0::4], out[1::4], out[2::4], out[3::4] = b, g, r, a
+    else:
+        out[0::4], out[1::4], out[2::4], out[3::4] = a, r, g, b
+    return out
+
+
+def argb32_to_rgba(data: bytes) -> bytearray:
+    """Convert cairo FORMAT_ARGB32 bytes back to straight RGBA bytes"""
+    if sys.byteorder == "little":
+        b, g, r, a = data[0::4], data[1::4], data[2::4], data[3::4]
+    else:
+        a, r, g, b = data[0::4], data[1::4], data[2::4], data[3::4]
+
+    out: bytearray = bytearray(len(data))
+    out[0::4], out[1::4], out[2::4], out[3::4] = r, g, b, a
+    return bytearray(_convert_alpha(out, _UNPREMULTIPLY, _UNPREMULTIPLY_ALL))
+
+
+def pack_rows(
+    width: int, height: int, pixels: bytes, rowstride: int, n_channels: int = 4
+) -> bytes:
+    """
+    Convert RGB or RGBA rows with padding (e.g. GdkPixbuf pixels) to packed RGBA bytes.
+    Works on whole rows and channel planes, never on single pixels.
+    """
+    row_len: int = width * n_channels
+    view: memoryview = memoryview(pixels)
+    # Strip rowstride padding. Last row of a pixbuf may be shorter than rowstride
+    if rowstride == row_len:
+        packed: bytes = view[: row_len * height]
+    else:
+        packed: bytes = b"".join(
+            view[y * rowstride : y * rowstride + row_len] for y in range(height)
+        )
+
+    if n_channels == 4:
+        return packed
+
+    # Expand RGB to RGBA by interleaving channel planes with opaque alpha
+    packed = bytes(packed)
+    data: bytearray = bytearray(width * height * 4)
+    data[0::4] = packed[0::3]
+    data[1::4] = packed[1::3]
+    data[2::4] = packed[2::3]
+    data[3::4] = b"\xff" * (width * height)
+    return data
+
+
+def content_bounds(width: int, height: int, data: bytes) -> tuple[int, int, int, int] | None:
+    """Bounding box of visible pixels of packed RGBA bytes, None if all are transparent"""
+    alpha: bytes = data[3::4]
+    rows: list[int] = [
+        y for y in range(height) if alpha[y * width : (y + 1) * width].count(0) != width
+    ]
+    if not rows:
+        return None
+    # Columns with any visible pixel, as one OR of all visible rows
+    columns: int = 0
+    for y in rows:
+        columns |= int.from_bytes(alpha[y * width : (y + 1) * width], "big")
+    column_bytes: bytes = columns.to_bytes(width, "big")
+    x0: int = width - len(column_bytes.lstrip(b"\x00"))
+    x1: int = len(column_bytes.rstrip(b"\x00"))
+    return x0, rows[0], x1 - x0, rows[-1] - rows[0] + 1
+
+
+class DirtyRegion:
+    """
+    Set of changed rectangles (x, y, w, h).
+    Touching or overlapping rectangles are merged as they are added
+    and the list collapses to its bounding box when it grows too long.
+    """
+
+    max_rects: int = 16
+
+    def __init__(self) -> None:
+        self.rects: list[tuple[int, int, int, int]] = []
+
+    def __bool__(self) -> bool:
+        return bool(self.rects)
+
+    def add(self, x: int, y: int, w: int = 1, h: int = 1) -> None:
+        if w <= 0 or h <= 0:
+            return
+        x1, y1 = x + w, y + h
+        merged: bool = True
+        while merged:
+            merged = False
+            for i, (rx, ry, rw, rh) in enumerate(self.rects):
+                # Merge if rectangles overlap or share an edge
+                if x <= rx + rw and rx <= x1 and y <= ry + rh and ry <= y1:
+                    x, y = min(x, rx), min(y, ry)
+                    x1, y1 = max(x1, rx + rw), max(y1, ry + rh)
+                    del self.rects[i]
+                    merged = True
+                    break
+        self.rects.append((x, y, x1 - x, y1 - y))
+        if len(self.rects) > self.max_rects:
+            self.rects = [self.bounds()]
+
+    def bounds(self) -> tuple[int, int, int, int]:
+        """Bounding box of all rectangles"""
+        x0: int = min(r[0] for r in self.rects)
+        y0: int = min(r[1] for r in self.rects)
+        x1: int = max(r[0] + r[2] for r in self.rects)
+        y1: int = max(r[1] + r[3] for r in self.rects)
+        return x0, y0, x1 - x0, y1 - y0
+
+    def take(self) -> list[tuple[int, int, int, int]]:
+        """Return rectangles and clear the region"""
+        rects, self.rects = self.rects, []
+        return rects
+
+
+class PixelBuffer:
+    """
+    Sparse tiled packed RGBA pixel storage.
+
+    The canvas is split into TILE_SIZE x TILE_SIZE tiles of 4 byte pixels (R, G, B, A).
+    Tiles that were never written are not allocated and read as the shared background
+    tile. Tiles are copy-on-write: `copy()` shares them and they are duplicated
+    by whichever buffer writes to them first. Tiles may also be lazy: stored as
+    loaders (e.g. reading a file chunk) that are called when the tile is first used.
+
+    The `*_raw` methods work on stored pixel values, `bpp` bytes each. Here those
+    are the packed colors themselves, subclasses may store e.g. palette indices
+    and convert them in `get`, `set`, `fill_rect`, `region_bytes` and `write_bytes`.
+    """
+
+    # Bytes per stored pixel
+    bpp: int = 4
+
+    def __init__(self, width: int, height: int, fill: int = TRANSPARENT) -> None:
+        self.width: int = width
+        self.height: int = height
+        # Raw value of unallocated pixels
+        self.fill: int = fill
+        self.background: bytes = fill.to_bytes(self.bpp, "big") * (TILE_SIZE * TILE_SIZE)
+        # Allocated tiles by (tile x, tile y)
+        self.tiles: dict[tuple[int, int], bytearray] = {}
+        # Tiles that may be referenced by another buffer and must be copied before write
+        self.shared: set[tuple[int, int]] = set()
+        # Tiles not decoded yet, by key. Loaders return the tile's raw bytes
+        self.lazy: dict[tuple[int, int], Callable[[], bytes]] = {}
+
+    @classmethod
+    def from_bytes(cls, width: int, height: int, data: bytes) -> PixelBuffer:
+        """Create buffer from tightly packed RGBA bytes"""
+        if len(data) != width * height * 4:
+            raise ValueError(
+                f"Expected {width * height * 4} bytes for {width}x{height}, got {len(data)}"
+            )
+        buffer: PixelBuffer = cls(width, height)
+        buffer.write_bytes(0, 0, width, height, data)
+        return buffer
+
+    @classmethod
+    def from_rows(
+        cls,
+        width: int,
+        height: int,
+        pixels: bytes,
+        rowstride: int,
+        n_channels: int = 4,
+    ) -> PixelBuffer:
+        """Create buffer from RGB or RGBA rows with padding (e.g. GdkPixbuf pixels)"""
+        return cls.from_bytes(
+            width, height, pack_rows(width, height, pixels, rowstride, n_channels)
+        )
+
+    def in_bounds(self, x: int, y: int) -> bool:
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def tile(self, key: tuple[int, int]) -> bytes:
+        """Get tile for reading. Lazy tiles are decoded, unallocated ones are the background"""
+        tile: bytearray = self.tiles.get(key)
+        if tile is None:
+            loader: Callable[[], bytes] = self.lazy.pop(key, None)
+            if loader is None:
+                return self.background
+            tile = self.tiles[key] = bytearray(loader())
+        return tile
+
+    def __writable_tile(self, key: tuple[int, int]) -> bytearray:
+        """Get tile for writing, allocating or un-sharing it first"""
+        tile: bytearray = self.tiles.get(key)
+        if tile is None:
+            tile = self.tile(key)
+            if tile is self.background:
+                tile = self.tiles[key] = bytearray(self.background)
+        elif key in self.shared:
+            tile = self.tiles[key] = bytearray(tile)
+            self.shared.discard(key)
+        return tile
+
+    def __tile_spans(self, x: int, y: int, w: int, h: int):
+        """
+        Split rectangle into parts covered by single tiles.
+        Yields tile key and part's x, y, w, h in canvas coordinates
+        """
+        for ty in range(y // TILE_SIZE, (y + h - 1) // TILE_SIZE + 1):
+            y0: int = max(y, ty * TILE_SIZE)
+            y1: int = min(y + h, (ty + 1) * TILE_SIZE)
+            for tx in range(x // TILE_SIZE, (x + w - 1) // TILE_SIZE + 1):
+                x0: int = max(x, tx * TILE_SIZE)
+                x1: int = min(x + w, (tx + 1) * TILE_SIZE)
+                yield (tx, ty), x0, y0, x1 - x0, y1 - y0
+
+    def get_raw(self, x: int, y: int) -> int:
+        tx, px = divmod(x, TILE_SIZE)
+        ty, py = divmod(y, TILE_SIZE)
+        bpp: int = self.bpp
+        offset: int = (py * TILE_SIZE + px) * bpp
+        tile: bytes = self.tiles.get((tx, ty)) or self.tile((tx, ty))
+        return int.from_bytes(tile[offset : offset + bpp], "big")
+
+    def set_raw(self, x: int, y: int, value: int) -> None:
+        tx, px = divmod(x, TILE_SIZE)
+        ty, py = divmod(y, TILE_SIZE)
+        bpp: int = self.bpp
+        offset: int = (py * TILE_SIZE + px) * bpp
+        self.__writable_tile((tx, ty))[offset : offset + bpp] = value.to_bytes(bpp, "big")
+
+    get = get_raw
+    set = set_raw
+
+    def to_value(self, color: int) -> int:
+        """Raw value storing color"""
+        return color
+
+    def clip_rect(self, x: int, y: int, w: int, h: int) -> tuple[int, int, int, int]:
+        """Clip rectangle to buffer bounds. Returned width or height may be 0"""
+        x0, y0 = max(x, 0), max(y, 0)
+        x1, y1 = min(x + w, self.width), min(y + h, self.height)
+        return x0, y0, max(x1 - x0, 0), max(y1 - y0, 0)
+
+    def fill_raw(self, x: int, y: int, w: int, h: int, value: int) -> None:
+        x, y, w, h = self.clip_rect(x, y, w, h)
+        if not w or not h:
+            return
+        bpp: int = self.bpp
+        pixel: bytes = value.to_bytes(bpp, "big")
+        for key, x0, y0, pw, ph in self.__tile_spans(x, y, w, h):
+            if pw == TILE_SIZE and ph == TILE_SIZE:
+                # Whole tile is covered. Background colored tiles are freed
+                self.shared.discard(key)
+                self.lazy.pop(key, None)
+                if value == self.fill:
+                    self.tiles.pop(key, None)
+                else:
+                    self.tiles[key] = bytearray(pixel * (TILE_SIZE * TILE_SIZE))
+                continue
+            tile: bytearray = self.__writable_tile(key)
+            row: bytes = pixel * pw
+            start: int = ((y0 % TILE_SIZE) * TILE_SIZE + x0 % TILE_SIZE) * bpp
+            for i in range(ph):
+                offset: int = start + i * TILE_SIZE * bpp
+                tile[offset : offset + pw * bpp] = row
+
+    def raw_region(self, x: int, y: int, w: int, h: int) -> bytes:
+        """Get packed raw bytes of region. Region must be inside the buffer"""
+        bpp: int = self.bpp
+        out: bytearray = bytearray(w * h * bpp)
+        row_len: int = w * bpp
+        for key, x0, y0, pw, ph in self.__tile_spans(x, y, w, h):
+            tile: bytes = self.tile(key)
+            src: int = ((y0 % TILE_SIZE) * TILE_SIZE + x0 % TILE_SIZE) * bpp
+            dst: int = (y0 - y) * row_len + (x0 - x) * bpp
+            for _ in range(ph):
+                out[dst : dst + pw * bpp] = tile[src : src + pw * bpp]
+                src += TILE_SIZE * bpp
+                dst += row_len
+        return bytes(out)
+
+    def write_raw(self, x: int, y: int, w: int, h: int, data: bytes) -> None:
+        """Write packed raw bytes to region. Region must be inside the buffer"""
+        bpp: int = self.bpp
+        row_len: int = w * bpp
+        for key, x0, y0, pw, ph in self.__tile_spans(x, y, w, h):
+            if pw == TILE_SIZE and ph == TILE_SIZE:
+                # Whole tile is replaced, no need to copy or decode the old one
+                self.shared.discard(key)
+                self.lazy.pop(key, None)
+                tile: bytearray = bytearray(TILE_SIZE * TILE_SIZE * bpp)
+                self.tiles[key] = tile
+            else:
+                tile: bytearray = self.__writable_tile(key)
+            src: int = (y0 - y) * row_len + (x0 - x) * bpp
+            dst: int = ((y0 % TILE_SIZE) * TILE_SIZE + x0 % TILE_SIZE) * bpp
+            for _ in range(ph):
+                tile[dst : dst + pw * bpp] = data[src : src + pw * bpp]
+                src += row_len
+                dst += TILE_SIZE * bpp
+
+    # Raw values are the packed colors
+    fill_rect = fill_raw
+    region_bytes = raw_region
+    write_bytes = write_raw
+
+    def argb32_region(self, x: int, y: int, w: int, h: int) -> bytearray:
+        """Get region as cairo FORMAT_ARGB32 bytes. Region must be inside the buffer"""
+        return rgba_to_argb32(self.region_bytes(x, y, w, h))
+
+    def sampled_raw(self, width: int, height: int) -> bytes:
+        """Raw bytes of the buffer downscaled to width x height, sampling pixel centers"""
+        bpp: int = self.bpp
+        xs: list[int] = [(2 * i + 1) * self.width // (2 * width) for i in range(width)]
+        ys: list[int] = [(2 * i + 1) * self.height // (2 * height) for i in range(height)]
+        return b"".join(self.get_raw(x, y).to_bytes(bpp, "big") for y in ys for x in xs)
+
+    def sampled_argb32(self, width: int, height: int) -> bytearray:
+        """`sampled_raw` as cairo FORMAT_ARGB32 bytes"""
+        return rgba_to_argb32(self.sampled_raw(width, height))
+
+    def get_region(self, x: int, y: int, w: int, h: int) -> PixelBuffer:
+        x, y, w, h = self.clip_rect(x, y, w, h)
+        return PixelBuffer.from_bytes(w, h, self.region_bytes(x, y, w, h))
+
+    def put_region(self, x: int, y: int, region: PixelBuffer) -> None:
+        """Copy region into buffer at position. Parts outside the buffer are dropped"""
+        cx, cy, w, h = self.clip_rect(x, y, region.width, region.height)
+        if not w or not h:
+            return
+        self.write_bytes(cx, cy, w, h, region.region_bytes(cx - x, cy - y, w, h))
+
+    def scaled(self, factor: int) -> PixelBuffer:
+        """Nearest neighbour upscale by integer factor"""
+        if factor == 1:
+            return self.copy()
+        pixels: array = array("I", self.to_bytes())
+        # Repeat every pixel `factor` times horizontally
+        wide: array = array("I", bytes(len(pixels) * 4 * factor))
+        for i in range(factor):
+            wide[i::factor] = pixels
+        # Repeat every row `factor` times vertically
+        wide_bytes: bytes = wide.tobytes()
+        stride: int = self.width * 4 * factor
+        data: bytes = b"".join(
+            wide_bytes[y * stride : (y + 1) * stride] * factor
+            for y in range(self.height)
+        )
+        return PixelBuffer.from_bytes(self.width * factor, self.height * factor, data)
+
+    def to_bytes(self) -> bytes:
+        return self.region_bytes(0, 0, self.width, self.height)
+
+    def blank(self, fill: int = None) -> PixelBuffer:
+        """Empty buffer of the same size and kind, filled with raw value or own fill"""
+        return PixelBuffer(self.width, self.height, self.fill if fill is None else fill)
+
+    def copy(self) -> PixelBuffer:
+        """Copy-on-write copy. Only tile references are copied"""
+        buffer: PixelBuffer = self.blank()
+        buffer.tiles = dict(self.tiles)
+        self.shared.update(self.tiles)
+        buffer.shared = set(self.tiles)
+        buffer.lazy = dict(self.lazy)
+        return buffer
+
+    def memory_usage(self) -> int:
+        """Bytes used by allocated tiles. Lazy tiles use no memory until decoded"""
+        return len(self.tiles) * TILE_SIZE * TILE_SIZE * self.bpp
@@ -0,0 +1,398 @@
+from __future__ import annotations
+
+import os
+import struct
+import zlib
+from typing import Callable
+
+from array import array
+
+from indexed import IndexedPixelBuffer
+from pixel_buffer import PixelBuffer, pack_rows, unpack_color
+
+PNG_SIGNATURE: bytes = b"\x89PNG\r\n\x1a\n"
+# Color types of 8-bit RGBA and palette images
+COLOR_RGBA: int = 6
+COLOR_INDEXED: int = 3
+# Rows compressed between progress reports
+ROWS_PER_BLOCK: int = 64
+# Samples per pixel by color type
+_CHANNELS: dict[int, int] = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+
+class PngError(Exception):
+    pass
+
+
+def _chunk(tag: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + tag
+        + data
+        + struct.pack(">I", zlib.crc32(tag + data))
+    )
+
+
+def write_png(
+    path: str,
+    width: int,
+    height: int,
+    rows: Callable[[int, int], bytes],
+    progress: Callable[[float], None] = None,
+    level: int = 6,
+    palette: list[int] = None,
+) -> None:
+    """
+    Write 8-bit RGBA PNG. `rows(y, count)` returns packed RGBA bytes of rows.
+    With a `palette` of packed colors the PNG is indexed and rows are index bytes.
+    Rows are compressed in blocks, so memory use doesn't depend on image height.
+    The file is written next to `path` and moved over it only when complete.
+    `progress` is called with the written fraction and may raise to cancel.
+    """
+    temp_path: str = path + ".tmp"
+    try:
+        with open(temp_path, "wb") as file:
+            file.write(PNG_SIGNATURE)
+            color_type: int = COLOR_INDEXED if palette else COLOR_RGBA
+            file.write(
+                _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+            )
+            if palette:
+                channels: list[tuple[int, int, int, int]] = [unpack_color(c) for c in palette]
+                file.write(_chunk(b"PLTE", bytes(c for rgba in channels for c in rgba[:3])))
+                # Alpha of entries, trailing opaque ones may be left out
+                alpha: bytes = bytes(rgba[3] for rgba in channels).rstrip(b"\xff")
+                if alpha:
+                    file.write(_chunk(b"tRNS", alpha))
+            compressor = zlib.compressobj(level)
+            row_len: int = width * (1 if palette else 4)
+            for y in range(0, height, ROWS_PER_BLOCK):
+                count: int = min(ROWS_PER_BLOCK, height - y)
+                data: bytes = rows(y, count)
+                # Every row starts with filter type 0 (none)
+                block: bytes = b"".join(
+                    b"\x00" + data[i * row_len : (i + 1) * row_len] for i in range(count)
+                )
+                compressed: bytes = compressor.compress(block)
+                if compressed:
+                    file.write(_chunk(b"IDAT", compressed))
+                if progress:
+                    progress((y + count) / height)
+            file.write(_chunk(b"IDAT", compressor.flush()))
+            file.write(_chunk(b"IEND", b""))
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_buffer(
+    path: str,
+    buffer: PixelBuffer,
+    progress: Callable[[float], None] = None,
+    scale: int = 1,
+) -> None:
+    """
+    Write pixel buffer as PNG, indexed for indexed buffers.
+    Upscaling by integer `scale` is done per block of rows while writing
+    """
+    bpp: int = buffer.bpp
+    width: int = buffer.width
+
+    def rows(y: int, count: int) -> bytes:
+        if scale == 1:
+            return buffer.raw_region(0, y, width, count)
+        # Source rows covering the output rows
+        y0, y1 = y // scale, (y + count - 1) // scale + 1
+        data: bytes = buffer.raw_region(0, y0, width, y1 - y0)
+        # Repeat every pixel `scale` times horizontally
+        pixels: array = array("B" if bpp == 1 else "I", data)
+        wide: array = array(pixels.typecode, bytes(len(data) * scale))
+        for i in range(scale):
+            wide[i::scale] = pixels
+        wide_bytes: bytes = wide.tobytes()
+        # Repeat every row as many times as it's in the output range
+        stride: int = width * bpp * scale
+        return b"".join(
+            wide_bytes[(row // scale - y0) * stride : (row // scale - y0 + 1) * stride]
+            for row in range(y, y + count)
+        )
+
+    write_png(
+        path,
+        width * scale,
+        buffer.height * scale,
+        rows,
+        progress,
+        palette=buffer.palette.colors if isinstance(buffer, IndexedPixelBuffer) else None,
+    )
+
+
+def _add_bytes(a: bytes, b: bytes) -> bytes:
+    """Bytewise sum modulo 256 of equal length byte strings, as big integer operations"""
+    n: int = len(a)
+    x, y = int.from_bytes(a, "little"), int.from_bytes(b, "little")
+    low: int = int.from_bytes(b"\x7f" * n, "little")
+    # Low 7 bits can't carry past their byte, top bits are added without carry by XOR
+    return (((x & low) + (y & low)) ^ ((x ^ y) & (low << 1 & ~low))).to_bytes(n, "little")
+
+
+def _unfilter_row(kind: int, line: bytes, prev: bytes, bpp: int) -> bytes:
+    """Undo filter of one row given the unfiltered previous row"""
+    stride: int = len(line)
+    if kind == 0:
+        return line
+    if kind == 1:
+        # Prefix sum of pixels in log2(width) whole row additions
+        shift: int = bpp
+        while shift < stride:
+            line = _add_bytes(line, bytes(shift) + line[:-shift])
+            shift *= 2
+        return line
+    if kind == 2:
+        return _add_bytes(line, prev)
+    line = bytearray(line)
+    if kind == 3:
+        for i in range(stride):
+            left: int = line[i - bpp] if i >= bpp else 0
+            line[i] = (line[i] + ((left + prev[i]) >> 1)) & 0xFF
+    else:
+        for i in range(stride):
+            a: int = line[i - bpp] if i >= bpp else 0
+            b: int = prev[i]
+            c: int = prev[i - bpp] if i >= bpp else 0
+            p: int = a + b - c
+            pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+            predictor: int = a if pa <= pb and pa <= pc else b if pb <= pc else c
+            line[i] = (line[i] + predictor) & 0xFF
+    return line
+
+
+# Runs of Average and Paeth filtered rows with at least this many bytes per
+# pixel column are unfiltered by diagonals. Shorter runs are faster byte by byte
+_MIN_DIAGONAL_BYTES: int = 64
+# Row masks by filter type, 1 in rows of that type
+_TYPE_TABLES: list[bytes] = [bytes(v == kind for v in range(256)) for kind in range(5)]
+
+
+def _widen(data: bytes) -> int:
+    """Bytes as an integer of 16-bit lanes, so lanes can be added and subtracted"""
+    wide: bytearray = bytearray(len(data) * 2)
+    wide[0::2] = data
+    return int.from_bytes(wide, "little")
+
+
+def _lane_distance(u: int, v: int, ones: int, high: int) -> int:
+    """|u - v| in every 16-bit lane of values below 0x8000. `high` is `ones << 15`"""
+    # Difference in two's complement, negated where it's negative
+    d: int = (u | high) - v
+    negative: int = (d & high) >> 15 ^ ones
+    return ((d ^ high) ^ negative * 0xFFFF) + negative
+
+
+def _lane_at_most(u: int, v: int, high: int) -> int:
+    """1 in 16-bit lanes where u <= v, 0 elsewhere. `high` is bit 15 of every lane"""
+    return ((v | high) - u & high) >> 15
+
+
+def _unfilter_diagonals(
+    rows: bytearray, stride: int, bpp: int, kinds: bytes, prev: bytes
+) -> None:
+    """
+    Undo Average and Paeth filters of rows, in place, given the unfiltered previous row.
+
+    Both predict a byte from its unfiltered left, upper and upper left
+    neighbours, so a row can't be processed at once. Pixels on an anti
+    diagonal don't depend on each other though: they are gathered with
+    strided slices and unfiltered together as 16-bit lanes of big integers.
+    """
+    height: int = len(kinds)
+    width: int = stride // bpp
+    # Rows padded with one zero pixel on the left, below the previous row, so
+    # neighbours outside the image read as 0
+    padded_stride: int = stride + bpp
+    padded: bytearray = bytearray(padded_stride * (height + 1))
+    for y in range(-1, height):
+        start: int = (y + 1) * padded_stride + bpp
+        padded[start : start + stride] = prev if y == -1 else rows[y * stride : (y + 1) * stride]
+    # Lane constants by number of lanes
+    constants: dict[int, tuple[int, int, int]] = {}
+
+    for t in range(width + height - 1):
+        y0, y1 = max(0, t - width + 1), min(t, height - 1)
+        n: int = y1 - y0 + 1
+        # Byte k of pixel (t - y, y) is at start + k + y * stride. Lanes hold
+        # byte 0 of every pixel, then byte 1 and so on
+        start = padded_stride + (t + 1) * bpp + y0 * stride
+        stop: int = start + (n - 1) * stride + 1
+        lanes: list[tuple[int, int]] = [
+            (start + k, stop + k) for k in range(bpp)
+        ]
+        x, a, b, c = (
+            _widen(b"".join(padded[i - offset : j - offset : stride] for i, j in lanes))
+            for offset in (0, bpp, padded_stride, padded_stride + bpp)
+        )
+        if n * bpp not in constants:
+            ones: int = int.from_bytes(b"\x01\x00" * (n * bpp), "little")
+            constants[n * bpp] = (ones, ones << 15, ones * 0xFF)
+        ones, high, low = constants[n * bpp]
+        types: bytes = kinds[y0 : y1 + 1] * bpp
+
+        predictor: int = 0
+        if 3 in types:
+            average: int = (a + b) >> 1 & low
+            predictor |= average & _widen(types.translate(_TYPE_TABLES[3])) * 0xFFFF
+        if 4 in types:
+            pa: int = _lane_distance(b, c, ones, high)
+            pb: int = _lane_distance(a, c, ones, high)
+            pc: int = _lane_distance(a + b, c + c, ones, high)
+            choose_a: int = _lane_at_most(pa, pb, high) & _lane_at_most(pa, pc, high)
+            choose_b: int = (choose_a ^ ones) & _lane_at_most(pb, pc, high)
+            choose_c: int = (choose_a | choose_b) ^ ones
+            paeth: int = a & choose_a * 0xFFFF | b & choose_b * 0xFFFF | c & choose_c * 0xFFFF
+            predictor |= paeth & _widen(types.translate(_TYPE_TABLES[4])) * 0xFFFF
+
+        result: bytes = ((x + predictor) & low).to_bytes(n * bpp * 2, "little")[0::2]
+        for k, (i, j) in enumerate(lanes):
+            padded[i:j:stride] = result[k * n : (k + 1) * n]
+
+    for y in range(height):
+        start = (y + 1) * padded_stride + bpp
+        rows[y * stride : (y + 1) * stride] = padded[start : start + stride]
+
+
+def _unfilter(data: bytes, stride: int, height: int, bpp: int) -> bytearray:
+    """
+    Undo per-row filters. `bpp` is bytes per complete pixel, at least 1.
+    None, Sub and Up rows are unfiltered as whole rows, longer runs of Average
+    and Paeth rows by diagonals
+    """
+    kinds: bytes = data[0 : (stride + 1) * height : stride + 1]
+    if max(kinds, default=0) > 4:
+        raise PngError(f"Unknown filter type {max(kinds)}")
+    out: bytearray = bytearray(stride * height)
+    for y in range(height):
+        out[y * stride : (y + 1) * stride] = data[
+            y * (stride + 1) + 1 : (y + 1) * (stride + 1)
+        ]
+    prev: bytes = bytes(stride)
+    y: int = 0
+    while y < height:
+        end: int = y
+        while end < height and kinds[end] >= 3:
+            end += 1
+        if (end - y) * bpp >= _MIN_DIAGONAL_BYTES and stride > bpp:
+            run: bytearray = out[y * stride : end * stride]
+            _unfilter_diagonals(run, stride, bpp, kinds[y:end], prev)
+            out[y * stride : end * stride] = run
+            prev = run[-stride:]
+            y = end
+            continue
+        line: bytes = _unfilter_row(kinds[y], out[y * stride : (y + 1) * stride], prev, bpp)
+        out[y * stride : (y + 1) * stride] = line
+        prev = line
+        y += 1
+    return out
+
+
+def _unpack_bits(data: bytes, width: int, height: int, stride: int, depth: int) -> bytes:
+    """Expand 1, 2 or 4 bit samples to one byte each"""
+    per_byte: int = 8 // depth
+    mask: int = (1 << depth) - 1
+    table: list[bytes] = [
+        bytes((b >> (8 - depth * (i + 1))) & mask for i in range(per_byte)) for b in range(256)
+    ]
+    return b"".join(
+        b"".join(table[b] for b in data[y * stride : (y + 1) * stride])[:width]
+        for y in range(height)
+    )
+
+
+def _key_transparency(rgba: bytearray, key: bytes) -> None:
+    """Clear alpha of pixels with the tRNS key color"""
+    pattern: bytes = key + b"\xff"
+    i: int = rgba.find(pattern)
+    while i != -1:
+        if i % 4 == 0:
+            rgba[i + 3] = 0
+        i = rgba.find(pattern, i + 1)
+
+
+def read_png(path: str) -> tuple[int, int, bytes]:
+    """
+    Decode PNG without GdkPixbuf, e.g. in headless batch processing.
+    Supports every bit depth and color type of non-interlaced images.
+    Returns width, height and packed RGBA bytes
+    """
+    with open(path, "rb") as file:
+        data: bytes = file.read()
+    if data[:8] != PNG_SIGNATURE:
+        raise PngError(f"{path} is not a PNG image")
+
+    chunks: dict[bytes, bytes] = {}
+    idat: list[bytes] = []
+    pos: int = 8
+    while pos + 8 <= len(data):
+        (length,) = struct.unpack_from(">I", data, pos)
+        tag: bytes = data[pos + 4 : pos + 8]
+        if tag == b"IDAT":
+            idat.append(data[pos + 8 : pos + 8 + length])
+        else:
+            chunks.setdefault(tag, data[pos + 8 : pos + 8 + length])
+        pos += length + 12
+        if tag == b"IEND":
+            break
+
+    width, height, depth, color_type, _, _, interlace = struct.unpack(
+        ">IIBBBBB", chunks[b"IHDR"]
+    )
+    if interlace:
+        raise PngError(f"{path}: interlaced PNG is not supported")
+    if color_type not in _CHANNELS:
+        raise PngError(f"{path}: unknown color type {color_type}")
+    channels: int = _CHANNELS[color_type]
+    stride: int = (width * channels * depth + 7) // 8
+    pixels: bytes = _unfilter(
+        zlib.decompress(b"".join(idat)), stride, height, max(1, channels * depth // 8)
+    )
+
+    # Down to one byte per sample
+    if depth == 16:
+        pixels = pixels[0::2]
+    elif depth < 8:
+        pixels = _unpack_bits(pixels, width, height, stride, depth)
+        if color_type == 0:
+            pixels = pixels.translate(
+                bytes(min(v * 255 // ((1 << depth) - 1), 255) for v in range(256))
+            )
+    trns: bytes = chunks.get(b"tRNS", b"")
+    # Gray and RGB transparency keys are 16-bit samples, keep the used byte
+    key: bytes = trns[0::2] if depth == 16 else trns[1::2]
+
+    n: int = width * height
+    if color_type == 6:
+        return width, height, bytes(pixels)
+    if color_type == 3:
+        plte: bytes = chunks[b"PLTE"]
+        tables: list[bytes] = [plte[c::3].ljust(256, b"\x00") for c in range(3)]
+        tables.append(trns.ljust(len(plte) // 3, b"\xff").ljust(256, b"\x00"))
+        rgba: bytearray = bytearray(n * 4)
+        for c, table in enumerate(tables):
+            rgba[c::4] = pixels.translate(table)
+        return width, height, bytes(rgba)
+
+    rgba: bytearray = bytearray(n * 4)
+    if color_type == 2:
+        rgba[:] = pack_rows(width, height, pixels, width * 3, 3)
+        if key:
+            _key_transparency(rgba, key)
+    else:
+        gray: bytes = pixels if color_type == 0 else pixels[0::2]
+        rgba[0::4] = rgba[1::4] = rgba[2::4] = gray
+        rgba[3::4] = b"\xff" * n if color_type == 0 else pixels[1::2]
+        if color_type == 0 and key:
+            value: int = key[0]
+            if depth < 8:
+                value = value * 255 // ((1 << depth) - 1)
+            _key_transparency(rgba, bytes([value]) * 3)
+    return width, height, bytes(rgba)
@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from collections import Counter
+
+from pixel_buffer import pixel_to_color
+
+# Keep the top 5 bits of every channel before quantising. Merges near-identical
+# colors so the median cut works on at most 2^20 distinct values. The top bits
+# are repeated in the low ones, so 0 and 255 (e.g. opaque alpha) stay unchanged
+_PRE_QUANTIZE: bytes = bytes((v & 0xF8) | (v >> 5) for v in range(256))
+
+
+def _count(data: bytes, step: int = 1) -> Counter[int]:
+    """
+    Count colors of every `step`-th pixel of RGBA bytes. Pixels are counted
+    as native 32-bit values and only the distinct ones are converted to colors.
+    Fully transparent pixels don't make palette colors, whatever their RGB
+    """
+    counts: Counter[int] = Counter()
+    for value, count in Counter(memoryview(data).cast("I")[::step]).items():
+        color: int = pixel_to_color(value)
+        if color & 0xFF:
+            counts[color] += count
+    return counts
+
+
+def median_cut(counts: dict[int, int], max_colors: int) -> list[int]:
+    """
+    Reduce weighted colors to at most `max_colors` with median cut.
+    The box with the widest channel range (weighted by pixel count) is split
+    at the weighted median of that channel until there are enough boxes.
+    Returns the weighted mean color of every box, most used first
+    """
+
+    def channels(color: int) -> tuple[int, int, int, int]:
+        return (color >> 24) & 0xFF, (color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF
+
+    def make_box(items: list[tuple[tuple[int, int, int, int], int]]) -> tuple:
+        weight: int = sum(count for _, count in items)
+        ranges: list[int] = [
+            max(c[i] for c, _ in items) - min(c[i] for c, _ in items) for i in range(4)
+        ]
+        channel: int = max(range(4), key=ranges.__getitem__)
+        return ranges[channel] * weight, channel, weight, items
+
+    boxes: list[tuple] = [make_box([(channels(c), n) for c, n in counts.items()])]
+    while len(boxes) < max_colors:
+        index: int = max(range(len(boxes)), key=lambda i: boxes[i][0])
+        score, channel, weight, items = boxes[index]
+        if not score:
+            break  # Every box holds a single color
+        items.sort(key=lambda item: item[0][channel])
+        # Split at the weighted median, keeping both halves non-empty
+        half: int = weight // 2
+        total: int = 0
+        split: int = 1
+        for split, (_, count) in enumerate(items[:-1], 1):
+            total += count
+            if total >= half:
+                break
+        boxes[index] = make_box(items[:split])
+        boxes.append(make_box(items[split:]))
+
+    colors: list[tuple[int, int]] = []
+    for _, _, weight, items in boxes:
+        mean: list[int] = [
+            round(sum(c[i] * n for c, n in items) / weight) for i in range(4)
+        ]
+        colors.append(((mean[0] << 24) | (mean[1] << 16) | (mean[2] << 8) | mean[3], weight))
+    colors.sort(key=lambda item: -item[1])
+    return [color for color, _ in colors]
+
+
+def extract_palette(data: bytes, max_colors: int = 32, max_samples: int = 1 << 20) -> list[int]:
+    """
+    Palette of RGBA bytes, most used colors first.
+    Images above `max_samples` pixels are counted from evenly strided samples.
+    Images with at most `max_colors` colors keep their exact colors, others are
+    pre-quantised to 5 bits per channel and reduced with median cut.
+    """
+    step: int = max(1, len(data) // 4 // max_samples)
+    counts: Counter[int] = _count(data, step)
+    if len(counts) <= max_colors and step > 1:
+        # Sampling may have skipped rare colors. A set of all pixels finds them
+        for value in set(memoryview(data).cast("I")):
+            color: int = pixel_to_color(value)
+            if color & 0xFF and color not in counts:
+                counts[color] = 1
+    if len(counts) <= max_colors:
+        return [color for color, _ in counts.most_common()]
+
+    sampled: bytes = memoryview(data).cast("I")[::step].tobytes()
+    return median_cut(_count(sampled.translate(_PRE_QUANTIZE)), max_colors)
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from math import sqrt
+
+from fill import spans_to_rects
+from pixel_buffer import PixelBuffer
+
+# Shapes are rasterised into horizontal spans (y, x0, x1) with exclusive x1
+
+
+def line_points(x0: int, y0: int, x1: int, y1: int) -> list[tuple[int, int]]:
+    """Bresenham's line algorithm"""
+    points: list[tuple[int, int]] = []
+    dx: int = abs(x1 - x0)
+    dy: int = abs(y1 - y0)
+    sx: int = 1 if x0 < x1 else -1
+    sy: int = 1 if y0 < y1 else -1
+    err: int = dx - dy
+
+    while True:
+        points.append((x0, y0))
+        if (x0 == x1) and (y0 == y1):
+            break
+        e2: int = 2 * err
+        if e2 > -dy:
+            err -= dy
+            x0 += sx
+        if e2 < dx:
+            err += dx
+            y0 += sy
+    return points
+
+
+def line_spans(x0: int, y0: int, x1: int, y1: int) -> list[tuple[int, int, int]]:
+    """Line as spans. Horizontal runs of points are joined"""
+    spans: list[tuple[int, int, int]] = []
+    for x, y in sorted(line_points(x0, y0, x1, y1), key=lambda p: (p[1], p[0])):
+        if spans and spans[-1][0] == y and spans[-1][2] == x:
+            spans[-1] = (y, spans[-1][1], x + 1)
+        else:
+            spans.append((y, x, x + 1))
+    return spans
+
+
+def _normalize(x0: int, y0: int, x1: int, y1: int) -> tuple[int, int, int, int]:
+    return min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)
+
+
+def rectangle_spans(
+    x0: int, y0: int, x1: int, y1: int, filled: bool = False
+) -> list[tuple[int, int, int]]:
+    """Rectangle between two corner pixels (inclusive)"""
+    x0, y0, x1, y1 = _normalize(x0, y0, x1, y1)
+    if filled or x1 - x0 < 2 or y1 - y0 < 2:
+        return [(y, x0, x1 + 1) for y in range(y0, y1 + 1)]
+    spans: list[tuple[int, int, int]] = [(y0, x0, x1 + 1)]
+    for y in range(y0 + 1, y1):
+        spans.append((y, x0, x0 + 1))
+        spans.append((y, x1, x1 + 1))
+    spans.append((y1, x0, x1 + 1))
+    return spans
+
+
+def ellipse_spans(
+    x0: int, y0: int, x1: int, y1: int, filled: bool = False
+) -> list[tuple[int, int, int]]:
+    """Ellipse inscribed in rectangle between two corner pixels (inclusive)"""
+    x0, y0, x1, y1 = _normalize(x0, y0, x1, y1)
+    # Radii and center in pixel edge coordinates
+    a: float = (x1 - x0 + 1) / 2
+    b: float = (y1 - y0 + 1) / 2
+    cx: float = x0 + a
+    cy: float = y0 + b
+
+    # Filled extent of every row, sampled at the row's center
+    rows: list[tuple[int, int]] = []
+    for y in range(y0, y1 + 1):
+        dy: float = (y + 0.5 - cy) / b
+        half: float = a * sqrt(max(1 - dy * dy, 0))
+        left: int = max(round(cx - half), x0)
+        right: int = min(round(cx + half), x1 + 1)
+        if right <= left:
+            # Keep thin tips connected
+            left, right = int(cx - 0.5), int(cx - 0.5) + 1
+        rows.append((left, right))
+
+    if filled:
+        return [(y0 + i, left, right) for i, (left, right) in enumerate(rows)]
+
+    # Outline is the filled row minus pixels whose neighbours are all inside
+    spans: list[tuple[int, int, int]] = []
+    for i, (left, right) in enumerate(rows):
+        if 0 < i < len(rows) - 1:
+            inner_left: int = max(rows[i - 1][0], rows[i + 1][0], left + 1)
+            inner_right: int = min(rows[i - 1][1], rows[i + 1][1], right - 1)
+        else:
+            inner_left, inner_right = right, right
+        if inner_left >= inner_right:
+            spans.append((y0 + i, left, right))
+            continue
+        spans.append((y0 + i, left, inner_left))
+        spans.append((y0 + i, inner_right, right))
+    return spans
+
+
+def clip_spans(
+    spans: list[tuple[int, int, int]], width: int, height: int
+) -> list[tuple[int, int, int]]:
+    """Clip spans to buffer size, dropping empty ones"""
+    clipped: list[tuple[int, int, int]] = []
+    for y, x0, x1 in spans:
+        if 0 <= y < height:
+            x0, x1 = max(x0, 0), min(x1, width)
+            if x0 < x1:
+                clipped.append((y, x0, x1))
+    return clipped
+
+
+def write_spans(buffer: PixelBuffer, spans: list[tuple[int, int, int]], color: int) -> None:
+    """Fill spans in buffer. Spans stacking into rectangles are written as one block"""
+    for rect in spans_to_rects(spans):
+        buffer.fill_rect(*rect, color)
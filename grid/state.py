@@ -6,10 +6,14 @@ from gi.repository import Adw, Gtk
 
 if TYPE_CHECKING:
     from palette_bar import PaletteBar
+    from layers_panel import LayersPanel
+    from timeline import Timeline
     from drawing_area import DrawingArea
     from toolbar import Toolbar
     from new_dialog import NewDialog
     from window import Window
+    from history import History
+    from autosave import Autosave
 
 
 class State:
@@ -18,6 +22,11 @@ class State:
     application: Adw.Application = None
     main_window: Window = None
     palette_bar: PaletteBar = None
+    layers_panel: LayersPanel = None
+    timeline: Timeline = None
     drawing_area: DrawingArea = None
     toolbar: Toolbar = None
     new_dialog: NewDialog = None
+    # Document
+    history: History = None
+    autosave: Autosave = None
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import threading
+from typing import Any, Callable
+
+from gi.repository import GLib  # type:ignore
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Task:
+    """
+    Operation running on a worker thread, e.g. loading or saving a file.
+
+    `work` gets a progress function to call with a 0-1 fraction. It raises
+    `Cancelled` once the task was cancelled, so work stops at the next report.
+    `progress`, `done` and `failed` callbacks are called on the main loop.
+    """
+
+    def __init__(
+        self,
+        work: Callable[[Callable[[float], None]], Any],
+        done: Callable[[Any], None],
+        progress: Callable[[float], None] = None,
+        failed: Callable[[BaseException], None] = None,
+    ) -> None:
+        self.work: Callable[[Callable[[float], None]], Any] = work
+        self.done: Callable[[Any], None] = done
+        self.progress: Callable[[float], None] = progress
+        self.failed: Callable[[BaseException], None] = failed
+        self.cancelled: threading.Event = threading.Event()
+        self.__fraction: float = 0.0
+        self.__progress_queued: bool = False
+
+    def start(self) -> None:
+        threading.Thread(target=self.__run, daemon=True).start()
+
+    def cancel(self) -> None:
+        self.cancelled.set()
+
+    def __report(self, fraction: float) -> None:
+        """Called by the worker. Progress updates are coalesced into one idle callback"""
+        if self.cancelled.is_set():
+            raise Cancelled()
+        self.__fraction = fraction
+        if self.progress and not self.__progress_queued:
+            self.__progress_queued = True
+            GLib.idle_add(self.__on_progress)
+
+    def __on_progress(self) -> bool:
+        self.__progress_queued = False
+        self.progress(self.__fraction)
+        return GLib.SOURCE_REMOVE
+
+    def __run(self) -> None:
+        try:
+            result: Any = self.work(self.__report)
+        except BaseException as e:
+            if self.failed:
+                GLib.idle_add(self.__finish, self.failed, e)
+            return
+        if self.cancelled.is_set():
+            if self.failed:
+                GLib.idle_add(self.__finish, self.failed, Cancelled())
+            return
+        GLib.idle_add(self.__finish, self.done, result)
+
+    def __finish(self, callback: Callable[[Any], None], value: Any) -> bool:
+        callback(value)
+        return GLib.SOURCE_REMOVE
@@ -0,0 +1,247 @@
+import cairo
+from gi.repository import Gdk, GLib, Gtk  # type:ignore
+
+from document import Document
+from layers import LayerStack
+from shared import Box, Button
+from state import State
+
+
+class FrameThumbnail(Gtk.DrawingArea):
+    size: int = 48
+
+    def __init__(self, index: int) -> None:
+        super().__init__(
+            content_width=self.size,
+            content_height=self.size,
+            css_classes=["frame-thumbnail"],
+            tooltip_text=f"Frame {index + 1}",
+        )
+        self.index: int = index
+        # Frame, its version and size the thumbnail was rendered for, and the thumbnail
+        self.__cached: tuple[LayerStack, int, tuple[int, int], cairo.ImageSurface] = None
+        self.set_draw_func(self.__on_draw)
+        click_ctrl: Gtk.GestureClick = Gtk.GestureClick()
+        click_ctrl.connect(
+            "pressed", lambda *_: State.drawing_area.set_frame(self.index)
+        )
+        self.add_controller(click_ctrl)
+
+    def __on_draw(self, _, cr: cairo.Context, width: int, height: int) -> None:
+        # Render the frame at thumbnail size, scaled up to fit keeping pixels sharp
+        document: Document = State.drawing_area.document
+        frame: LayerStack = document.frames[self.index]
+        scale: float = min(
+            width * self.get_scale_factor() / document.width,
+            height * self.get_scale_factor() / document.height,
+            1,
+        )
+        size: tuple[int, int] = (
+            max(round(document.width * scale), 1),
+            max(round(document.height * scale), 1),
+        )
+        if not self.__cached or self.__cached[:3] != (frame, frame.version, size):
+            self.__cached = (frame, frame.version, size, frame.thumbnail(*size))
+        surface: cairo.ImageSurface = self.__cached[3]
+
+        scale = min(width / size[0], height / size[1])
+        cr.translate((width - size[0] * scale) / 2, (height - size[1] * scale) / 2)
+        cr.scale(scale, scale)
+        cr.set_source_surface(surface, 0, 0)
+        cr.get_source().set_filter(cairo.FILTER_NEAREST)
+        cr.paint()
+
+
+class Timeline(Gtk.Box):
+    # Delay before thumbnails of edited frames are redrawn, in ms
+    thumbnail_delay: int = 300
+    __thumbnail_timeout: int = 0
+
+    def __init__(self) -> None:
+        super().__init__()
+        State.timeline = self
+        self.thumbnails: list[FrameThumbnail] = []
+        self.__changed_frames: set[LayerStack] = set()
+        self.__setup_styles()
+        self.__build_ui()
+
+    def __setup_styles(self) -> None:
+        self.styles: str = """
+        .frame-thumbnail {
+            border: solid 2px transparent;
+            border-radius: 4px;
+        }
+
+        .frame-thumbnail.current {
+            border-color: @accent_color;
+        }
+        """
+
+        self.css_provider = Gtk.CssProvider()
+        self.css_provider.load_from_string(self.styles)
+        Gtk.StyleContext.add_provider_for_display(
+            Gdk.Display.get_default(),
+            self.css_provider,
+            Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION,
+        )
+
+    def __build_ui(self) -> None:
+        self.set_spacing(6)
+        self.set_margin_start(6)
+        self.set_margin_end(6)
+        self.set_margin_top(6)
+        self.set_margin_bottom(6)
+        self.set_sensitive(False)
+
+        self.play_btn: Gtk.ToggleButton = Gtk.ToggleButton(
+            icon_name="media-playback-start-symbolic",
+            tooltip_text="Play",
+            valign=Gtk.Align.CENTER,
+        )
+        self.play_btn.connect("toggled", self.__on_play_toggled)
+        self.append(self.play_btn)
+
+        self.fps: Gtk.SpinButton = Gtk.SpinButton.new_with_range(1, 60, 1)
+        self.fps.set_tooltip_text("Frames per Second")
+        self.fps.set_valign(Gtk.Align.CENTER)
+        self.fps.connect("value-changed", self.__on_fps_changed)
+        self.append(self.fps)
+
+        onion_skin_btn: Gtk.ToggleButton = Gtk.ToggleButton(
+            icon_name="grid-onion-skin-symbolic",
+            tooltip_text="Onion Skin",
+            valign=Gtk.Align.CENTER,
+        )
+        onion_skin_btn.connect("toggled", self.__on_onion_skin_toggled)
+        self.append(onion_skin_btn)
+
+        self.append(Gtk.Separator(orientation=Gtk.Orientation.VERTICAL))
+
+        self.frames_box: Gtk.Box = Gtk.Box(spacing=4)
+        self.append(
+            Gtk.ScrolledWindow(
+                child=self.frames_box,
+                hexpand=True,
+                vscrollbar_policy=Gtk.PolicyType.NEVER,
+            )
+        )
+
+        self.append(
+            Box(
+                children=[
+                    Button(
+                        icon_name="list-add-symbolic",
+                        tooltip_text="Add Frame",
+                        on_click=lambda *_: self.__add_frame(False),
+                    ),
+                    Button(
+                        icon_name="edit-copy-symbolic",
+                        tooltip_text="Duplicate Frame",
+                        on_click=lambda *_: self.__add_frame(True),
+                    ),
+                    Button(
+                        icon_name="list-remove-symbolic",
+                        tooltip_text="Remove Frame",
+                        on_click=lambda *_: self.__remove_frame(),
+                    ),
+                    Button(
+                        icon_name="go-previous-symbolic",
+                        tooltip_text="Move Frame Left",
+                        on_click=lambda *_: self.__move_frame(-1),
+                    ),
+                    Button(
+                        icon_name="go-next-symbolic",
+                        tooltip_text="Move Frame Right",
+                        on_click=lambda *_: self.__move_frame(1),
+                    ),
+                ],
+                css_classes=["linked"],
+                valign=Gtk.Align.CENTER,
+            )
+        )
+
+    def update(self) -> None:
+        """Rebuild thumbnails from the drawing area's document"""
+        document: Document = State.drawing_area.document
+        self.set_sensitive(True)
+        self.fps.set_value(document.fps)
+        for thumbnail in self.thumbnails:
+            self.frames_box.remove(thumbnail)
+        self.thumbnails = [FrameThumbnail(i) for i in range(len(document.frames))]
+        for thumbnail in self.thumbnails:
+            self.frames_box.append(thumbnail)
+        self.update_current()
+
+    def update_current(self) -> None:
+        current: int = State.drawing_area.document.current
+        for thumbnail in self.thumbnails:
+            if thumbnail.index == current:
+                thumbnail.add_css_class("current")
+            else:
+                thumbnail.remove_css_class("current")
+
+    def frame_changed(self, frame: LayerStack) -> None:
+        """
+        Schedule thumbnail redraw of a changed frame. Redraws are delayed so
+        a frame being drawn on is not flattened every frame
+        """
+        self.__changed_frames.add(frame)
+        if not self.__thumbnail_timeout:
+            self.__thumbnail_timeout = GLib.timeout_add(
+                self.thumbnail_delay, self.__redraw_thumbnails
+            )
+
+    def __redraw_thumbnails(self) -> bool:
+        self.__thumbnail_timeout = 0
+        frames: list[LayerStack] = State.drawing_area.document.frames
+        for frame in self.__changed_frames:
+            if frame in frames:
+                self.thumbnails[frames.index(frame)].queue_draw()
+        self.__changed_frames.clear()
+        return GLib.SOURCE_REMOVE
+
+    def __on_play_toggled(self, btn: Gtk.ToggleButton) -> None:
+        if btn.get_active():
+            btn.set_icon_name("media-playback-stop-symbolic")
+            State.drawing_area.play()
+        else:
+            btn.set_icon_name("media-playback-start-symbolic")
+            State.drawing_area.stop()
+
+    def __on_fps_changed(self, spin: Gtk.SpinButton) -> None:
+        if State.drawing_area.document:
+            State.drawing_area.document.fps = spin.get_value_as_int()
+
+    def __on_onion_skin_toggled(self, btn: Gtk.ToggleButton) -> None:
+        State.drawing_area.onion_skin = btn.get_active()
+        State.drawing_area.drawing_area.queue_draw()
+
+    def __edit_frames(self, edit) -> None:
+        """Apply change of frame list. Playback is stopped and editing moves to the current frame"""
+        self.play_btn.set_active(False)
+        State.toolbar.current_tool.deactivate()
+        document: Document = State.drawing_area.document
+        document.current_frame.drop_cache()
+        State.history.record_structure(document)
+        edit(document)
+        State.history.commit()
+        self.update()
+        State.drawing_area.redraw_cached_surface()
+        State.layers_panel.update()
+        State.main_window.update_document_info()
+
+    def __add_frame(self, duplicate: bool) -> None:
+        def add(document: Document) -> None:
+            document.current = document.add_frame(duplicate)
+
+        self.__edit_frames(add)
+
+    def __remove_frame(self) -> None:
+        self.__edit_frames(lambda document: document.remove_frame(document.current))
+
+    def __move_frame(self, offset: int) -> None:
+        self.__edit_frames(
+            lambda document: document.move_frame(
+                document.current, document.current + offset
+            )
+        )
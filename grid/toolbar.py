@@ -2,6 +2,17 @@ import cairo
 from gi.repository import Gdk, Gtk, Xdp  # type:ignore
 from state import State
 import utils as Utils
+from fill import flood_fill_spans, spans_bounds
+from layers import LayerStack, StrokeLayer
+from pixel_buffer import TRANSPARENT, PixelBuffer, color_to_rgba, rgba_to_color
+from shapes import (
+    clip_spans,
+    ellipse_spans,
+    line_spans,
+    rectangle_spans,
+    write_spans,
+)
+from shared import Box
 
 
 class ButtonTool(Gtk.Button):
@@ -17,16 +28,40 @@ class ButtonTool(Gtk.Button):
 
 
 class DrawTool(ButtonTool):
+    options_popover: Gtk.Popover = None
+
     def __init__(
         self, tooltip: str = None, icon_name: str = None, shortcut: str = None
     ) -> None:
         super().__init__(tooltip, icon_name, shortcut)
 
     def do_clicked(self) -> None:
+        # Clicking the active tool again shows its options
+        current_tool: DrawTool = getattr(State.toolbar, "current_tool", None)
+        if current_tool is self:
+            self.show_options()
+            return
+        if current_tool:
+            current_tool.deactivate()
         State.toolbar.deactivate_buttons()
         State.toolbar.current_tool = self
         self.add_css_class("toolbar-btn-active")
 
+    def build_options(self) -> Gtk.Widget | None:
+        """Override to return widget with tool options"""
+        return None
+
+    def show_options(self) -> None:
+        if not self.options_popover:
+            options: Gtk.Widget = self.build_options()
+            if not options:
+                return
+            self.options_popover = Gtk.Popover(
+                child=options, position=Gtk.PositionType.LEFT
+            )
+            self.options_popover.set_parent(self)
+        self.options_popover.popup()
+
     def left_click(self, x: int, y: int) -> None: ...
 
     def left_click_hold(self, x: int, y: int) -> None: ...
@@ -41,6 +76,9 @@ class DrawTool(ButtonTool):
 
     def draw_overlay(self, cr: cairo.Context) -> None: ...
 
+    def deactivate(self) -> None:
+        """Called before switching to another tool, undo or loading another image"""
+
 
 class CustomTool: ...
 
@@ -75,14 +113,12 @@ class Zoom(Gtk.Box, CustomTool):
         State.drawing_area.grid_size = min(State.drawing_area.grid_size + 5, 50)
         self.update_zoom_label()
         State.drawing_area.update_canvas_size()
-        State.drawing_area.redraw_cached_surface()
         State.drawing_area.drawing_area.queue_draw()
 
     def on_zoom_out(self, _):
         State.drawing_area.grid_size = max(State.drawing_area.grid_size - 5, 2)
         self.update_zoom_label()
         State.drawing_area.update_canvas_size()
-        State.drawing_area.redraw_cached_surface()
         State.drawing_area.drawing_area.queue_draw()
 
     def update_zoom_label(self):
@@ -91,165 +127,201 @@ class Zoom(Gtk.Box, CustomTool):
 
 
 class Pencil(DrawTool):
-    pixel_data: list[int, int, tuple[float, float, float, float]] = []
-
     def __init__(self) -> None:
         super().__init__("Pencil (P)", "grid-pencil-symbolic", "P")
+        self.stroke: StrokeLayer = StrokeLayer()
+        # Frame showing the stroke as its overlay
+        self.__frame: LayerStack = None
+
+    def __paint(self, x: int, y: int, color: int) -> None:
+        buffer: PixelBuffer = State.drawing_area.pixel_data
+        if not buffer.in_bounds(x, y):
+            return
+        State.history.record(buffer, x, y)
+        buffer.set(x, y, color)
+        # Indexed buffers store the nearest palette color
+        color = buffer.get(x, y)
+        if color & 0xFF == 0xFF:
+            self.stroke.add(x, y, color, buffer.width, buffer.height)
+            self.__frame = State.drawing_area.layers
+            self.__frame.overlay = (self.stroke.surface, *self.stroke.origin)
+            State.drawing_area.mark_overlay_dirty(x, y)
+        else:
+            # Not opaque colors replace canvas pixels, so they can't be drawn over it
+            State.drawing_area.mark_dirty(x, y)
 
     def left_click(self, x: int, y: int):
         if State.drawing_area.left_click_ctrl.get_current_button() == 1:
-            if (
-                0 <= x < State.drawing_area.canvas_size.x
-                and 0 <= y < State.drawing_area.canvas_size.y
-            ):
-                State.drawing_area.pixel_data[y][x] = State.palette_bar.primary_color
-                self.pixel_data.append((x, y, State.palette_bar.primary_color))
-                State.drawing_area.drawing_area.queue_draw()
+            self.__paint(x, y, State.palette_bar.primary_color)
         else:
             self.__draw_new_pixels()
 
     def left_click_hold(self, x: int, y: int) -> None:
-        self.left_click(x, y)
+        # Redraw is requested once per frame by the drawing area
+        self.__paint(x, y, State.palette_bar.primary_color)
+
+    def left_click_release(self, x: int, y: int) -> None:
+        self.__draw_new_pixels()
 
     def right_click(self, x: int, y: int):
         if State.drawing_area.right_click_ctrl.get_current_button() == 3:
-            if (
-                0 <= x < State.drawing_area.canvas_size.x
-                and 0 <= y < State.drawing_area.canvas_size.y
-            ):
-                State.drawing_area.pixel_data[y][x] = State.palette_bar.secondary_color
-                self.pixel_data.append((x, y, State.palette_bar.secondary_color))
-                State.drawing_area.drawing_area.queue_draw()
+            self.__paint(x, y, State.palette_bar.secondary_color)
         else:
             self.__draw_new_pixels()
 
     def right_click_hold(self, x: int, y: int) -> None:
-        self.right_click(x, y)
-
-    def draw_overlay(self, cr: cairo.Context) -> None:
-        for pix in self.pixel_data:
-            cr.set_source_rgba(*pix[2])
-            cr.rectangle(
-                pix[0] * State.drawing_area.grid_size,
-                pix[1] * State.drawing_area.grid_size,
-                State.drawing_area.grid_size,
-                State.drawing_area.grid_size,
-            )
-            cr.fill()
+        self.__paint(x, y, State.palette_bar.secondary_color)
 
-    def __draw_new_pixels(self) -> None:
-        ctx = cairo.Context(State.drawing_area.cached_surface)
-        for pix in self.pixel_data:
-            ctx.set_source_rgba(*pix[2])
-            ctx.rectangle(
-                pix[0] * State.drawing_area.grid_size,
-                pix[1] * State.drawing_area.grid_size,
-                State.drawing_area.grid_size,
-                State.drawing_area.grid_size,
-            )
-            ctx.fill()
-        State.drawing_area.drawing_area.queue_draw()
-        self.pixel_data = []
+    def right_click_release(self, x: int, y: int) -> None:
+        self.__draw_new_pixels()
 
+    def deactivate(self) -> None:
+        # Undo or tool shortcuts can come mid-stroke. Finish it first, so
+        # the overlay isn't left on the frame when the release goes elsewhere
+        self.__draw_new_pixels()
 
-class Line(DrawTool):
+    def __draw_new_pixels(self) -> None:
+        # Pixels are already in the buffer. Merge the stroke into the cached tiles
+        if self.stroke.bounds and self.__frame:
+            x0, y0, x1, y1 = self.stroke.bounds
+            self.__frame.merge_overlay(x0, y0, x1 - x0 + 1, y1 - y0 + 1)
+            State.timeline.frame_changed(self.__frame)
+        self.__frame = None
+        self.stroke.clear()
+        State.history.commit()
+
+
+class ShapeTool(DrawTool):
+    """
+    Base for tools that drag a shape from start to end cell.
+    Shapes are rasterised to spans, previewed from a cached 1:1 surface
+    and written to the buffer as bulk rectangle fills on release.
+    """
+
+    # Whether tool has "Filled" option
+    can_fill: bool = False
+    filled: bool = False
     start_pos: tuple[int, int] = None
     current_pos: tuple[int, int] = None
-
-    def __init__(self):
-        super().__init__("Line (L)", "grid-line-symbolic", "L")
+    color: int = None
+    preview: cairo.ImageSurface = None
+    preview_origin: tuple[int, int] = (0, 0)
+
+    def spans(
+        self, start_pos: tuple[int, int], end_pos: tuple[int, int]
+    ) -> list[tuple[int, int, int]]:
+        """Override to rasterise the shape to spans (y, x0, x1)"""
+        return []
+
+    def build_options(self) -> Gtk.Widget | None:
+        if not self.can_fill:
+            return None
+        filled: Gtk.CheckButton = Gtk.CheckButton(label="Filled", active=self.filled)
+        filled.connect("toggled", lambda btn: setattr(self, "filled", btn.get_active()))
+        return filled
 
     def left_click(self, x: int, y: int) -> None:
-        self.start_pos = (x, y)
-        self.current_pos = (x, y)
+        self.__begin(x, y, State.palette_bar.primary_color)
 
     def left_click_hold(self, x: int, y: int) -> None:
-        self.current_pos = (x, y)
-        State.drawing_area.drawing_area.queue_draw()
+        self.__move(x, y)
 
     def left_click_release(self, x: int, y: int) -> None:
-        if self.start_pos:
-            end_pos = (x, y)
-            self.draw_line(self.start_pos, end_pos)
-            self.start_pos = None
-            self.current_pos = None
-            State.drawing_area.drawing_area.queue_draw()
+        self.__finish(x, y)
 
     def right_click(self, x: int, y: int) -> None:
-        self.left_click(x, y)
+        self.__begin(x, y, State.palette_bar.secondary_color)
 
     def right_click_hold(self, x: int, y: int) -> None:
-        self.left_click_hold(x, y)
+        self.__move(x, y)
 
     def right_click_release(self, x: int, y: int) -> None:
-        self.left_click_release(x, y)
+        self.__finish(x, y)
 
-    def draw_overlay(self, cr: cairo.Context):
-        if not self.start_pos and not self.current_pos:
+    def __begin(self, x: int, y: int, color: int) -> None:
+        self.start_pos = (x, y)
+        self.current_pos = (x, y)
+        self.color = color
+        self.__update_preview()
+        State.drawing_area.drawing_area.queue_draw()
+
+    def __move(self, x: int, y: int) -> None:
+        # Preview is only rasterised again when the end cell changes
+        if self.start_pos and self.current_pos != (x, y):
+            self.current_pos = (x, y)
+            self.__update_preview()
+
+    def __finish(self, x: int, y: int) -> None:
+        if not self.start_pos:
             return
+        buffer: PixelBuffer = State.drawing_area.pixel_data
+        spans: list[tuple[int, int, int]] = clip_spans(
+            self.spans(self.start_pos, (x, y)), buffer.width, buffer.height
+        )
+        if spans:
+            State.history.record_spans(buffer, spans)
+            write_spans(buffer, spans, self.color)
+            State.history.commit()
+            State.drawing_area.mark_dirty(*spans_bounds(spans))
+        self.start_pos = None
+        self.current_pos = None
+        self.preview = None
+        State.drawing_area.drawing_area.queue_draw()
 
-        x0, y0 = self.start_pos
-        x1, y1 = self.current_pos
-        dx = abs(x1 - x0)
-        dy = abs(y1 - y0)
-        sx = 1 if x0 < x1 else -1
-        sy = 1 if y0 < y1 else -1
-        err = dx - dy
+    def __update_preview(self) -> None:
+        spans: list[tuple[int, int, int]] = self.spans(self.start_pos, self.current_pos)
+        x, y, w, h = spans_bounds(spans)
+        self.preview = cairo.ImageSurface(cairo.FORMAT_ARGB32, w, h)
+        self.preview_origin = (x, y)
+        ctx: cairo.Context = cairo.Context(self.preview)
+        ctx.set_source_rgba(*color_to_rgba(self.color))
+        for sy, x0, x1 in spans:
+            ctx.rectangle(x0 - x, sy - y, x1 - x0, 1)
+        ctx.fill()
 
-        if State.drawing_area.left_click_ctrl.get_current_button() == 1:
-            cr.set_source_rgba(*State.palette_bar.primary_color)
-        elif State.drawing_area.right_click_ctrl.get_current_button() == 3:
-            cr.set_source_rgba(*State.palette_bar.secondary_color)
-
-        while True:
-            cr.rectangle(
-                x0 * State.drawing_area.grid_size,
-                y0 * State.drawing_area.grid_size,
-                State.drawing_area.grid_size,
-                State.drawing_area.grid_size,
-            )
-            cr.fill()
-            if (x0 == x1) and (y0 == y1):
-                break
-            e2 = 2 * err
-            if e2 > -dy:
-                err -= dy
-                x0 += sx
-            if e2 < dx:
-                err += dx
-                y0 += sy
-
-    def draw_line(self, start_pos: tuple[int, int], end_pos: tuple[int, int]) -> None:
-        x0, y0 = start_pos
-        x1, y1 = end_pos
-        dx = abs(x1 - x0)
-        dy = abs(y1 - y0)
-        sx = 1 if x0 < x1 else -1
-        sy = 1 if y0 < y1 else -1
-        err = dx - dy
-
-        cs_x: int = State.drawing_area.canvas_size.x - 1
-        cs_y: int = State.drawing_area.canvas_size.y - 1
+    def draw_overlay(self, cr: cairo.Context) -> None:
+        if not self.preview:
+            return
+        cr.save()
+        cr.scale(State.drawing_area.grid_size, State.drawing_area.grid_size)
+        cr.set_source_surface(self.preview, *self.preview_origin)
+        cr.get_source().set_filter(cairo.FILTER_NEAREST)
+        cr.paint()
+        cr.restore()
 
-        if State.drawing_area.left_click_ctrl.get_current_button() == 1:
-            color = State.palette_bar.primary_color
-        elif State.drawing_area.right_click_ctrl.get_current_button() == 3:
-            color = State.palette_bar.secondary_color
-
-        while True:
-            if x0 > cs_x or x0 < 0 or y0 > cs_y or y0 < 0:
-                break
-            State.drawing_area.pixel_data[y0][x0] = color
-            State.drawing_area.update_pixel(x0, y0)
-            if (x0 == x1) and (y0 == y1):
-                break
-            e2 = 2 * err
-            if e2 > -dy:
-                err -= dy
-                x0 += sx
-            if e2 < dx:
-                err += dx
-                y0 += sy
+
+class Line(ShapeTool):
+    def __init__(self):
+        super().__init__("Line (L)", "grid-line-symbolic", "L")
+
+    def spans(
+        self, start_pos: tuple[int, int], end_pos: tuple[int, int]
+    ) -> list[tuple[int, int, int]]:
+        return line_spans(*start_pos, *end_pos)
+
+
+class Rectangle(ShapeTool):
+    can_fill: bool = True
+
+    def __init__(self):
+        super().__init__("Rectangle (R)", "grid-rectangle-symbolic", "R")
+
+    def spans(
+        self, start_pos: tuple[int, int], end_pos: tuple[int, int]
+    ) -> list[tuple[int, int, int]]:
+        return rectangle_spans(*start_pos, *end_pos, self.filled)
+
+
+class Ellipse(ShapeTool):
+    can_fill: bool = True
+
+    def __init__(self):
+        super().__init__("Ellipse (O)", "grid-ellipse-symbolic", "O")
+
+    def spans(
+        self, start_pos: tuple[int, int], end_pos: tuple[int, int]
+    ) -> list[tuple[int, int, int]]:
+        return ellipse_spans(*start_pos, *end_pos, self.filled)
 
 
 class Eraser(DrawTool):
@@ -261,19 +333,278 @@ class Eraser(DrawTool):
             0 <= x < State.drawing_area.canvas_size.x
             and 0 <= y < State.drawing_area.canvas_size.y
         ):
-            State.drawing_area.pixel_data[y][x] = (0, 0, 0, 0)
-
+            State.history.record(State.drawing_area.pixel_data, x, y)
+            State.drawing_area.pixel_data.set(x, y, TRANSPARENT)
             State.drawing_area.update_pixel(x, y)
 
     def left_click_hold(self, x: int, y: int) -> None:
         self.left_click(x, y)
 
+    def left_click_release(self, x: int, y: int) -> None:
+        State.history.commit()
+
     def right_click(self, x: int, y: int) -> None:
         self.left_click(x, y)
 
     def right_click_hold(self, x: int, y: int) -> None:
         self.left_click(x, y)
 
+    def right_click_release(self, x: int, y: int) -> None:
+        State.history.commit()
+
+    def deactivate(self) -> None:
+        State.history.commit()
+
+
+class Fill(DrawTool):
+    tolerance: int = 0
+    connectivity: int = 4
+
+    def __init__(self) -> None:
+        super().__init__("Fill (F)", "grid-fill-symbolic", "F")
+
+    def build_options(self) -> Gtk.Widget:
+        tolerance: Gtk.SpinButton = Gtk.SpinButton.new_with_range(0, 255, 1)
+        tolerance.set_value(self.tolerance)
+        tolerance.connect(
+            "value-changed",
+            lambda btn: setattr(self, "tolerance", btn.get_value_as_int()),
+        )
+        diagonal: Gtk.CheckButton = Gtk.CheckButton(
+            label="Fill Diagonally", active=self.connectivity == 8
+        )
+        diagonal.connect(
+            "toggled",
+            lambda btn: setattr(self, "connectivity", 8 if btn.get_active() else 4),
+        )
+        return Box(
+            children=[Gtk.Label(label="Tolerance", xalign=0), tolerance, diagonal],
+            orientation=Gtk.Orientation.VERTICAL,
+            spacing=6,
+        )
+
+    def left_click(self, x: int, y: int) -> None:
+        self.__fill(x, y, State.palette_bar.primary_color)
+
+    def right_click(self, x: int, y: int) -> None:
+        self.__fill(x, y, State.palette_bar.secondary_color)
+
+    def __fill(self, x: int, y: int, color: int) -> None:
+        buffer: PixelBuffer = State.drawing_area.pixel_data
+        if not buffer.in_bounds(x, y):
+            return
+        if buffer.get(x, y) == color and not self.tolerance:
+            return
+
+        spans: list[tuple[int, int, int]] = flood_fill_spans(
+            buffer, x, y, self.tolerance, self.connectivity
+        )
+        # Without tolerance every filled pixel had the start pixel's color. Indexed
+        # palettes may hold that color at several indices, so their values are read
+        old: int = buffer.get_raw(x, y) if not self.tolerance and buffer.bpp == 4 else None
+        State.history.record_spans(buffer, spans, old)
+        write_spans(buffer, spans, color)
+        State.history.commit()
+        State.drawing_area.mark_dirty(*spans_bounds(spans))
+
+
+class Selection(DrawTool):
+    """
+    Rectangular selection. Dragging inside the selection lifts its pixels into a
+    floating buffer that is drawn from its own cached surface while moving
+    and blitted back into the canvas when anchored.
+    """
+
+    # Shared between documents
+    clipboard: PixelBuffer = None
+
+    # Selected rectangle (x, y, w, h) in canvas pixels
+    rect: tuple[int, int, int, int] = None
+    start_pos: tuple[int, int] = None
+    # Floating pixels, their cached surface and drag offset from the pointer
+    floating: PixelBuffer = None
+    floating_surface: cairo.ImageSurface = None
+    drag_offset: tuple[int, int] = None
+
+    def __init__(self) -> None:
+        super().__init__("Selection (S)", "grid-select-symbolic", "S")
+        self.add_controller(
+            Utils.callback_shortcuts(
+                {
+                    "<Control>c": self.copy,
+                    "<Control>x": self.cut,
+                    "<Control>v": self.paste,
+                    "Delete": self.delete,
+                    "Escape": self.__deactivate_shortcut,
+                    "Return": self.__deactivate_shortcut,
+                }
+            )
+        )
+
+    def __inside(self, x: int, y: int) -> bool:
+        if not self.rect:
+            return False
+        rx, ry, rw, rh = self.rect
+        return rx <= x < rx + rw and ry <= y < ry + rh
+
+    def left_click(self, x: int, y: int) -> None:
+        if self.__inside(x, y):
+            if not self.floating:
+                self.__lift()
+            self.drag_offset = (x - self.rect[0], y - self.rect[1])
+        else:
+            self.anchor()
+            self.start_pos = (x, y)
+            self.rect = (x, y, 1, 1)
+        State.drawing_area.drawing_area.queue_draw()
+
+    def left_click_hold(self, x: int, y: int) -> None:
+        if self.drag_offset:
+            # Only the floating surface moves. The canvas is not re-rendered
+            self.rect = (
+                x - self.drag_offset[0],
+                y - self.drag_offset[1],
+                *self.rect[2:],
+            )
+        elif self.start_pos:
+            x0, y0 = self.start_pos
+            self.rect = (min(x, x0), min(y, y0), abs(x - x0) + 1, abs(y - y0) + 1)
+
+    def left_click_release(self, x: int, y: int) -> None:
+        if self.start_pos and self.rect:
+            # Keep selection inside the canvas
+            rect = State.drawing_area.pixel_data.clip_rect(*self.rect)
+            self.rect = rect if rect[2] and rect[3] else None
+        self.start_pos = None
+        self.drag_offset = None
+        State.drawing_area.drawing_area.queue_draw()
+
+    def right_click(self, x: int, y: int) -> None:
+        self.deactivate()
+
+    def __set_floating(self, floating: PixelBuffer) -> None:
+        self.floating = floating
+        self.floating_surface = cairo.ImageSurface(
+            cairo.FORMAT_ARGB32, floating.width, floating.height
+        )
+        Utils.blit_to_surface(self.floating_surface, floating)
+
+    def __clear_rect(self) -> None:
+        """Make selected canvas pixels transparent"""
+        buffer: PixelBuffer = State.drawing_area.pixel_data
+        State.history.record_region(buffer, *self.rect)
+        buffer.fill_rect(*self.rect, TRANSPARENT)
+        State.drawing_area.mark_dirty(*self.rect)
+
+    def __lift(self) -> None:
+        """Move selected pixels from the canvas to the floating buffer"""
+        self.__set_floating(State.drawing_area.pixel_data.get_region(*self.rect))
+        # History operation stays open until the floating pixels are anchored
+        self.__clear_rect()
+
+    def anchor(self) -> None:
+        """Blit floating pixels into the canvas"""
+        if not self.floating:
+            return
+        buffer: PixelBuffer = State.drawing_area.pixel_data
+        x, y = self.rect[:2]
+        State.history.record_region(buffer, x, y, self.floating.width, self.floating.height)
+        buffer.put_region(x, y, self.floating)
+        State.history.commit()
+        State.drawing_area.mark_dirty(x, y, self.floating.width, self.floating.height)
+        self.floating = None
+        self.floating_surface = None
+
+    def deactivate(self) -> None:
+        self.anchor()
+        self.rect = None
+        self.start_pos = None
+        self.drag_offset = None
+        State.drawing_area.drawing_area.queue_draw()
+
+    def __deactivate_shortcut(self) -> bool:
+        if not self.rect:
+            return False
+        self.deactivate()
+        return True
+
+    def copy(self) -> bool:
+        if not self.rect:
+            return False
+        if self.floating:
+            Selection.clipboard = self.floating.copy()
+        else:
+            Selection.clipboard = State.drawing_area.pixel_data.get_region(*self.rect)
+        return True
+
+    def cut(self) -> bool:
+        if not self.copy():
+            return False
+        if self.floating:
+            # Pixels were already removed from the canvas when lifted
+            State.history.commit()
+            self.floating = None
+            self.floating_surface = None
+        else:
+            self.__clear_rect()
+            State.history.commit()
+        self.rect = None
+        State.drawing_area.drawing_area.queue_draw()
+        return True
+
+    def delete(self) -> bool:
+        if not self.rect:
+            return False
+        if self.floating:
+            State.history.commit()
+            self.floating = None
+            self.floating_surface = None
+        else:
+            self.__clear_rect()
+            State.history.commit()
+        self.rect = None
+        State.drawing_area.drawing_area.queue_draw()
+        return True
+
+    def paste(self) -> bool:
+        if not Selection.clipboard or not State.drawing_area.pixel_data:
+            return False
+        if State.toolbar.current_tool is not self:
+            self.do_clicked()
+        self.anchor()
+        # Paste at the current selection or at the canvas origin
+        x, y = self.rect[:2] if self.rect else (0, 0)
+        self.__set_floating(Selection.clipboard.copy())
+        self.rect = (x, y, self.floating.width, self.floating.height)
+        State.drawing_area.drawing_area.queue_draw()
+        return True
+
+    def draw_overlay(self, cr: cairo.Context) -> None:
+        if not self.rect:
+            return
+        grid_size: int = State.drawing_area.grid_size
+        x, y, w, h = self.rect
+
+        if self.floating_surface:
+            cr.save()
+            cr.scale(grid_size, grid_size)
+            cr.set_source_surface(self.floating_surface, x, y)
+            cr.get_source().set_filter(cairo.FILTER_NEAREST)
+            cr.paint()
+            cr.restore()
+
+        # Selection outline
+        cr.save()
+        cr.set_line_width(1)
+        cr.set_dash([4, 4])
+        cr.rectangle(x * grid_size + 0.5, y * grid_size + 0.5, w * grid_size, h * grid_size)
+        cr.set_source_rgba(1, 1, 1, 1)
+        cr.stroke_preserve()
+        cr.set_dash([4, 4], 4)
+        cr.set_source_rgba(0, 0, 0, 1)
+        cr.stroke()
+        cr.restore()
+
 
 class ColorPicker(ButtonTool):
     def __init__(self) -> None:
@@ -281,19 +612,24 @@ class ColorPicker(ButtonTool):
 
     def do_clicked(self):
         def __on_selected(portal: Xdp.Portal, task):
-            color: Gdk.RGBA = Gdk.RGBA()
-            color.red, color.green, color.blue = portal.pick_color_finish(task)
-            color.alpha = 1
-            color_rgba = color.to_string().strip("rgba()").split(",")
-            State.palette_bar.primary_color = Utils.rgba_to_hex(
-                [int(c) for c in color_rgba] + [255]
-            )
+            r, g, b = portal.pick_color_finish(task)
+            State.palette_bar.primary_color = rgba_to_color(r, g, b)
 
         Xdp.Portal().pick_color(None, None, __on_selected)
 
 
 class Toolbar(Gtk.Box):
-    tools: list = [Pencil, Line, Eraser, ColorPicker, Zoom]
+    tools: list = [
+        Pencil,
+        Line,
+        Rectangle,
+        Ellipse,
+        Eraser,
+        Fill,
+        Selection,
+        ColorPicker,
+        Zoom,
+    ]
     current_tool: ButtonTool | DrawTool
 
     def __init__(self) -> None:
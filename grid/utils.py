@@ -1,105 +1,145 @@
-import random
-import string
+from __future__ import annotations
+
+import os
+from typing import TYPE_CHECKING, Callable
+
 import cairo
-from gi.repository import GdkPixbuf, Gtk  # type:ignore
-from state import State
+from gi.repository import GdkPixbuf, GLib, Gtk  # type:ignore
+from pixel_buffer import PixelBuffer, color_to_hex, pack_rows
+from quantize import extract_palette
+import png as Png
+import atlas as Atlas
 
+if TYPE_CHECKING:
+    from layers import LayerStack
 
-def generate_random_ascii_string(length: int) -> str:
-    return "".join(random.choice(string.ascii_letters) for _ in range(length))
+# Bytes of image file decoded at once by load_png
+LOAD_CHUNK_SIZE: int = 256 * 1024
 
 
-def rgba_to_hex(rgba: tuple[int, int, int, int]) -> str:
-    r, g, b, a = rgba
-    return "#{:02x}{:02x}{:02x}{:02x}".format(
-        int(r * 255), int(g * 255), int(b * 255), int(a * 255)
+def get_pallete_colors_from_file(
+    image_path: str, max_colors: int = 32, progress: Callable[[float], None] = None
+) -> list[str]:
+    """
+    Extract palette of at most `max_colors` colors from image, most used first.
+    Safe to call off the main thread
+    """
+    pixbuf: GdkPixbuf.Pixbuf = load_pixbuf(image_path, progress)
+    data: bytes = pack_rows(
+        pixbuf.get_width(),
+        pixbuf.get_height(),
+        pixbuf.read_pixel_bytes().get_data(),
+        pixbuf.get_rowstride(),
+        pixbuf.get_n_channels(),
     )
+    return [color_to_hex(color) for color in extract_palette(data, max_colors)]
 
 
-def hex_to_rgba(hex_code: str) -> tuple[float, float, float, float]:
-    """Convert HEX to RGBA 0-1 floats tuple"""
-    hex_code = hex_code.lstrip("#")
-    length = len(hex_code)
-    rgb = [int(hex_code[i : i + 2], 16) / 255.0 for i in range(0, 6, 2)]
-    alpha = int(hex_code[6:8], 16) / 255.0 if length == 8 else 1.0
-    return (*rgb, alpha)
-
-
-def get_pallete_colors_from_file(image_path: str) -> list[str]:
-    # Load the image
-    pixbuf: GdkPixbuf.Pixbuf = GdkPixbuf.Pixbuf.new_from_file(image_path)
-
-    # Get image dimensions and properties
-    width: int = pixbuf.get_width()
-    height: int = pixbuf.get_height()
-    n_channels: int = pixbuf.get_n_channels()
-    rowstride: int = pixbuf.get_rowstride()
-    pixels: bytes = pixbuf.get_pixels()
-
-    # Extract colors
-    colors: list[str] = []
-    for y in range(height):
-        for x in range(width):
-            offset: int = y * rowstride + x * n_channels
-            color_rgb: list[int] = list(pixels[offset : offset + n_channels])
-            if len(color_rgb) == 3:
-                color_rgb.append(255)
-            color_hex: str = rgba_to_hex(tuple(color_rgb))
-            if color_hex not in colors:
-                colors.append(color_hex)
-    colors.sort()
-    return colors
-
-
-def load_png(path: str) -> list[list[str]]:
-    # Load the image
-    pixbuf = GdkPixbuf.Pixbuf.new_from_file(path)
-
-    # Get image properties
-    width = pixbuf.get_width()
-    height = pixbuf.get_height()
-    rowstride = pixbuf.get_rowstride()
-    n_channels = pixbuf.get_n_channels()
-    pixels = pixbuf.get_pixels()
-
-    # Initialize the 2D array for HEX values
-    hex_array = []
-
-    for y in range(height):
-        row = []
-        for x in range(width):
-            offset = y * rowstride + x * n_channels
-            r = pixels[offset]
-            g = pixels[offset + 1]
-            b = pixels[offset + 2]
-            if n_channels == 4:
-                a = pixels[offset + 3]
-                hex_value = f"#{r:02X}{g:02X}{b:02X}{a:02X}"
-            else:
-                hex_value = f"#{r:02X}{g:02X}{b:02X}"
-            row.append(hex_value)
-        hex_array.append(row)
-
-    return hex_array
-
-
-def save_png(path: str):
-    # Create a Cairo surface to draw on
-    surface: cairo.ImageSurface = cairo.ImageSurface(
-        cairo.FORMAT_ARGB32,
-        State.drawing_area.canvas_size.x,
-        State.drawing_area.canvas_size.y,
+def load_pixbuf(path: str, progress: Callable[[float], None] = None) -> GdkPixbuf.Pixbuf:
+    """
+    Decode image. The file is fed to the loader in chunks so `progress` can
+    report the read fraction (and cancel by raising). Safe to call off the main thread
+    """
+    loader: GdkPixbuf.PixbufLoader = GdkPixbuf.PixbufLoader()
+    size: int = os.path.getsize(path) or 1
+    read: int = 0
+    with open(path, "rb") as file:
+        try:
+            while chunk := file.read(LOAD_CHUNK_SIZE):
+                loader.write(chunk)
+                read += len(chunk)
+                if progress:
+                    progress(read / size)
+        except BaseException:
+            # Release the loader. Its error about the incomplete image doesn't matter
+            try:
+                loader.close()
+            except GLib.Error:
+                pass
+            raise
+    loader.close()
+    return loader.get_pixbuf()
+
+
+def load_png(path: str, progress: Callable[[float], None] = None) -> PixelBuffer:
+    pixbuf: GdkPixbuf.Pixbuf = load_pixbuf(path, progress)
+
+    # Hand the whole pixel block to the buffer. No per-pixel work here
+    return PixelBuffer.from_rows(
+        pixbuf.get_width(),
+        pixbuf.get_height(),
+        pixbuf.read_pixel_bytes().get_data(),
+        pixbuf.get_rowstride(),
+        pixbuf.get_n_channels(),
     )
-    cr: cairo.Context = cairo.Context(surface)
 
-    # Draw the pixel data onto the surface
-    for x in range(State.drawing_area.canvas_size.x):
-        for y in range(State.drawing_area.canvas_size.y):
-            cr.set_source_rgba(*hex_to_rgba(State.drawing_area.pixel_data[y][x]))
-            cr.rectangle(x, y, 1, 1)
-            cr.fill()
 
-    surface.write_to_png(path)
+def blit_to_surface(
+    surface: cairo.ImageSurface,
+    buffer: PixelBuffer,
+    x: int = 0,
+    y: int = 0,
+    w: int = None,
+    h: int = None,
+    origin_x: int = 0,
+    origin_y: int = 0,
+) -> None:
+    """
+    Copy buffer region into an ARGB32 image surface.
+    `origin_x` and `origin_y` are the buffer coordinates of the surface's top left corner
+    """
+    w = buffer.width - x if w is None else w
+    h = buffer.height - y if h is None else h
+    argb: bytearray = buffer.argb32_region(x, y, w, h)
+
+    # Position in surface coordinates
+    sx, sy = x - origin_x, y - origin_y
+
+    surface.flush()
+    data: memoryview = surface.get_data()
+    stride: int = surface.get_stride()
+    row_len: int = w * 4
+    if sx == 0 and stride == row_len:
+        data[sy * stride : (sy + h) * stride] = argb
+    else:
+        for row in range(h):
+            offset: int = (sy + row) * stride + sx * 4
+            data[offset : offset + row_len] = argb[row * row_len : (row + 1) * row_len]
+    surface.mark_dirty_rectangle(sx, sy, w, h)
+
+
+def save_png(
+    path: str, frame: LayerStack, scale: int = 1, progress: Callable[[float], None] = None
+) -> None:
+    """
+    Export flattened frame, as indexed PNG when its layers merge by index.
+    Safe to call off the main thread with a document snapshot
+    """
+    buffer: PixelBuffer = frame.flatten_indexed() or frame.flatten()
+    Png.write_buffer(path, buffer, progress, scale)
+
+
+def save_atlas(
+    path: str, frames: list[LayerStack], progress: Callable[[float], None] = None
+) -> None:
+    """
+    Export frames as a trimmed, deduplicated sprite sheet with a JSON frame map.
+    Safe to call off the main thread with a document snapshot
+    """
+    name: str = os.path.splitext(os.path.basename(path))[0]
+    sprites: list[Atlas.Sprite] = []
+    for i, frame in enumerate(frames):
+        if progress:
+            progress(i / len(frames) / 2)
+        buffer: PixelBuffer = frame.flatten()
+        sprites.append(
+            Atlas.make_sprite(
+                f"{name}_{i}", buffer.width, buffer.height, buffer.to_bytes(), trim=True
+            )
+        )
+    Atlas.write_atlas(
+        sprites, path, progress=progress and (lambda fraction: progress(0.5 + fraction / 2))
+    )
 
 
 def button_shortcut(*shortcuts: list[str]) -> Gtk.ShortcutController:
@@ -115,6 +155,23 @@ def button_shortcut(*shortcuts: list[str]) -> Gtk.ShortcutController:
     return ctrl
 
 
+def callback_shortcuts(shortcuts: dict[str, Callable[[], bool]]) -> Gtk.ShortcutController:
+    """
+    Create global shortcut controller calling functions by shortcut triggers.
+    Functions return True if the shortcut was handled
+    """
+    ctrl: Gtk.ShortcutController = Gtk.ShortcutController.new()
+    ctrl.set_scope(Gtk.ShortcutScope.GLOBAL)
+    for shortcut, callback in shortcuts.items():
+        ctrl.add_shortcut(
+            Gtk.Shortcut(
+                action=Gtk.CallbackAction.new(lambda *_, cb=callback: cb()),
+                trigger=Gtk.ShortcutTrigger.parse_string(shortcut),
+            )
+        )
+    return ctrl
+
+
 def get_children(obj: Gtk.Widget) -> list[Gtk.Widget]:
     """
     Get list of widget's children
@@ -1,21 +1,36 @@
+import os
+from typing import Any, Callable
+
 import utils as Utils
 from drawing_area import DrawingArea
-from gi.repository import Adw, Gio, Gtk  # type:ignore
+from gi.repository import Adw, Gio, GLib, Gtk  # type:ignore
 from palette_bar import PaletteBar
 from shared import Box, ToolbarView, Button
 from state import State
 from toolbar import Toolbar
 from new_dialog import NewDialog
+from pixel_buffer import PixelBuffer
+from document import Document
+from grid_file import GridFile
+from layers_panel import LayersPanel
+from timeline import Timeline
+from autosave import Autosave
+from task import Cancelled, Task
 
 
 class Window(Adw.ApplicationWindow):
+    # Running open or save operation
+    task: Task = None
+
     def __init__(self) -> None:
         super().__init__()
         State.main_window = self
         self.set_application(State.application)
         State.icon_theme = Gtk.IconTheme.get_for_display(self.get_display())
         State.icon_theme.add_search_path("data/icons")
+        Autosave()
         self.__build_ui()
+        self.connect("close-request", self.__on_close_request)
 
     def __build_ui(self) -> None:
         self.set_title("Grid")
@@ -43,10 +58,79 @@ class Window(Adw.ApplicationWindow):
             on_click=self.__on_open_btn_clicked,
         )
 
-        hb: Adw.HeaderBar = Adw.HeaderBar()
+        export_atlas_btn: Button = Button(
+            tooltip_text="Export Sprite Sheet",
+            icon_name="view-app-grid-symbolic",
+            on_click=self.__on_export_atlas_btn_clicked,
+        )
+
+        undo_btn: Button = Button(
+            tooltip_text="Undo",
+            icon_name="edit-undo-symbolic",
+            on_click=lambda *_: State.drawing_area.undo(),
+        )
+        undo_btn.add_controller(Utils.button_shortcut("<Control>z"))
+
+        redo_btn: Button = Button(
+            tooltip_text="Redo",
+            icon_name="edit-redo-symbolic",
+            on_click=lambda *_: State.drawing_area.redo(),
+        )
+        redo_btn.add_controller(Utils.button_shortcut("<Control><Shift>z", "<Control>y"))
+
+        self.export_scale: Gtk.SpinButton = Gtk.SpinButton.new_with_range(1, 32, 1)
+        self.export_scale.set_tooltip_text("Export Scale")
+
+        self.window_title: Adw.WindowTitle = Adw.WindowTitle(title="Grid")
+
+        # Progress of the running open or save task
+        self.progress_bar: Gtk.ProgressBar = Gtk.ProgressBar(
+            show_text=True, valign=Gtk.Align.CENTER
+        )
+        self.task_box: Box = Box(
+            children=[
+                self.progress_bar,
+                Button(
+                    tooltip_text="Cancel",
+                    icon_name="process-stop-symbolic",
+                    on_click=lambda *_: self.task.cancel(),
+                    css_classes=["flat"],
+                ),
+            ],
+            spacing=6,
+            visible=False,
+        )
+        self.file_buttons: list[Gtk.Widget] = [
+            new_btn,
+            open_btn,
+            save_img_btn,
+            export_atlas_btn,
+        ]
+
+        hb: Adw.HeaderBar = Adw.HeaderBar(title_widget=self.window_title)
         hb.pack_start(new_btn)
         hb.pack_start(open_btn)
         hb.pack_start(save_img_btn)
+        hb.pack_start(export_atlas_btn)
+        hb.pack_start(self.export_scale)
+        hb.pack_start(self.task_box)
+        hb.pack_end(redo_btn)
+        hb.pack_end(undo_btn)
+
+        # Offer to restore the autosaved document if the last session didn't exit cleanly
+        self.recover_btn: Button = Button(
+            child=Adw.ButtonContent(label="Recover", icon_name="document-revert-symbolic"),
+            on_click=self.__on_recover_btn_clicked,
+            css_classes=["pill", "suggested-action"],
+            halign=Gtk.Align.CENTER,
+            visible=State.autosave.has_recovery(),
+        )
+        if self.recover_btn.get_visible():
+            info: dict = State.autosave.recovery_info()
+            self.recover_btn.set_tooltip_text(
+                "Unsaved work from "
+                + GLib.DateTime.new_from_unix_local(int(info["time"])).format("%c")
+            )
 
         # Empty state overlay
         self.welcome_page = ToolbarView(
@@ -76,6 +160,7 @@ class Window(Adw.ApplicationWindow):
                             css_classes=["pill"],
                             halign=Gtk.Align.CENTER,
                         ),
+                        self.recover_btn,
                     ],
                 ),
             ),
@@ -83,10 +168,13 @@ class Window(Adw.ApplicationWindow):
         overlay: Gtk.Overlay = Gtk.Overlay(
             child=ToolbarView(
                 top_bars=[hb],
+                bottom_bars=[Timeline()],
                 content=Box(
                     children=[
                         PaletteBar(),
                         Gtk.Separator(orientation=Gtk.Orientation.VERTICAL),
+                        LayersPanel(),
+                        Gtk.Separator(orientation=Gtk.Orientation.VERTICAL),
                         Gtk.ScrolledWindow(child=DrawingArea(), hexpand=True),
                         Gtk.Separator(orientation=Gtk.Orientation.VERTICAL),
                         Toolbar(),
@@ -99,34 +187,158 @@ class Window(Adw.ApplicationWindow):
 
         self.set_content(overlay)
 
+    def update_document_info(self) -> None:
+        """Show canvas size, frame count and memory used by pixels in the header bar"""
+        document: Document = State.drawing_area.document
+        self.window_title.set_subtitle(
+            f"{document.width}x{document.height} · {len(document.frames)} frames"
+            f" · {GLib.format_size(document.memory_usage())}"
+        )
+
+    def run_task(
+        self, label: str, work: Callable[[Callable[[float], None]], Any], done: Callable
+    ) -> None:
+        """Run file operation on a worker thread, showing its progress in the header bar"""
+        if self.task:
+            return
+
+        def __finish() -> None:
+            self.task = None
+            self.task_box.set_visible(False)
+            for btn in self.file_buttons:
+                btn.set_sensitive(True)
+            # Back to the welcome page if opening the first document failed
+            self.welcome_page.set_visible(not State.drawing_area.document)
+
+        def __done(result: Any) -> None:
+            done(result)
+            __finish()
+
+        def __failed(error: BaseException) -> None:
+            __finish()
+            if not isinstance(error, Cancelled):
+                print(error)
+
+        self.task = Task(work, __done, self.progress_bar.set_fraction, __failed)
+        self.progress_bar.set_text(label)
+        self.progress_bar.set_fraction(0)
+        self.task_box.set_visible(True)
+        # The welcome page would cover the progress
+        self.welcome_page.set_visible(False)
+        for btn in self.file_buttons:
+            btn.set_sensitive(False)
+        self.task.start()
+
     def __on_save_img_btn_clicked(self, _) -> None:
         def __save_cb(dialog: Gtk.FileDialog, res: Gio.Task) -> None:
             try:
                 path: str = dialog.save_finish(res).get_path()
-                Utils.save_png(path)
-            except BaseException as e:
+            except GLib.Error as e:
                 print(e)
+                return
+
+            # The worker reads a copy-on-write snapshot, editing can go on meanwhile
+            document: Document = State.drawing_area.document
+            snapshot: Document = document.snapshot()
+            snapshot.file = document.file
+            label: str = f"Saving {os.path.basename(path)}"
+            if path.endswith(".grid"):
 
+                def __saved(grid_file: GridFile) -> None:
+                    if State.drawing_area.document is document:
+                        document.file = grid_file
+
+                self.run_task(
+                    label,
+                    lambda progress: GridFile.save(snapshot, path, progress) or snapshot.file,
+                    __saved,
+                )
+            else:
+                scale: int = self.export_scale.get_value_as_int()
+                self.run_task(
+                    label,
+                    lambda progress: Utils.save_png(
+                        path, snapshot.current_frame, scale, progress
+                    ),
+                    lambda _: None,
+                )
+
+        document_file: GridFile = State.drawing_area.document.file
         Gtk.FileDialog(
-            initial_name="untitled.png",
-            default_filter=Gtk.FileFilter(patterns=["*.png"]),
+            initial_name=(
+                os.path.basename(document_file.path) if document_file else "untitled.png"
+            ),
+            filters=self.__file_filters(),
         ).save(self, None, __save_cb)
 
+    def __on_export_atlas_btn_clicked(self, _) -> None:
+        def __save_cb(dialog: Gtk.FileDialog, res: Gio.Task) -> None:
+            try:
+                path: str = dialog.save_finish(res).get_path()
+            except GLib.Error as e:
+                print(e)
+                return
+            snapshot: Document = State.drawing_area.document.snapshot()
+            self.run_task(
+                f"Exporting {os.path.basename(path)}",
+                lambda progress: Utils.save_atlas(path, snapshot.frames, progress),
+                lambda _: None,
+            )
+
+        filters: Gio.ListStore = Gio.ListStore.new(Gtk.FileFilter)
+        filters.append(Gtk.FileFilter(name="PNG Image", patterns=["*.png"]))
+        Gtk.FileDialog(initial_name="spritesheet.png", filters=filters).save(
+            self, None, __save_cb
+        )
+
+    def __file_filters(self) -> Gio.ListStore:
+        filters: Gio.ListStore = Gio.ListStore.new(Gtk.FileFilter)
+        filters.append(Gtk.FileFilter(name="PNG Image", patterns=["*.png"]))
+        filters.append(Gtk.FileFilter(name="Grid Project", patterns=["*.grid"]))
+        return filters
+
+    def __on_recover_btn_clicked(self, _) -> None:
+        try:
+            State.drawing_area.load_document(State.autosave.recover())
+            self.welcome_page.set_visible(False)
+        except BaseException as e:
+            print(e)
+
+    def __on_close_request(self, _) -> bool:
+        # Clean exit, nothing to recover
+        State.autosave.discard()
+        return False
+
     def __on_new_btn_clicked(self, _) -> None:
         if not State.new_dialog:
             State.new_dialog = NewDialog()
         State.new_dialog.present(self)
 
     def __on_open_btn_clicked(self, _) -> None:
+        def __load(path: str, progress: Callable[[float], None]) -> Document:
+            # Runs on the worker thread
+            if path.endswith(".grid"):
+                return GridFile.load(path)
+            pixel_data: PixelBuffer = Utils.load_png(path, progress)
+            return Document.from_buffer(pixel_data)
+
+        def __loaded(document: Document) -> None:
+            State.drawing_area.load_document(document)
+
         def __open_cb(dialog: Gtk.FileDialog, res: Gio.Task) -> None:
             try:
                 path: str = dialog.open_finish(res).get_path()
-                pixel_data: list[list[str]] = Utils.load_png(path)
-                State.drawing_area.load_image(pixel_data)
-                self.welcome_page.set_visible(False)
-            except BaseException as e:
+            except GLib.Error as e:
                 print(e)
+                return
+            self.run_task(
+                f"Opening {os.path.basename(path)}",
+                lambda progress: __load(path, progress),
+                __loaded,
+            )
 
-        Gtk.FileDialog(default_filter=Gtk.FileFilter(patterns=["*.png"])).open(
-            self, None, __open_cb
-        )
+        Gtk.FileDialog(
+            default_filter=Gtk.FileFilter(
+                name="Images and Projects", patterns=["*.png", "*.grid"]
+            )
+        ).open(self, None, __open_cb)